@@ -0,0 +1,7 @@
+'''Cross-backend benchmarks for the inventory API.
+
+Run from the project root, e.g.::
+
+    $ python -m benchmarks.run --backends sqlalchemy,peewee --rows 1000
+
+'''
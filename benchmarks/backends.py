@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Adapters that boot each api_* app against a scratch datastore, bulk-load
+it with a fixed dataset and count the queries each request issues.
+
+The SQL backends use a throwaway SQLite file in the temp directory. The
+Mongoengine and Stdnet backends need a local mongod/redis-server.
+
+WARNING: Like the test suite, the Pony, Mongoengine and Stdnet adapters
+drop the data in the databases those apps are bound to.
+'''
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+BACKENDS = ('sqlalchemy', 'peewee', 'pony', 'mongoengine', 'stdnet')
+
+# Percentage of items that are checked out
+CHECKED_OUT_PERCENT = 10
+
+
+class QueryCounter(object):
+    '''Counts round trips to the datastore.'''
+
+    def __init__(self):
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+
+def patch_counting(owner, attr, counter):
+    '''Wrap ``owner.attr`` so that each call bumps ``counter``. Returns a
+    function that restores the original attribute.
+    '''
+    original = getattr(owner, attr)
+    saved = vars(owner).get(attr)
+
+    def counted(*args, **kwargs):
+        counter.count += 1
+        return original(*args, **kwargs)
+
+    setattr(owner, attr, counted)
+
+    def restore():
+        if saved is None:
+            delattr(owner, attr)
+        else:
+            setattr(owner, attr, saved)
+    return restore
+
+
+def make_rows(n_people, n_items, recent=None):
+    '''Return deterministic ``(people, items)`` rows. Every item is owned by
+    a person (referenced by index into ``people``); updated timestamps are
+    spread over the last two hours so that roughly half of the checked out
+    items count as recent checkouts.
+
+    :param int recent: If given, exactly this many items are recent
+        checkouts and every other item was updated over an hour ago.
+    '''
+    now = datetime.utcnow()
+    people = [("First{0}".format(i), "Last{0}".format(i),
+                now - timedelta(seconds=i))
+                for i in range(n_people)]
+    items = []
+    for i in range(n_items):
+        checked_out = i % 100 < CHECKED_OUT_PERCENT
+        if recent is None:
+            age = (i * 7) % 7200
+        elif i < recent:
+            checked_out, age = True, i % 60
+        else:
+            age = 7200 + i % 3600
+        items.append(("Item {0}".format(i), i % n_people, checked_out,
+                        now - timedelta(seconds=age)))
+    return people, items
+
+
+def scratch_path(name):
+    path = os.path.join(tempfile.gettempdir(), "sleepy_bench_{0}.db".format(name))
+    # A WAL file left behind would be replayed into the new database
+    for leftover in (path, path + "-wal", path + "-shm", path + "-journal"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return path
+
+
+def _format_dt(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def item_counts(people, items):
+    '''Return the number of items of each person, for their stored
+    ``item_count``.
+    '''
+    counts = [0] * len(people)
+    for _, person, _, _ in items:
+        counts[person] += 1
+    return counts
+
+
+def seed_sqlite(path, person_table, item_table, person_column, people, items):
+    '''Bulk-load rows into a SQLite file with executemany. Returns the
+    ``(person_ids, item_ids)`` that were inserted.
+    '''
+    counts = item_counts(people, items)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany(
+            "INSERT INTO {0} (id, firstname, lastname, created, item_count) "
+            "VALUES (?, ?, ?, ?, ?)".format(person_table),
+            ((i + 1, first, last, _format_dt(created), counts[i])
+                for i, (first, last, created) in enumerate(people)))
+        conn.executemany(
+            "INSERT INTO {0} (id, name, {1}, checked_out, updated) "
+            "VALUES (?, ?, ?, ?, ?)".format(item_table, person_column),
+            ((i + 1, name, person + 1, int(checked_out), _format_dt(updated))
+                for i, (name, person, checked_out, updated) in enumerate(items)))
+        conn.commit()
+    finally:
+        conn.close()
+    return list(range(1, len(people) + 1)), list(range(1, len(items) + 1))
+
+
+class Backend(object):
+    '''Base adapter. Subclasses import their app lazily in ``setup`` so that
+    a missing driver or service only skips that backend.
+    '''
+    name = None
+
+    def __init__(self, **config):
+        self.config = config
+        self.counter = QueryCounter()
+        self._restore = []
+
+    def settings(self, **settings):
+        '''Return the app config to create the app with: ``settings``,
+        overridden by the config the adapter was created with. It's kept as
+        ``app_settings``, to point other processes at the same database.
+        '''
+        settings.setdefault('DEBUG', False)
+        settings.update(self.config)
+        self.app_settings = settings
+        return settings
+
+    def setup(self):
+        '''Import the app, point it at a scratch database, create the schema
+        and start counting queries.
+        '''
+        raise NotImplementedError
+
+    def seed(self, n_people, n_items, recent=None):
+        '''Load the dataset built by ``make_rows``. Returns
+        ``(person_ids, item_ids)``.
+        '''
+        raise NotImplementedError
+
+    def reset(self):
+        '''Empty the database between dataset sizes.'''
+        raise NotImplementedError
+
+    def teardown(self):
+        for restore in reversed(self._restore):
+            restore()
+        self._restore = []
+
+    def clear_cache(self):
+        '''Drop cached resources, which go stale when the data is reloaded.'''
+        with self.app.app_context():
+            self.api.cache.clear()
+
+    def count_calls(self, owner, attr):
+        self._restore.append(patch_counting(owner, attr, self.counter))
+
+    @property
+    def client(self):
+        return self.app.test_client()
+
+
+class SQLAlchemyBackend(Backend):
+    name = 'sqlalchemy'
+
+    def setup(self):
+        from sqlalchemy import event
+        from sleepy import configure_app, api_sqlalchemy as api
+        self.api = api
+        self.path = scratch_path(self.name)
+        self.app = configure_app(self.name, self.settings(
+            SQLALCHEMY_DATABASE_URI="sqlite:///{0}".format(self.path)))
+        self.reset()
+        # Listeners can't be removed on SQLAlchemy 0.8, so switch it off instead
+        self._counting = True
+        event.listen(api.db.get_engine(self.app), 'before_cursor_execute',
+                    self._on_execute)
+        self._restore.append(lambda: setattr(self, '_counting', False))
+
+    def _on_execute(self, *args):
+        if self._counting:
+            self.counter.count += 1
+
+    def reset(self):
+        with self.app.app_context():
+            self.api.db.session.remove()
+            self.api.db.drop_all()
+            self.api.db.create_all()
+        self.clear_cache()
+
+    def seed(self, n_people, n_items, recent=None):
+        people, items = make_rows(n_people, n_items, recent)
+        return seed_sqlite(self.path, 'person', 'item', 'person_id',
+                            people, items)
+
+
+class PeeweeBackend(Backend):
+    name = 'peewee'
+
+    def setup(self):
+        from sleepy import configure_app, api_peewee as api
+        self.api = api
+        self.path = scratch_path(self.name)
+        self.app = configure_app(self.name, self.settings(
+            DATABASE={"name": self.path, "engine": "peewee.SqliteDatabase"}))
+        self.reset()
+        self.count_calls(api.db.database, 'execute_sql')
+
+    def reset(self):
+        self.api.drop_tables()
+        self.api.create_tables()
+        self.clear_cache()
+
+    def seed(self, n_people, n_items, recent=None):
+        people, items = make_rows(n_people, n_items, recent)
+        return seed_sqlite(self.path, 'person', 'item', 'person_id',
+                            people, items)
+
+
+class PonyBackend(Backend):
+    name = 'pony'
+
+    def setup(self):
+        from sleepy import configure_app, api_pony as api
+        self.api = api
+        self.app = configure_app(self.name, self.settings())
+        self.path = api.db.provider.pool.filename
+        self.reset()
+        self.count_calls(api.db, '_exec_sql')
+
+    def reset(self):
+        self.api.db.drop_all_tables(with_all_data=True)
+        self.api.create_tables()
+        self.clear_cache()
+
+    def seed(self, n_people, n_items, recent=None):
+        people, items = make_rows(n_people, n_items, recent)
+        return seed_sqlite(self.path, 'people', 'items', 'person',
+                            people, items)
+
+
+class MongoengineBackend(Backend):
+    name = 'mongoengine'
+    db_name = '_bench_inventory'
+    batch_size = 10000
+
+    def setup(self):
+        from pymongo.mongo_client import MongoClient
+        from sleepy import configure_app, api_mongoengine as api
+        self.api = api
+        self.app = configure_app(self.name, self.settings(
+            MONGODB_SETTINGS={"DB": self.db_name}))
+        self.reset()
+        self.count_calls(MongoClient, '_send_message')
+        self.count_calls(MongoClient, '_send_message_with_response')
+
+    def reset(self):
+        self.api.drop_collections()
+        self.clear_cache()
+
+    def seed(self, n_people, n_items, recent=None):
+        from bson import ObjectId
+        people, items = make_rows(n_people, n_items, recent)
+        item_ids = [ObjectId() for _ in items]
+        owned = [[] for _ in people]
+        docs = []
+        item_collection = self.api.Item._get_collection()
+        for oid, (name, person, checked_out, updated) in zip(item_ids, items):
+            owned[person].append(oid)
+            docs.append({"_id": oid, "name": name,
+                        "checked_out": checked_out, "updated": updated})
+            if len(docs) == self.batch_size:
+                item_collection.insert(docs)
+                docs = []
+        if docs:
+            item_collection.insert(docs)
+        person_ids = [ObjectId() for _ in people]
+        self.api.Person._get_collection().insert(
+            [{"_id": oid, "firstname": first, "lastname": last,
+                "created": created, "items": owned[i],
+                "item_count": len(owned[i])}
+                for i, (oid, (first, last, created))
+                in enumerate(zip(person_ids, people))])
+        return [str(oid) for oid in person_ids], [str(oid) for oid in item_ids]
+
+
+class StdnetBackend(Backend):
+    name = 'stdnet'
+    batch_size = 10000
+
+    def setup(self):
+        # stdnet's client overrides redis-py's methods
+        from stdnet.backends.redisb.client import Redis, Pipeline
+        from sleepy import configure_app, api_stdnet as api
+        self.api = api
+        self.app = configure_app(self.name, self.settings())
+        self.reset()
+        self.count_calls(Redis, 'execute_command')
+        self.count_calls(Pipeline, 'execute')
+
+    def reset(self):
+        self.api.models.flush()
+        self.clear_cache()
+
+    def _save_all(self, instances):
+        for start in range(0, len(instances), self.batch_size):
+            with self.api.models.session().begin() as t:
+                for instance in instances[start:start + self.batch_size]:
+                    t.add(instance)
+        return instances
+
+    def seed(self, n_people, n_items, recent=None):
+        people, items = make_rows(n_people, n_items, recent)
+        counts = item_counts(people, items)
+        persons = self._save_all([self.api.Person(firstname=first,
+                                    lastname=last, created=created,
+                                    item_count=count)
+                                    for (first, last, created), count
+                                    in zip(people, counts)])
+        saved = self._save_all([self.api.Item(name=name,
+                                    person=persons[person],
+                                    checked_out=checked_out, updated=updated)
+                                for name, person, checked_out, updated in items])
+        return [p.id for p in persons], [i.id for i in saved]
+
+
+def get_backend(name, **config):
+    '''Return the adapter for ``name``, whose app will be created with
+    ``config`` on top of the adapter's own settings.
+    '''
+    for cls in Backend.__subclasses__():
+        if cls.name == name:
+            return cls(**config)
+    raise ValueError('Unknown backend: {0!r}'.format(name))
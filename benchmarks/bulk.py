@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare inserting items one request at a time with the bulk endpoint.
+
+Reports rows per second for ``POST /items/`` against ``POST /items/bulk``
+with batches of ``--batch`` rows.
+
+    $ python -m benchmarks.bulk --backends sqlalchemy,peewee --rows 10000
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from benchmarks.backends import BACKENDS, get_backend
+from benchmarks.workload import API_PREFIX, BenchmarkError
+
+
+def post_json(client, url, payload):
+    res = client.post(url, data=json.dumps(payload),
+                        content_type='application/json')
+    if res.status_code not in (200, 201):
+        raise BenchmarkError("POST {0} returned {1}".format(url, res.status_code))
+    return res
+
+
+def single_rows_per_sec(client, rows):
+    start = default_timer()
+    for row in rows:
+        post_json(client, API_PREFIX + "items/", row)
+    return len(rows) / (default_timer() - start)
+
+
+def bulk_rows_per_sec(client, rows, batch):
+    start = default_timer()
+    for i in range(0, len(rows), batch):
+        post_json(client, API_PREFIX + "items/bulk", rows[i:i + batch])
+    return len(rows) / (default_timer() - start)
+
+
+def bench_backend(name, n_rows, batch):
+    '''Return ``{"single": rows/sec, "bulk": rows/sec}`` for one backend.'''
+    backend = get_backend(name)
+    backend.setup()
+    try:
+        results = {}
+        for mode in ("single", "bulk"):
+            backend.reset()
+            person_ids, _ = backend.seed(10, 0)
+            rows = [{"name": "Item {0}".format(i), "checked_out": i % 2 == 0,
+                    "person_id": person_ids[i % len(person_ids)]}
+                    for i in range(n_rows)]
+            client = backend.client
+            if mode == "single":
+                results[mode] = single_rows_per_sec(client, rows)
+            else:
+                results[mode] = bulk_rows_per_sec(client, rows, batch)
+        backend.reset()
+    finally:
+        backend.teardown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            results = bench_backend(name, args.rows, args.batch)
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        print("{0:<12} single {1:10.1f} rows/s  bulk {2:10.1f} rows/s  "
+                "speedup {3:.1f}x".format(name, results["single"],
+                                        results["bulk"],
+                                        results["bulk"] / results["single"]))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
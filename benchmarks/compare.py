@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Diff two result files written by ``benchmarks.run``.
+
+    $ python -m benchmarks.compare before.json after.json --threshold 0.1
+
+Exits with status 1 if any endpoint's p95 latency or query count regressed
+by more than the threshold.
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'rps', 'queries_per_request')
+# Metrics where a bigger number is worse
+WATCHED = ('p95_ms', 'queries_per_request')
+
+
+def iter_stats(report):
+    for backend, by_rows in sorted(report["results"].items()):
+        if "skipped" in by_rows:
+            continue
+        for rows, endpoints in sorted(by_rows.items(), key=lambda x: int(x[0])):
+            for endpoint, stats in sorted(endpoints.items()):
+                yield (backend, rows, endpoint), stats
+
+
+def compare(old, new, threshold):
+    '''Return ``(key, metric, old_value, new_value, change)`` tuples for all
+    metrics present in both reports, and the subset that regressed.
+    '''
+    old_stats = dict(iter_stats(old))
+    rows, regressions = [], []
+    for key, stats in iter_stats(new):
+        if key not in old_stats:
+            continue
+        for metric in METRICS:
+            before, after = old_stats[key].get(metric), stats.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            row = (key, metric, before, after, change)
+            rows.append(row)
+            if metric in WATCHED and change > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative change counted as a regression.")
+    args = parser.parse_args(argv)
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+    rows, regressions = compare(old, new, args.threshold)
+    print("{0} -> {1}".format(old["meta"].get("commit"), new["meta"].get("commit")))
+    for (backend, n_rows, endpoint), metric, before, after, change in rows:
+        flag = " !" if metric in WATCHED and change > args.threshold else ""
+        print("{0:<12} {1:>8} {2:<24} {3:<20} {4:>10.2f} {5:>10.2f} {6:>+7.1%}{7}"
+                .format(backend, n_rows, endpoint, metric, before, after,
+                        change, flag))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare mixed read/write throughput with SQLite tuning and group commit.
+
+Runs ``--threads`` clients against each app for ``--seconds``. Each
+request is either a checkout (a PUT to an item) or the first page of the
+item listing, with ``--write-ratio`` of them writes. Each of ``--modes``
+runs the apps with different settings:
+
+- ``stock``: SQLite's own settings (rollback journal, full syncs).
+- ``tuned``: the ``SQLITE_TUNING`` pragmas (see ``sleepy/pragmas.py``).
+- ``group-commit``: tuned, with ``GROUP_COMMIT`` (see ``sleepy/batching.py``).
+
+Reports reads and writes per second, 95th percentile latencies and failed
+requests, which are mostly "database is locked" errors. The SQLite modes
+make no difference to Mongoengine and Stdnet.
+
+    $ python -m benchmarks.concurrency --threads 8 --seconds 10 --write-ratio 0.2
+    $ python -m benchmarks.concurrency --backends mongoengine --write-ratio 1
+'''
+from __future__ import print_function
+import argparse
+import json
+import random
+import sys
+import threading
+from timeit import default_timer
+
+from benchmarks.backends import get_backend
+from benchmarks.raw_rows import in_child
+from benchmarks.run import PEOPLE_RATIO
+from benchmarks.workload import API_PREFIX, percentile
+
+SQL_BACKENDS = "sqlalchemy,peewee,pony"
+
+# SQLite's defaults, set explicitly so that a database left in WAL mode by
+# an earlier run is switched back
+STOCK_PRAGMAS = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "mmap_size": 0,
+    "cache_size": -2000,
+    "busy_timeout": 5000,
+    "temp_store": "DEFAULT",
+}
+MODES = {
+    'stock': {"SQLITE_TUNING": True, "SQLITE_PRAGMAS": STOCK_PRAGMAS},
+    'tuned': {"SQLITE_TUNING": True},
+    'group-commit': {"SQLITE_TUNING": True, "GROUP_COMMIT": True},
+}
+
+
+def client_loop(app, person_ids, item_ids, write_ratio, deadline, seed,
+                results):
+    '''Issue requests until ``deadline``, appending ``(kind, seconds, ok)``
+    for each one to ``results``.
+    '''
+    rand = random.Random(seed)
+    client = app.test_client()
+    while default_timer() < deadline:
+        if rand.random() < write_ratio:
+            kind = 'write'
+            url = API_PREFIX + "items/{0}".format(rand.choice(item_ids))
+            payload = {"checked_out": True,
+                        "person_id": rand.choice(person_ids)}
+            kwargs = {"method": 'PUT', "data": json.dumps(payload),
+                        "content_type": "application/json"}
+        else:
+            kind = 'read'
+            url = API_PREFIX + "items/?limit=50"
+            kwargs = {"method": 'GET'}
+        start = default_timer()
+        try:
+            ok = client.open(url, **kwargs).status_code < 400
+        except Exception:
+            ok = False
+        results.append((kind, default_timer() - start, ok))
+
+
+def measure(name, config, n_items, n_threads, seconds, write_ratio):
+    '''Return the throughput of one backend with one set of settings.'''
+    backend = get_backend(name, **config)
+    backend.setup()
+    try:
+        person_ids, item_ids = backend.seed(
+            max(n_items // PEOPLE_RATIO, 1), n_items)
+        backend.clear_cache()
+        results = []
+        deadline = default_timer() + seconds
+        threads = [threading.Thread(target=client_loop,
+                    args=(backend.app, person_ids, item_ids, write_ratio,
+                            deadline, seed, results))
+                    for seed in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        backend.teardown()
+    stats = {"errors": sum(1 for _, _, ok in results if not ok)}
+    for kind in ('read', 'write'):
+        timings = sorted(elapsed for k, elapsed, ok in results
+                        if k == kind and ok)
+        stats[kind + "s_per_s"] = len(timings) / float(seconds)
+        stats[kind + "_p95_ms"] = (percentile(timings, 95) or 0) * 1e3
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=SQL_BACKENDS)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--modes", default="stock,tuned,group-commit")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for name in args.backends.split(","):
+        results = {}
+        for mode in args.modes.split(","):
+            config = MODES[mode]
+            try:
+                # A fresh process for each, so the app is created once
+                # with the mode's settings
+                stats = in_child(lambda: measure(name, config, args.rows,
+                                    args.threads, args.seconds,
+                                    args.write_ratio))
+            except Exception as error:
+                print("{0} {1}: skipped ({2!r})".format(name, mode, error))
+                continue
+            results[mode] = stats
+            print("{0:<12} {1:<12} reads {2:8.1f}/s  writes {3:8.1f}/s  "
+                    "p95 read {4:7.1f} ms  write {5:7.1f} ms  errors {6}".format(
+                    name, mode, stats['reads_per_s'], stats['writes_per_s'],
+                    stats['read_p95_ms'], stats['write_p95_ms'],
+                    stats['errors']))
+        if results:
+            report[name] = results
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Measure the JSON encoding step of a large item listing.
+
+Marshals ``--rows`` in-memory items into the ``{"items": [...]}`` payload
+``ItemsView.index`` returns, then encodes it with Flask's own ``jsonify``
+(indented, as Flask 0.10 does outside XMLHttpRequests) and with each
+``JSON_ENCODER`` that's installed. Reports each encoder's time and its
+share of marshalling plus encoding, i.e. of the request minus its queries.
+Fails if an encoder's output decodes to something else.
+
+With ``--backends``, also fetches ``GET /api/v1/items/?limit=<rows>`` from
+each app, seeded with ``--rows`` items, and reports each encoder's share
+of the whole request.
+
+    $ python -m benchmarks.encoding --rows 100000
+    $ python -m benchmarks.encoding --rows 100000 --backends sqlalchemy
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from flask import Flask, jsonify as flask_jsonify
+
+from benchmarks.backends import get_backend
+from benchmarks.raw_rows import in_child
+from benchmarks.run import PEOPLE_RATIO
+from benchmarks.serializers import make_objects
+from benchmarks.workload import API_PREFIX, BenchmarkError
+from sleepy.encoding import ENCODERS, jsonify, load_encoder
+from sleepy.serializers import ItemSerializer
+
+
+def available_encoders():
+    names = []
+    for name in ENCODERS:
+        try:
+            load_encoder(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def best_time(func, repeat):
+    '''Return ``(seconds, result)`` for the fastest of ``repeat`` calls.'''
+    best = result = None
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_payload(n_items, repeat):
+    '''Return the milliseconds to marshal and to encode the payload.'''
+    app = Flask(__name__)
+    app.config['SERIALIZER_ENGINE'] = "compiled"
+    items = make_objects(n_items)
+    report = {}
+    with app.test_request_context():
+        marshal, payload = best_time(
+            lambda: {"items": ItemSerializer(items, many=True).data}, repeat)
+        report['marshal_ms'] = marshal * 1e3
+        expected = json.loads(json.dumps(payload))
+        encoders = [('flask', lambda: flask_jsonify(payload))]
+        for name in available_encoders():
+            def encode(name=name):
+                app.config['JSON_ENCODER'] = name
+                return jsonify(payload)
+            encoders.append((name, encode))
+        for name, encode in encoders:
+            seconds, response = best_time(encode, repeat)
+            if json.loads(response.get_data()) != expected:
+                raise BenchmarkError("{0}'s output differs".format(name))
+            report[name] = {"encode_ms": seconds * 1e3,
+                            "share": seconds / (seconds + marshal),
+                            "bytes": len(response.get_data())}
+    return report
+
+
+def bench_app(name, n_items, repeat):
+    '''Return each encoder's share of fetching ``n_items`` items.'''
+    backend = get_backend(name, MAX_PAGE_SIZE=n_items)
+    backend.setup()
+    try:
+        backend.seed(max(n_items // PEOPLE_RATIO, 1), n_items)
+        client = backend.app.test_client()
+        url = API_PREFIX + "items/?limit={0}".format(n_items)
+        report = {}
+        for encoder in available_encoders():
+            backend.app.config['JSON_ENCODER'] = encoder
+            seconds, response = best_time(lambda: client.get(url), repeat)
+            payload = json.loads(response.get_data())
+            if len(payload['items']) != n_items:
+                raise BenchmarkError("Got {0} items".format(
+                                        len(payload['items'])))
+            encode = load_encoder(encoder)
+            encode_seconds, _ = best_time(lambda: encode(payload), repeat)
+            report[encoder] = {"request_ms": seconds * 1e3,
+                                "encode_ms": encode_seconds * 1e3,
+                                "share": encode_seconds / seconds}
+    finally:
+        backend.teardown()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backends", default="")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    payload = bench_payload(args.rows, args.repeat)
+    report = {"payload": payload}
+    print("marshal      {0:10.1f} ms".format(payload['marshal_ms']))
+    for name in ['flask'] + available_encoders():
+        stats = payload[name]
+        print("{0:<12} {1:10.1f} ms  {2:5.1f}% of marshal+encode  "
+                "{3} bytes".format(name, stats['encode_ms'],
+                                    stats['share'] * 100, stats['bytes']))
+    for name in filter(None, args.backends.split(",")):
+        try:
+            results = in_child(lambda: bench_app(name, args.rows,
+                                                args.repeat))
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        for encoder, stats in sorted(results.items()):
+            print("{0:<12} {1:<12} {2:10.1f} ms request  {3:8.1f} ms encode"
+                    "  {4:5.1f}%".format(name, encoder, stats['request_ms'],
+                                        stats['encode_ms'],
+                                        stats['share'] * 100))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare the threaded and gevent servers under many concurrent clients.
+
+Seeds each backend's scratch database, then starts one worker of
+``sleepy.server`` on it, first threaded (``--threads``) and then with
+``--gevent``. For each of the ``--concurrency`` levels, that many clients
+fetch a mix of item and people listings, detail pages and recent checkouts
+for ``--seconds``. Each request opens its own connection. Reports requests
+per second, p50/p99 latency and failed requests.
+
+    $ python -m benchmarks.event_loop --backends stdnet --concurrency 10,1000
+'''
+from __future__ import print_function
+from gevent import monkey
+monkey.patch_all()  # The clients are greenlets too
+
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from timeit import default_timer
+
+import gevent
+
+from benchmarks.backends import BACKENDS, get_backend
+from benchmarks.raw_rows import in_child
+from benchmarks.run import PEOPLE_RATIO
+from benchmarks.workload import API_PREFIX, percentile
+
+MODES = ('threaded', 'gevent')
+PATHS = ("items/?limit=50", "items/{item}", "people/?limit=50",
+        "people/{person}", "recentcheckouts/")
+
+
+def seed(name, n_items):
+    '''Load a backend's scratch database and return the settings that point
+    an app at it, with the ids that were inserted.
+    '''
+    backend = get_backend(name)
+    backend.setup()
+    try:
+        person_ids, item_ids = backend.seed(
+            max(n_items // PEOPLE_RATIO, 1), n_items)
+    finally:
+        backend.teardown()
+    return {"settings": backend.app_settings, "person_ids": person_ids,
+            "item_ids": item_ids}
+
+
+def write_settings(settings):
+    '''Write ``settings`` to a file for ``$SLEEPY_SETTINGS`` and return its
+    path.
+    '''
+    fd, path = tempfile.mkstemp(prefix="sleepy_bench_", suffix=".cfg")
+    with os.fdopen(fd, "w") as fp:
+        for key, value in sorted(settings.items()):
+            fp.write("{0} = {1!r}\n".format(key, value))
+    return path
+
+
+def start_server(name, mode, port, threads, settings_path):
+    '''Start one worker serving ``name`` and wait until it accepts
+    connections.
+    '''
+    command = [sys.executable, "-m", "sleepy.server", "--backend", name,
+                "--port", str(port), "--workers", "1", "--no-schema"]
+    if mode == 'gevent':
+        command.append("--gevent")
+    else:
+        command += ["--threads", str(threads)]
+    env = dict(os.environ, SLEEPY_SETTINGS=settings_path)
+    with open(os.devnull, "w") as devnull:
+        server = subprocess.Popen(command, env=env, stdout=devnull,
+                                    stderr=devnull)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited with {0}".format(
+                                server.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+def load(port, person_ids, item_ids, concurrency, seconds):
+    '''Run ``concurrency`` clients for ``seconds`` and return their
+    statistics.
+    '''
+    base = "http://127.0.0.1:{0}{1}".format(port, API_PREFIX)
+    timings, errors = [], []
+    deadline = default_timer() + seconds
+
+    def client(seed):
+        rand = random.Random(seed)
+        while default_timer() < deadline:
+            url = base + rand.choice(PATHS).format(
+                item=rand.choice(item_ids), person=rand.choice(person_ids))
+            start = default_timer()
+            try:
+                urllib2.urlopen(url, timeout=60).read()
+            except Exception as error:
+                errors.append(error)
+                continue
+            timings.append(default_timer() - start)
+
+    gevent.joinall([gevent.spawn(client, i) for i in range(concurrency)])
+    timings.sort()
+    return {"rps": len(timings) / float(seconds),
+            "p50_ms": (percentile(timings, 50) or 0) * 1e3,
+            "p99_ms": (percentile(timings, 99) or 0) * 1e3,
+            "errors": len(errors)}
+
+
+def raise_file_limit():
+    '''Allow this process as many open sockets as the system does.'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def bench_backend(name, args):
+    '''Return ``{mode: {concurrency: stats}}`` for one backend.'''
+    data = in_child(lambda: seed(name, args.rows))
+    settings_path = write_settings(data['settings'])
+    results = {}
+    try:
+        for mode in MODES:
+            server = start_server(name, mode, args.port, args.threads,
+                                    settings_path)
+            try:
+                results[mode] = dict(
+                    (concurrency, load(args.port, data['person_ids'],
+                                        data['item_ids'], concurrency,
+                                        args.seconds))
+                    for concurrency in args.concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        os.remove(settings_path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--concurrency", default="10,100,1000",
+                        type=lambda s: [int(n) for n in s.split(",")])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=16,
+                        help="Threads of the threaded server")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+    raise_file_limit()
+
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            results = bench_backend(name, args)
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        for mode in MODES:
+            for concurrency in args.concurrency:
+                stats = results[mode][concurrency]
+                print("{0:<12} {1:<8} {2:5d} clients  {3:8.1f} req/s  "
+                        "p50 {4:8.1f} ms  p99 {5:8.1f} ms  errors {6}".format(
+                        name, mode, concurrency, stats['rps'],
+                        stats['p50_ms'], stats['p99_ms'], stats['errors']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
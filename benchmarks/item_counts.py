@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare counting people's items on read with reading stored counts.
+
+Seeds each backend with ``--rows`` items, then fetches pages of
+``--limit`` people with ``n_items`` and adds items, first with
+``STORED_ITEM_COUNTS`` off and then on, and reports the milliseconds and
+queries per request of each. Fails if the two listings differ.
+
+    $ python -m benchmarks.item_counts --rows 100000 --limit 1000
+    $ python -m benchmarks.item_counts --backends sqlalchemy,mongoengine
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from benchmarks.backends import BACKENDS, get_backend
+from benchmarks.raw_rows import in_child
+from benchmarks.run import PEOPLE_RATIO
+from benchmarks.workload import API_PREFIX, BenchmarkError
+
+MODES = ('counted', 'stored')
+
+
+def timed_requests(backend, send, n_requests):
+    '''Return ``(ms, queries)`` per request and the last response of
+    ``n_requests`` calls to ``send(client, i)``.
+    '''
+    client = backend.client
+    backend.counter.reset()
+    start = default_timer()
+    for i in range(n_requests):
+        response = send(client, i)
+        if response.status_code >= 400:
+            raise BenchmarkError("Got a {0}".format(response.status_code))
+    elapsed = default_timer() - start
+    return (elapsed * 1e3 / n_requests,
+            backend.counter.count / float(n_requests), response)
+
+
+def bench_backend(name, n_items, limit, n_requests):
+    '''Return ``{mode: stats}`` for one backend.'''
+    backend = get_backend(name, MAX_PAGE_SIZE=limit)
+    backend.setup()
+    try:
+        backend.reset()
+        person_ids, _ = backend.seed(max(n_items // PEOPLE_RATIO, 1), n_items)
+        n_people = len(person_ids)
+        url = API_PREFIX + "people/?limit={0}".format(limit)
+        post = lambda client, i: client.post(
+                    API_PREFIX + "items/", content_type='application/json',
+                    data=json.dumps({"name": "Bench {0}".format(i),
+                                    "person_id": person_ids[i % n_people]}))
+        results = dict((mode, {}) for mode in MODES)
+        listings = {}
+        # Compare the two before the counted mode's posts leave the stored
+        # counts behind
+        for mode in MODES:
+            backend.app.config['STORED_ITEM_COUNTS'] = mode == 'stored'
+            ms, queries, response = timed_requests(
+                backend, lambda client, i: client.get(url), n_requests)
+            listings[mode] = [person['n_items'] for person in
+                                json.loads(response.get_data())['people']]
+            results[mode].update(list_ms=ms, list_queries=queries)
+        if listings['counted'] != listings['stored']:
+            raise BenchmarkError("The stored counts differ")
+        for mode in MODES:
+            backend.app.config['STORED_ITEM_COUNTS'] = mode == 'stored'
+            ms, queries, _ = timed_requests(backend, post, n_requests)
+            results[mode].update(post_ms=ms, post_queries=queries)
+        backend.app.config['STORED_ITEM_COUNTS'] = False
+        backend.reset()
+    finally:
+        backend.teardown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=1000,
+                        help="People per page")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            results = in_child(lambda: bench_backend(name, args.rows,
+                                                    args.limit, args.requests))
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        for mode in MODES:
+            stats = results[mode]
+            print("{0:<12} {1:<8} list {2:8.2f} ms {3:6.1f} queries  "
+                    "post {4:6.2f} ms {5:4.1f} queries".format(
+                    name, mode, stats['list_ms'], stats['list_queries'],
+                    stats['post_ms'], stats['post_queries']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Measure what recording requests for ``/metrics`` costs.
+
+First, without any app, ``--threads`` threads each record ``--requests``
+requests the way the apps' hooks do, while another thread scrapes the
+metrics every ``--scrape-interval`` seconds. Reports the microseconds each
+request spends recording, net of the same loop with recording left out.
+
+Then, for each of ``--backends``, the same threads fetch an item detail
+page through the test client, with ``request_metrics`` recording and with
+its methods replaced by no-ops, and report the difference per request.
+
+    $ python -m benchmarks.metrics_overhead --threads 8 --requests 100000
+    $ python -m benchmarks.metrics_overhead --backends sqlalchemy,peewee
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+import threading
+from timeit import default_timer
+
+from benchmarks.backends import get_backend
+from benchmarks.raw_rows import in_child
+from benchmarks.workload import API_PREFIX, BenchmarkError
+from sleepy.instrument import RequestQueries
+from sleepy.metrics import RequestMetrics
+
+ROUTES = ("/api/v1/items/", "/api/v1/items/<id>", "/api/v1/people/",
+            "/api/v1/people/<id>", "/api/v1/recentcheckouts/")
+
+
+def record_loop(metrics, n_requests, offset):
+    '''Record ``n_requests`` requests in ``metrics``, or just build what
+    they'd record if ``metrics`` is None.
+    '''
+    for i in range(n_requests):
+        queries = RequestQueries()
+        queries.add("SELECT 1", 0.0005)
+        route = ROUTES[(i + offset) % len(ROUTES)]
+        seconds = 0.001 * (i % 50)
+        if metrics is not None:
+            metrics.start()
+            metrics.finish("GET", route, 200, seconds, queries)
+
+
+def run_threads(n_threads, target, *args):
+    '''Return the seconds ``n_threads`` threads take to run ``target``.'''
+    threads = [threading.Thread(target=target, args=args + (i,))
+                for i in range(n_threads)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return default_timer() - start
+
+
+def measure_recording(n_threads, n_requests, scrape_interval):
+    '''Return the microseconds recording adds to each request.'''
+    metrics = RequestMetrics()
+    scrapes = []
+    done = threading.Event()
+
+    def scrape():
+        while not done.wait(scrape_interval):
+            start = default_timer()
+            metrics.render()
+            scrapes.append(default_timer() - start)
+
+    baseline = run_threads(n_threads, record_loop, None, n_requests)
+    scraper = threading.Thread(target=scrape)
+    scraper.start()
+    try:
+        recorded = run_threads(n_threads, record_loop, metrics, n_requests)
+    finally:
+        done.set()
+        scraper.join()
+    total = n_threads * n_requests
+    handled = sum(int(line.rsplit(" ", 1)[1])
+                    for line in metrics.render().splitlines()
+                    if line.startswith("sleepy_requests_total{"))
+    if handled != total:
+        raise BenchmarkError("Recorded {0} of {1} requests".format(handled,
+                                                                    total))
+    return {"us_per_request": (recorded - baseline) * 1e6 / total,
+            "scrapes": len(scrapes),
+            "scrape_ms_max": max(scrapes or [0]) * 1e3}
+
+
+def measure_app(name, n_threads, n_requests):
+    '''Return the microseconds per request of a backend's item detail page
+    with and without recording.
+    '''
+    backend = get_backend(name)
+    backend.setup()
+    try:
+        person_ids, item_ids = backend.seed(10, 100)
+        metrics = backend.api.request_metrics
+        url = API_PREFIX + "items/{0}".format(item_ids[0])
+
+        def fetch(offset):
+            client = backend.app.test_client()
+            for _ in range(n_requests):
+                client.get(url)
+
+        results = {}
+        for mode in ('off', 'on', 'off', 'on'):
+            if mode == 'off':
+                metrics.start = lambda: None
+                metrics.finish = lambda *args, **kwargs: None
+            else:
+                del metrics.start, metrics.finish
+            elapsed = run_threads(n_threads, fetch)
+            us = elapsed * 1e6 / (n_threads * n_requests)
+            # The faster of two runs, to damp the noise
+            results[mode] = min(results.get(mode, us), us)
+    finally:
+        backend.teardown()
+    return {"us_per_request_off": results['off'],
+            "us_per_request_on": results['on'],
+            "us_overhead": results['on'] - results['off']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100000,
+                        help="Requests recorded per thread")
+    parser.add_argument("--scrape-interval", type=float, default=0.1)
+    parser.add_argument("--backends", default="",
+                        help="Also measure these apps end to end")
+    parser.add_argument("--app-requests", type=int, default=1000,
+                        help="Requests per thread to each app")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {"recording": measure_recording(args.threads, args.requests,
+                                                args.scrape_interval)}
+    stats = report['recording']
+    print("recording    {0:6.2f} us/request  {1} scrapes, slowest "
+            "{2:.1f} ms".format(stats['us_per_request'], stats['scrapes'],
+                                stats['scrape_ms_max']))
+    for name in filter(None, args.backends.split(",")):
+        try:
+            stats = in_child(lambda: measure_app(name, args.threads,
+                                                args.app_requests))
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = stats
+        print("{0:<12} {1:6.2f} us/request  ({2:.1f} off, {3:.1f} on)".format(
+                name, stats['us_overhead'], stats['us_per_request_off'],
+                stats['us_per_request_on']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare the hydrated and raw-row read paths of the item listing.
+
+Loads every item through the same query the list endpoints use, first as
+model instances and then with ``RAW_ROWS = True``, and reports the time
+per row to load and to serialize them and the memory per loaded row. Each
+measurement runs in a forked process so that they start from the same
+heap; memory is the growth of the process's peak RSS.
+
+    $ python -m benchmarks.raw_rows --backends sqlalchemy,peewee --rows 100000
+'''
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+from timeit import default_timer
+
+from benchmarks.backends import get_backend
+from benchmarks.run import PEOPLE_RATIO
+
+RAW_ROW_BACKENDS = "sqlalchemy,peewee"
+MODES = ('hydrated', 'raw')
+
+
+def max_rss():
+    '''Return the peak resident set size of this process in bytes.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def in_child(func):
+    '''Return ``func()``, run in a forked process. The result must be JSON
+    serializable.
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        with os.fdopen(write_fd, 'w') as fp:
+            try:
+                json.dump(func(), fp)
+            except Exception as error:
+                json.dump({"error": repr(error)}, fp)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        result = json.load(fp)
+    os.waitpid(pid, 0)
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def measure(backend, mode):
+    '''Return per-row timings and memory for loading and serializing every
+    item with one read path.
+    '''
+    api = backend.api
+    app = backend.app
+    app.config['RAW_ROWS'] = mode == 'raw'
+    with app.test_request_context('/'):
+        query = api.select_items(None).order_by(api.Item.updated.desc())
+        gc.collect()
+        before = max_rss()
+        start = default_timer()
+        items = list(api.load_items(query, None))
+        loaded = default_timer()
+        memory = max_rss() - before
+        api.ItemSerializer(items, many=True).data
+        serialized = default_timer()
+    n = len(items)
+    return {"rows": n,
+            "load_us": (loaded - start) * 1e6 / n,
+            "serialize_us": (serialized - loaded) * 1e6 / n,
+            "bytes_per_row": memory / float(n)}
+
+
+def bench_backend(name, n_items):
+    '''Return ``{mode: stats}`` for one backend.'''
+    backend = get_backend(name)
+    backend.setup()
+    try:
+        backend.reset()
+        backend.seed(max(n_items // PEOPLE_RATIO, 1), n_items)
+        results = dict((mode, in_child(lambda: measure(backend, mode)))
+                        for mode in MODES)
+        backend.reset()
+    finally:
+        backend.teardown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=RAW_ROW_BACKENDS)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            results = bench_backend(name, args.rows)
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        for mode in MODES:
+            stats = results[mode]
+            print("{0:<12} {1:<9} load {2:7.1f} us/row  serialize {3:7.1f} "
+                    "us/row  {4:8.0f} bytes/row".format(
+                    name, mode, stats['load_us'], stats['serialize_us'],
+                    stats['bytes_per_row']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Measure RecentCheckoutsView as the item table grows.
+
+Every dataset has the same number of recent checkouts, so with the
+(checked_out, updated) index the endpoint's latency should stay flat
+instead of growing with the table.
+
+    $ python -m benchmarks.recent_checkouts --backends sqlalchemy,peewee
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+
+from benchmarks.backends import get_backend
+from benchmarks.run import PEOPLE_RATIO
+from benchmarks.workload import API_PREFIX, run_script
+
+ENDPOINT = 'recentcheckouts.index'
+INDEXED_BACKENDS = "sqlalchemy,peewee,pony,mongoengine"
+
+
+def bench_backend(name, rows, recent, n_requests):
+    '''Return ``{rows: stats}`` for one backend.'''
+    backend = get_backend(name)
+    script = [(ENDPOINT, 'GET', API_PREFIX + "recentcheckouts/", None)] * n_requests
+    results = {}
+    backend.setup()
+    try:
+        for n_items in rows:
+            backend.reset()
+            backend.seed(max(n_items // PEOPLE_RATIO, 1), n_items, recent=recent)
+            stats = run_script(backend.client, script, backend.counter)
+            results[str(n_items)] = stats[ENDPOINT]
+        backend.reset()
+    finally:
+        backend.teardown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=INDEXED_BACKENDS)
+    parser.add_argument("--rows", default="1000,100000,1000000")
+    parser.add_argument("--recent", type=int, default=50,
+                        help="Number of recent checkouts in every dataset.")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    rows = [int(n) for n in args.rows.split(",")]
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            results = bench_backend(name, rows, args.recent, args.requests)
+        except Exception as error:
+            print("{0}: skipped ({1!r})".format(name, error))
+            continue
+        report[name] = results
+        smallest, largest = results[str(rows[0])], results[str(rows[-1])]
+        for n_items in rows:
+            print("{0:<12} {1:>8} rows  p50 {2:8.2f} ms  p95 {3:8.2f} ms".format(
+                name, n_items, results[str(n_items)]['p50_ms'],
+                results[str(n_items)]['p95_ms']))
+        print("{0:<12} p50 growth from {1} to {2} rows: {3:.2f}x".format(
+            name, rows[0], rows[-1], largest['p50_ms'] / smallest['p50_ms']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
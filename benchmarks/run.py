@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Drive every backend through the same scripted workload and write the
+results as JSON.
+
+    $ python -m benchmarks.run --rows 1000,100000 --output before.json
+    $ python -m benchmarks.compare before.json after.json
+'''
+from __future__ import print_function
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.backends import BACKENDS, get_backend
+from benchmarks.workload import build_script, run_script
+
+DEFAULT_ROWS = "1000,100000,1000000"
+# Number of people per item in the seeded dataset
+PEOPLE_RATIO = 10
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_backend(name, rows, n_requests, seed):
+    '''Return ``{rows: {endpoint: stats}}`` for one backend.'''
+    backend = get_backend(name)
+    results = {}
+    backend.setup()
+    try:
+        for n_items in rows:
+            backend.reset()
+            n_people = max(n_items // PEOPLE_RATIO, 1)
+            start = time.time()
+            person_ids, item_ids = backend.seed(n_people, n_items)
+            print("  {0} rows seeded in {1:.1f}s".format(n_items,
+                                                        time.time() - start))
+            script = build_script(person_ids, item_ids, n_requests, seed=seed)
+            results[str(n_items)] = run_script(backend.client, script,
+                                                backend.counter)
+        backend.reset()
+    finally:
+        backend.teardown()
+    return results
+
+
+def print_table(name, results):
+    print("{0:<10} {1:<24} {2:>9} {3:>9} {4:>9} {5:>9} {6:>8}".format(
+        name, "endpoint", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries"))
+    for rows in sorted(results, key=int):
+        for endpoint, stats in sorted(results[rows].items()):
+            print("{0:<10} {1:<24} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.1f} "
+                    "{6:>8.1f}".format(rows, endpoint, stats['p50_ms'],
+                        stats['p95_ms'], stats['p99_ms'], stats['rps'],
+                        stats['queries_per_request']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="Comma-separated backends to run.")
+    parser.add_argument("--rows", default=DEFAULT_ROWS,
+                        help="Comma-separated item counts to seed.")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="Requests per endpoint for each dataset size.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    rows = [int(n) for n in args.rows.split(",")]
+    report = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rows": rows,
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    for name in args.backends.split(","):
+        print("Benchmarking {0}...".format(name))
+        try:
+            results = bench_backend(name, rows, args.requests, args.seed)
+        except Exception as error:
+            # Missing drivers or services only skip that backend
+            print("  skipped: {0!r}".format(error))
+            report["results"][name] = {"skipped": repr(error)}
+            continue
+        report["results"][name] = results
+        print_table(name, results)
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    print("Wrote {0}".format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compare marshmallow with the compiled serializer engine.
+
+Serializes ``--rows`` in-memory items (and their people) with
+``ItemSerializer(items, many=True)`` under each ``SERIALIZER_ENGINE`` and
+reports items per second. Fails if the two engines' JSON differs.
+
+    $ python -m benchmarks.serializers --rows 100000
+'''
+from __future__ import print_function
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from flask import Flask
+
+from benchmarks.backends import make_rows
+from benchmarks.workload import BenchmarkError
+from sleepy.serializers import ItemSerializer
+
+ENGINES = ('marshmallow', 'compiled')
+
+
+class Row(object):
+    '''A plain object standing in for a model instance.'''
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def make_objects(n_items):
+    person_rows, item_rows = make_rows(max(n_items // 10, 1), n_items)
+    people = [Row(id=i + 1, firstname=firstname, lastname=lastname,
+                    created=created, n_items=0)
+                for i, (firstname, lastname, created) in enumerate(person_rows)]
+    items = []
+    for i, (name, person, checked_out, updated) in enumerate(item_rows):
+        person = people[person]
+        person.n_items += 1
+        items.append(Row(id=i + 1, name=name, person=person,
+                        checked_out=checked_out, updated=updated))
+    return items
+
+
+def bench_engine(app, engine, items, repeat):
+    '''Return ``(items/sec, data)`` for the fastest of ``repeat`` runs.'''
+    app.config['SERIALIZER_ENGINE'] = engine
+    best = None
+    with app.app_context():
+        for _ in range(repeat):
+            start = default_timer()
+            data = ItemSerializer(items, many=True).data
+            elapsed = default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return len(items) / best, data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    app = Flask(__name__)
+    items = make_objects(args.rows)
+    report, dumped = {}, {}
+    for engine in ENGINES:
+        report[engine], data = bench_engine(app, engine, items, args.repeat)
+        dumped[engine] = json.dumps(data, sort_keys=True)
+        print("{0:<12} {1:12.1f} items/s".format(engine, report[engine]))
+    if dumped['marshmallow'] != dumped['compiled']:
+        raise BenchmarkError("The compiled engine's output differs")
+    print("speedup {0:.1f}x".format(report['compiled'] / report['marshmallow']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Measure the cold-start time of each backend's app.
+
+Each sample runs in a fresh interpreter and times what a server worker does
+on boot (import the backend and create its app) and what the test runner
+does when it collects a backend's test module. Reports the median of
+``--repeat`` samples in milliseconds. Also runs on checkouts without
+``configure_app``, to compare against.
+
+    $ python -m benchmarks.startup --backends sqlalchemy,pony --repeat 9
+'''
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+from benchmarks.backends import BACKENDS
+
+WORKER = '''
+import importlib, json, sys
+from timeit import default_timer
+backend = sys.argv[1]
+start = default_timer()
+api = importlib.import_module('sleepy.api_' + backend)
+imported = default_timer()
+try:
+    from sleepy import configure_app
+except ImportError:
+    pass
+else:
+    configure_app(backend, {"DEBUG": False})
+created = default_timer()
+print(json.dumps({"import_ms": (imported - start) * 1e3,
+                  "configure_app_ms": (created - imported) * 1e3}))
+'''
+
+TESTS = '''
+import importlib, json, sys
+from timeit import default_timer
+start = default_timer()
+importlib.import_module('tests.test_{0}_app'.format(sys.argv[1]))
+print(json.dumps({"tests_ms": (default_timer() - start) * 1e3}))
+'''
+
+
+def sample(code, backend):
+    '''Run ``code`` in a fresh interpreter and return the JSON it prints.'''
+    output = subprocess.check_output([sys.executable, '-c', code, backend],
+                                    stderr=subprocess.STDOUT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def bench_backend(backend, repeat):
+    '''Return the median of each timing for ``backend``.'''
+    samples = [dict(sample(WORKER, backend), **sample(TESTS, backend))
+                for _ in range(repeat)]
+    stats = dict((key, median([s[key] for s in samples]))
+                    for key in samples[0])
+    stats['boot_ms'] = stats['import_ms'] + stats['configure_app_ms']
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = {}
+    for name in args.backends.split(","):
+        try:
+            stats = bench_backend(name, args.repeat)
+        except subprocess.CalledProcessError as error:
+            print("{0}: skipped ({1})".format(
+                name, error.output.decode('utf-8').strip().splitlines()[-1]))
+            continue
+        report[name] = stats
+        print("{0:<12} import {1:8.1f} ms  configure_app {2:8.1f} ms  "
+                "worker boot {3:8.1f} ms  test module {4:8.1f} ms".format(
+                name, stats['import_ms'], stats['configure_app_ms'],
+                stats['boot_ms'], stats['tests_ms']))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''The scripted workload and the statistics reported for it.'''
+import json
+import math
+import random
+from collections import defaultdict
+from timeit import default_timer
+
+API_PREFIX = "/api/v1/"
+
+# (endpoint name, HTTP method, resource, takes an id)
+ENDPOINTS = (
+    ('items.index', 'GET', 'items', False),
+    ('items.get', 'GET', 'items', True),
+    ('items.put', 'PUT', 'items', True),
+    ('people.index', 'GET', 'people', False),
+    ('people.get', 'GET', 'people', True),
+    ('recentcheckouts.index', 'GET', 'recentcheckouts', False),
+)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def build_script(person_ids, item_ids, n_requests, seed=0):
+    '''Return the list of ``(endpoint, method, url, payload)`` requests to
+    issue. Ids are drawn by position from the seeded id lists, so every
+    backend receives the same sequence of requests for the same dataset.
+    '''
+    rand = random.Random(seed)
+    script = []
+    for _ in range(n_requests):
+        for endpoint, method, resource, takes_id in ENDPOINTS:
+            url = API_PREFIX + resource + "/"
+            payload = None
+            if takes_id:
+                ids = person_ids if resource == 'people' else item_ids
+                url += str(ids[rand.randrange(len(ids))])
+            if method == 'PUT':
+                person_id = person_ids[rand.randrange(len(person_ids))]
+                payload = {"checked_out": True, "person_id": person_id}
+            script.append((endpoint, method, url, payload))
+    return script
+
+
+def percentile(sorted_samples, percent):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not sorted_samples:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_samples)))
+    return sorted_samples[min(max(rank, 1), len(sorted_samples)) - 1]
+
+
+def summarize(samples, queries):
+    '''Return the per-endpoint statistics for raw latency samples (seconds)
+    and total query counts.
+    '''
+    stats = {}
+    for endpoint, timings in samples.items():
+        timings = sorted(timings)
+        total = sum(timings)
+        stats[endpoint] = {
+            "requests": len(timings),
+            "p50_ms": percentile(timings, 50) * 1000,
+            "p95_ms": percentile(timings, 95) * 1000,
+            "p99_ms": percentile(timings, 99) * 1000,
+            "rps": len(timings) / total if total else None,
+            "queries_per_request": float(queries[endpoint]) / len(timings),
+        }
+    return stats
+
+
+def run_script(client, script, counter):
+    '''Issue each request in ``script`` and return the summarized results.'''
+    samples = defaultdict(list)
+    queries = defaultdict(int)
+    for endpoint, method, url, payload in script:
+        kwargs = {}
+        if payload is not None:
+            kwargs = {"data": json.dumps(payload),
+                        "content_type": "application/json"}
+        counter.reset()
+        start = default_timer()
+        res = client.open(url, method=method, **kwargs)
+        elapsed = default_timer() - start
+        if res.status_code >= 400:
+            raise BenchmarkError("{0} {1} returned {2}".format(method, url,
+                                                            res.status_code))
+        samples[endpoint].append(elapsed)
+        queries[endpoint] += counter.count
+    return summarize(samples, queries)
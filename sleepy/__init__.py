@@ -0,0 +1,36 @@
+'''Python ORM/ODM examples, for the sleepy.
+
+``configure_app`` imports only the backend it's asked for, and each backend
+defers its mapping and connections until the app is created (or, where the
+driver allows, until the first query)::
+
+    from sleepy import configure_app
+    app = configure_app("peewee", {"DATABASE": {"name": "/tmp/inventory.db",
+                                            "engine": "peewee.SqliteDatabase"}})
+'''
+import importlib
+
+BACKENDS = ('sqlalchemy', 'peewee', 'pony', 'mongoengine', 'stdnet')
+
+
+def configure_app(backend, config=None):
+    '''Configure the app of ``backend``, set up its database and return it.
+
+    :param backend: One of ``BACKENDS``.
+    :param config: Optional settings to apply over the backend's
+        ``Settings``, as a dict or an object with uppercase attributes.
+
+    This isn't a factory: each backend module builds one app at import,
+    so the app is a per-process singleton and calling this again
+    reconfigures and returns that same app.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: {0!r}'.format(backend))
+    api = importlib.import_module('sleepy.api_' + backend)
+    app = api.app
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    api.init_db(app)
+    return app
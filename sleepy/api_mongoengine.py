@@ -1,13 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''Hello Mongoengine.'''
+import struct
 from datetime import datetime, timedelta
 
-from flask import Flask, jsonify, request, render_template, abort
-from flask.ext.classy import FlaskView
+from flask import Flask, request, render_template, abort
+from flask.ext.classy import FlaskView, route
 from flask.ext.mongoengine import MongoEngine
-from marshmallow import fields, Serializer
+from marshmallow import fields
 import mongoengine as mdb
+from mongoengine import connection
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.mongo_client import MongoClient
+
+from pagination import get_page_args, paginate
+from cache import ResourceCache
+from conditional import conditional
+from bulk import (get_bulk_rows, get_row_ids, row_error, row_result,
+                    bulk_results, bulk_response)
+from batching import (GroupCommit, group_commit_enabled, submit_row,
+                        row_response)
+from streaming import CHUNK_SIZE, is_streaming, chunked, stream_json
+from serializers import CompiledSerializer
+from projection import (ITEM_FIELDS, PERSON_FIELDS, ITEM_ATTRIBUTES,
+                        PERSON_ATTRIBUTES, get_fields, wants, get_attributes)
+from instrument import QueryStats, time_method, instrument
+from metrics import RequestMetrics, metrics_response
+from profiling import RequestProfiler
+from encoding import jsonify
+from counts import stored_item_counts
 
 
 class Settings:
@@ -15,19 +37,57 @@ class Settings:
         "DB": "inventory",
     }
     DEBUG = True
+    # See serializers.py
+    SERIALIZER_ENGINE = "marshmallow"
+    # See batching.py
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_TIMEOUT = 30
+    # See profiling.py
+    PROFILING = False
+    PROFILE_RATE = 0.0
+    # See encoding.py
+    JSON_ENCODER = "auto"
+    # See counts.py
+    STORED_ITEM_COUNTS = False
 
 app = Flask(__name__)
 app.config.from_object(Settings)
 
 ### Models ###
 
-db = MongoEngine(app)
+db = MongoEngine()
+
+# Wire protocol opcodes of the messages the client sends
+OPCODES = {2001: "update", 2002: "insert", 2004: "query", 2005: "getmore",
+            2006: "delete"}
+
+def describe_message(client, message, *args, **kwargs):
+    '''Describe a message sent by ``client``, e.g. "query inventory.item".
+    Every opcode the client sends has its collection name at offset 20.
+    '''
+    data = message[1]
+    opcode = struct.unpack("<i", data[12:16])[0]
+    collection = data[20:data.index(b"\0", 20)]
+    return "{0} {1}".format(OPCODES.get(opcode, opcode), collection)
+
+# pymongo 2.6 has no command monitoring, so time the client's round trips
+time_method(MongoClient, '_send_message', describe_message)
+time_method(MongoClient, '_send_message_with_response', describe_message)
 
 class Item(db.Document):
     name = mdb.StringField(max_length=100, required=True)
     checked_out = mdb.BooleanField(default=False)
     updated = mdb.DateTimeField(default=datetime.utcnow)
 
+    meta = {
+        "indexes": [
+            {"fields": ["-updated", "-id"]},
+            # Covers RecentCheckoutsView
+            {"fields": ["checked_out", "-updated"]},
+        ],
+    }
+
     def __repr__(self):
         return '<Item {0!r}>'.format(self.name)
 
@@ -38,6 +98,16 @@ class Person(db.Document):
     created = mdb.DateTimeField(default=datetime.utcnow)
     # Denormalize the items collection because there are no joins in MongoDB
     items = mdb.ListField(mdb.ReferenceField(Item))
+    # len(items), if the app stores it
+    item_count = mdb.IntField(default=0)
+
+    meta = {
+        "indexes": [
+            {"fields": ["-created", "-id"]},
+            # Multikey index for looking up an item's owner
+            "items",
+        ],
+    }
 
     def __repr__(self):
         return "<Person '{0} {1}'>".format(self.firstname, self.lastname)
@@ -46,47 +116,331 @@ def get_item_person(item):
     '''Get an item's parent person.'''
     return Person.objects(items__in=[item]).first()
 
+def get_item_people(item_ids):
+    '''Return a dict mapping item ids to their parent person, using a single
+    ``$in`` query over all the ids.
+    '''
+    item_ids = list(item_ids)
+    people = {}
+    if not item_ids:
+        return people
+    wanted = set(item_ids)
+    # Don't dereference each person's items; only their ids are needed
+    for person in Person.objects(items__in=item_ids).no_dereference():
+        for ref in person.items:
+            item_id = getattr(ref, 'id', ref)
+            if item_id in wanted:
+                people[item_id] = person
+    return people
+
+def keyset_filter(field, after):
+    '''Return a Q object matching documents that sort after the
+    ``(timestamp, id)`` cursor when ordered by ``-field, -id``.
+    '''
+    timestamp, id = after
+    try:
+        oid = ObjectId(id)
+    except (InvalidId, TypeError):
+        abort(400)
+    return (mdb.Q(**{field + "__lt": timestamp}) |
+            mdb.Q(**{field: timestamp, "id__lt": oid}))
+
+def collection_state(query, field):
+    '''Return ``(count, max(field))`` of the documents matching ``query``,
+    reading the max from the ``field`` index.
+    '''
+    latest = query.order_by("-" + field).only(field).first()
+    return (query.count(), latest[field] if latest else None)
+
+def items_state(query):
+    '''Return ``collection_state`` of the items matching ``query`` plus that
+    of people. Items embed their person, and deleting a person orphans their
+    items without updating them.
+    '''
+    return (collection_state(query, "updated") +
+            collection_state(Person.objects, "created"))
+
+def people_state():
+    '''Return the state of the people listing, which depends on items too
+    because of ``n_items``: the same as the items listing's.
+    '''
+    return items_state(Item.objects)
+
+def to_object_ids(ids):
+    '''Return a dict mapping each valid id string to its ObjectId.'''
+    oids = {}
+    for id in ids:
+        try:
+            oids[id] = ObjectId(id)
+        except (InvalidId, TypeError):
+            pass
+    return oids
+
+def existing_ids(document, oids):
+    '''Return the set of ``oids`` that exist, fetching only the ids.'''
+    if not oids:
+        return set()
+    return set(doc.id for doc in document.objects(id__in=list(oids)).only("id"))
+
 ### Custom Serializers ###
 
-class PersonDocSerializer(Serializer):
+class PersonDocSerializer(CompiledSerializer):
     id = fields.String()
     name = fields.Function(lambda p: "{0}, {1}".format(p['lastname'], p['firstname']))
     created = fields.DateTime()
-    n_items = fields.Function(lambda p: len(p['items']))
+    n_items = fields.Function(lambda p: p['item_count']
+                                if stored_item_counts() else len(p['items']))
 
-class ItemDocSerializer(Serializer):
+class ItemDocSerializer(CompiledSerializer):
     id = fields.String()
     person = fields.Method("get_person")
     class Meta:
         additional = ('name', 'checked_out', 'updated')
 
+    def __init__(self, *args, **kwargs):
+        # Optional mapping of item id -> person built by get_item_people, so
+        # that serializing many items doesn't query once per item
+        self.people = kwargs.pop('people', None)
+        super(ItemDocSerializer, self).__init__(*args, **kwargs)
+
     def get_person(self, item):
-        person = Person.objects(items__in=[item['id']]).first()
+        if self.people is None:
+            person = get_item_person(item['id'])
+        else:
+            person = self.people.get(item['id'])
+        if person is None:
+            return None
         return PersonDocSerializer(person._data).data
 
+# Items don't store their person, and a person's n_items is the length of
+# their list of items, or their stored count
+ITEM_DOC_FIELDS = dict(ITEM_ATTRIBUTES, person=())
+PERSON_DOC_FIELDS = dict(PERSON_ATTRIBUTES, n_items=('items',))
+STORED_COUNT_DOC_FIELDS = dict(PERSON_ATTRIBUTES, n_items=('item_count',))
+
+def person_doc_fields():
+    if stored_item_counts():
+        return STORED_COUNT_DOC_FIELDS
+    return PERSON_DOC_FIELDS
+
+def only_fields(query, fields, attributes, always):
+    '''Return ``query`` loading only the document fields ``fields`` need,
+    plus ``always``.
+    '''
+    names = get_attributes(fields, attributes, always=always)
+    return query if names is None else query.only(*names)
+
+def serialize_items(items, fields=None):
+    '''Serialize a list of items, resolving their people in one query if
+    they're asked for.
+    '''
+    # Serializer takes data dict for each item
+    item_data = [item._data for item in items]
+    people = get_item_people(item.id for item in items) \
+                if wants(fields, 'person') else {}
+    return ItemDocSerializer(item_data, many=True, people=people,
+                            only=fields).data
+
+def serialize_people(people, fields=None):
+    return PersonDocSerializer([p._data for p in people], many=True,
+                                only=fields).data
+
 ### API ###
 
+cache = ResourceCache("mongoengine")
+query_stats = QueryStats()
+request_metrics = RequestMetrics()
+instrument(app, query_stats, request_metrics)
+profiler = RequestProfiler(app, app.wsgi_app)
+app.wsgi_app = profiler
+
+def owned_item_ids(person_ids):
+    '''Return the ids of the items owned by any of ``person_ids``.'''
+    if not person_ids:
+        return []
+    people = Person.objects(id__in=list(person_ids)).only("items").no_dereference()
+    return [getattr(ref, 'id', ref) for person in people for ref in person.items]
+
+def count_update(n):
+    '''Return the update to a person's stored item count when ``n`` items
+    are added to their items list (or ``-n`` removed), to go in the same
+    update as the list's, so that both change at once.
+    '''
+    return {"inc__item_count": n} if n and stored_item_counts() else {}
+
+def remove_from_people(item_people):
+    '''Remove items from their people's items lists, given a dict mapping
+    item ids to people, with one update per person.
+    '''
+    removed = {}
+    for item_id, person in item_people.items():
+        removed.setdefault(person.id, []).append(item_id)
+    for person_oid, ids in removed.items():
+        Person.objects(id=person_oid).update_one(pull_all__items=ids,
+                                                **count_update(-len(ids)))
+
+def reconcile_item_counts():
+    '''Recount every person's items and fix their stored counts. Returns
+    the number of people whose count was wrong.
+    '''
+    repaired = 0
+    for person in Person.objects.only("items", "item_count").no_dereference():
+        if person.item_count != len(person.items):
+            Person.objects(id=person.id)\
+                    .update_one(set__item_count=len(person.items))
+            repaired += 1
+    return repaired
+
+def insert_items(rows):
+    '''Insert items with a single insert, then add them to their people's
+    items lists with one update per person. Returns the result of each row,
+    as the bulk endpoints do.
+    '''
+    person_oids = to_object_ids(row.get("person_id") for row in rows
+                                if isinstance(row, dict) and row.get("person_id"))
+    people = existing_ids(Person, person_oids.values())
+    results, owned, owners = [], {}, {}
+    for row in rows:
+        if not isinstance(row, dict) or not row.get("name"):
+            results.append(row_error(400, "Must specify name."))
+            continue
+        person_oid = None
+        if row.get("person_id"):
+            person_oid = person_oids.get(row["person_id"])
+            if person_oid not in people:
+                results.append(row_error(404, "Person not found."))
+                continue
+        # Assign ids up front so the insert doesn't need to reload them
+        item = Item(id=ObjectId(), name=row["name"],
+                    checked_out=row.get("checked_out", False))
+        results.append(item)
+        if person_oid:
+            owned.setdefault(person_oid, []).append(item)
+            owners[item.id] = person_oid
+    items = [r for r in results if isinstance(r, Item)]
+    if items:
+        Item.objects.insert(items, load_bulk=False)
+    for person_oid, person_items in owned.items():
+        Person.objects(id=person_oid).update_one(
+            push_all__items=person_items, **count_update(len(person_items)))
+    cache.invalidate("people", *owned.keys())
+    people = dict((p.id, p) for p in
+                Person.objects(id__in=list(owned)).no_dereference()) \
+                if owned else {}
+    item_people = dict((id, people[pid]) for id, pid in owners.items())
+    return bulk_results(results,
+                        lambda i: ItemDocSerializer(i._data,
+                                                    people=item_people).data,
+                        key="item", status=201)
+
+def update_items(rows):
+    '''Update items with one update per distinct new name and status (so
+    one for a burst of checkouts), moving the ones that change hands with
+    one update per person. Rows are applied in order, so an item in several
+    rows ends up as the last one left it. Returns the result of each row,
+    as the bulk endpoints do.
+    '''
+    item_oids = to_object_ids(get_row_ids(rows))
+    items = dict((item.id, item) for item in
+                Item.objects(id__in=list(item_oids.values()))) \
+                if item_oids else {}
+    item_people = get_item_people(items.keys())
+    person_oids = to_object_ids(row.get("person_id") for row in rows
+                                if isinstance(row, dict) and row.get("person_id"))
+    people = dict((p.id, p) for p in
+                Person.objects(id__in=list(person_oids.values())).no_dereference()) \
+                if person_oids else {}
+    old_people = dict(item_people)
+    results, written = [], {}
+    now = datetime.utcnow()
+    for row in rows:
+        item = items.get(item_oids.get(row.get("id"))) \
+                if isinstance(row, dict) else None
+        if item is None:
+            results.append(row_error(404, "Item not found."))
+            continue
+        item.name = row.get("name", item.name)
+        item.checked_out = row.get("checked_out", item.checked_out)
+        person = people.get(person_oids.get(row.get("person_id")))
+        if person:
+            item_people[item.id] = person
+        item.updated = now
+        # Serialized now, in case a later row updates the same item
+        results.append(row_result(ItemDocSerializer(item._data,
+                                                    people=item_people).data,
+                                    "item"))
+        written[item.id] = item
+    # Each item is written once, in the state its last row left it in
+    changed, pulled, pushed = {}, {}, {}
+    for item in written.values():
+        changed.setdefault((item.name, item.checked_out), []).append(item.id)
+        person, old_person = item_people.get(item.id), old_people.get(item.id)
+        if person != old_person:
+            if old_person:
+                pulled.setdefault(old_person.id, []).append(item.id)
+            pushed.setdefault(person.id, []).append(item.id)
+    for (name, checked_out), ids in changed.items():
+        Item.objects(id__in=ids).update(set__name=name,
+                                        set__checked_out=checked_out,
+                                        set__updated=now)
+    for person_oid, ids in pulled.items():
+        Person.objects(id=person_oid).update_one(pull_all__items=ids,
+                                                **count_update(-len(ids)))
+    for person_oid, ids in pushed.items():
+        Person.objects(id=person_oid).update_one(push_all__items=ids,
+                                                **count_update(len(ids)))
+    cache.invalidate("items", *items.keys())
+    cache.invalidate("people", *(list(pulled) + list(pushed)))
+    return bulk_results(results)
+
+# Used by post and put with GROUP_COMMIT on. A failed batch may have been
+# partly written, so it isn't retried row by row.
+item_inserts = GroupCommit(insert_items, retry=False)
+item_updates = GroupCommit(update_items, retry=False)
+
 class ItemsView(FlaskView):
     route_base = '/items/'
 
     def index(self):
-        '''Get all items.'''
-        all_items = Item.objects.order_by("-updated")
-        # Serializer takes data dict for each item
-        item_data = [item._data for item in all_items]
-        data = ItemDocSerializer(item_data, many=True).data
-        return jsonify({"items": data})
+        '''Get a page of items, most recently updated first.'''
+        state = items_state(Item.objects)
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(ITEM_FIELDS)
+        query = only_fields(Item.objects, fields, ITEM_DOC_FIELDS,
+                            always=('id', 'updated')).order_by("-updated", "-id")
+        if is_streaming():
+            cursor = query.batch_size(CHUNK_SIZE)
+            return stream_json("items", chunked(cursor),
+                                lambda items: serialize_items(items, fields))
+        if after:
+            query = query(keyset_filter("updated", after))
+        items, next_cursor = paginate(query[:limit + 1], limit,
+                                        key=lambda i: (i.updated, str(i.id)))
+        return jsonify({"items": serialize_items(items, fields),
+                        "next": next_cursor})
 
     def get(self, id):
         '''Get an item.'''
+        fields = get_fields(ITEM_FIELDS)
+        return cache.response("items", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
+        query = only_fields(Item.objects, fields, ITEM_DOC_FIELDS, always=('id',))
         try:
-            item = Item.objects.get_or_404(id=id)
+            item = query.get_or_404(id=id)
         except mdb.ValidationError:  # Invalid ID
             abort(404)
-        return jsonify(ItemDocSerializer(item._data).data)
+        return ItemDocSerializer(item._data, only=fields).data
 
     def post(self):
         '''Insert a new item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_inserts), "item",
+                                "Successfully added new item", status=201)
         data = request.json
         name = data.get("name", None)
         checked_out = data.get("checked_out", False)
@@ -100,57 +454,120 @@ class ItemsView(FlaskView):
             if not person:
                 abort(404)
             # Add item to person's items list
-            person.items.append(item)
-            person.save()
+            Person.objects(id=person.id).update_one(push__items=item,
+                                                    **count_update(1))
+            cache.invalidate("people", person.id)
         return jsonify({"message": "Successfully added new item",
                         "item": ItemDocSerializer(item._data).data}), 201
 
     def delete(self, id):
         '''Delete an item.'''
         item = Item.objects.get_or_404(id=id)
+        item_people = get_item_people([item.id])
         item.delete()
+        remove_from_people(item_people)
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", *[p.id for p in item_people.values()])
         return jsonify({"message": "Successfully deleted item.",
                         "id": str(item.id)}), 200
 
     def put(self, id):
         '''Update an item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_updates, id=id), "item",
+                                "Successfully updated item.")
         item = Item.objects.get_or_404(id=id)
         # Update item
         item.name = request.json.get("name", item.name)
         item.checked_out = request.json.get("checked_out", item.checked_out)
         if request.json.get("person_id"):
             person = Person.objects(id=str(request.json['person_id'])).first()
-            if person:
+            old_person = get_item_person(item)
+            if person and person != old_person:
                 # remove the item from its person's items list and add it to the
                 # new person's items list
-                old_person = get_item_person(item)
-                old_person.items.remove(item)
-                old_person.save()
-                person.items.append(item)
-            person.save()
+                if old_person:
+                    remove_from_people({item.id: old_person})
+                Person.objects(id=person.id).update_one(push__items=item,
+                                                        **count_update(1))
+                cache.invalidate("people", old_person and old_person.id,
+                                    person.id)
         item.updated = datetime.utcnow()
         item.save()
+        cache.invalidate("items", item.id)
         return jsonify({"message": "Successfully updated item.",
                         "item": ItemDocSerializer(item._data).data})
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many items with a single insert, then add them to their
+        people's items lists with one update per person.
+        '''
+        return jsonify({"results": insert_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['PUT'])
+    def bulk_put(self):
+        '''Update many items with as few updates as their changes allow,
+        moving the ones that change hands with one update per person.
+        '''
+        return jsonify({"results": update_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many items, given a list of ids, and remove them from
+        their people's items lists.
+        '''
+        ids = get_bulk_rows()
+        oids = to_object_ids(ids)
+        found = existing_ids(Item, oids.values())
+        item_people = get_item_people(found)
+        if found:
+            Item.objects(id__in=list(found)).delete()
+            remove_from_people(item_people)
+        cache.invalidate("items", *found)
+        cache.invalidate("people", *[p.id for p in item_people.values()])
+        return bulk_response([id if oids.get(id) in found else
+                                row_error(404, "Item not found.") for id in ids])
+
 
 class PeopleView(FlaskView):
     route_base = '/people/'
 
     def index(self):
-        '''Get all people, ordered by creation date.'''
-        all_people = Person.objects.order_by("-created")
-        people_data = [p._data for p in all_people]  # Data for serializer
-        data = PersonDocSerializer(people_data, many=True).data
-        return jsonify({"people": data})
+        '''Get a page of people, ordered by creation date.'''
+        state = people_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(PERSON_FIELDS)
+        query = only_fields(Person.objects, fields, person_doc_fields(),
+                            always=('id', 'created')).order_by("-created", "-id")
+        if is_streaming():
+            cursor = query.batch_size(CHUNK_SIZE)
+            return stream_json("people", chunked(cursor),
+                                lambda people: serialize_people(people, fields))
+        if after:
+            query = query(keyset_filter("created", after))
+        people, next_cursor = paginate(query[:limit + 1], limit,
+                                        key=lambda p: (p.created, str(p.id)))
+        return jsonify({"people": serialize_people(people, fields),
+                        "next": next_cursor})
 
     def get(self, id):
         '''Get a person.'''
+        fields = get_fields(PERSON_FIELDS)
+        return cache.response("people", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
+        query = only_fields(Person.objects, fields, person_doc_fields(),
+                            always=('id',))
         try:
-            person = Person.objects.get_or_404(id=str(id))
+            person = query.get_or_404(id=str(id))
         except mdb.ValidationError:  # Invalid ID
             abort(404)
-        return jsonify(PersonDocSerializer(person._data).data)
+        return PersonDocSerializer(person._data, only=fields).data
 
     def post(self):
         '''Insert a new person.'''
@@ -168,10 +585,46 @@ class PeopleView(FlaskView):
         '''Delete a person.'''
         person = Person.objects.get_or_404(id=id)
         pid = person.id
+        item_ids = owned_item_ids([pid])
         person.delete()
+        cache.invalidate("people", pid)
+        cache.invalidate("items", *item_ids)
         return jsonify({"message": "Successfully deleted person.",
                         "id": str(pid)}), 200
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many people with a single insert.'''
+        results = []
+        for row in get_bulk_rows():
+            if not isinstance(row, dict) or \
+                    not row.get("firstname") or not row.get("lastname"):
+                results.append(row_error(400, "Must specify both first and "
+                                                "last name."))
+                continue
+            results.append(Person(id=ObjectId(), firstname=row["firstname"],
+                                    lastname=row["lastname"]))
+        people = [r for r in results if isinstance(r, Person)]
+        if people:
+            Person.objects.insert(people, load_bulk=False)
+        return bulk_response(results,
+                            lambda p: PersonDocSerializer(p._data).data,
+                            key="person", status=201)
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many people, given a list of ids.'''
+        ids = get_bulk_rows()
+        oids = to_object_ids(ids)
+        found = existing_ids(Person, oids.values())
+        item_ids = owned_item_ids(found)
+        if found:
+            Person.objects(id__in=list(found)).delete()
+        cache.invalidate("people", *found)
+        cache.invalidate("items", *item_ids)
+        return bulk_response([id if oids.get(id) in found else
+                                row_error(404, "Person not found.") for id in ids])
+
 class RecentCheckoutsView(FlaskView):
     '''Demonstrates a more complex query.'''
 
@@ -180,25 +633,70 @@ class RecentCheckoutsView(FlaskView):
     def index(self):
         '''Return items checked out in the past hour.'''
         hour_ago  = datetime.utcnow() - timedelta(hours=1)
-        recent = Item.objects(checked_out=True, updated__gt=hour_ago)\
-                                .order_by("-updated")
-        recent_data = [i._data for i in recent]
-        serialized = ItemDocSerializer(recent_data, many=True)
-        return jsonify({"items": serialized.data})
+        state = items_state(Item.objects(checked_out=True,
+                                            updated__gt=hour_ago))
+        return conditional(lambda: self._index(hour_ago), state)
+
+    def _index(self, hour_ago):
+        fields = get_fields(ITEM_FIELDS)
+        recent = only_fields(Item.objects, fields, ITEM_DOC_FIELDS,
+                                always=('id', 'updated'))\
+                    .filter(checked_out=True, updated__gt=hour_ago)\
+                    .order_by("-updated")
+        if is_streaming():
+            cursor = recent.batch_size(CHUNK_SIZE)
+            return stream_json("items", chunked(cursor),
+                                lambda items: serialize_items(items, fields))
+        return jsonify({"items": serialize_items(recent, fields)})
 
 @app.route("/")
 def home():
     return render_template('index.html', orm="Mongoengine")
 
+@app.route("/api/v1/queries")
+def queries():
+    return jsonify(query_stats.as_dict())
+
+@app.route("/admin/profiles")
+def profiles():
+    return jsonify({"profiles": list(profiler.profiles)})
+
+def prometheus_metrics():
+    return metrics_response(request_metrics, cache=cache.stats())
+
 def drop_collections():
     Person.drop_collection()
     Item.drop_collection()
 
+# The MONGODB_SETTINGS the default connection was registered with
+_connected_for = None
+
+def init_db(app):
+    '''Register the default connection for the app's ``MONGODB_SETTINGS``.
+    Unlike ``MongoEngine(app)``, this doesn't connect: the client is created
+    the first time a document is read or saved.
+    '''
+    global _connected_for
+    settings = dict((key.lower(), value)
+                    for key, value in app.config['MONGODB_SETTINGS'].items())
+    if settings == _connected_for:
+        return
+    options = dict(settings)
+    connection.disconnect()
+    connection.register_connection(connection.DEFAULT_CONNECTION_NAME,
+                                    options.pop('db'), **options)
+    # Documents cache their collection from the previous connection
+    Item._collection = None
+    Person._collection = None
+    _connected_for = settings
+
 # Register views
 api_prefix = "/api/v1/"
 ItemsView.register(app, route_prefix=api_prefix)
 PeopleView.register(app, route_prefix=api_prefix)
 RecentCheckoutsView.register(app, route_prefix=api_prefix)
+app.add_url_rule("/metrics", view_func=prometheus_metrics)
 
 if __name__ == '__main__':
+    init_db(app)
     app.run(port=5000)
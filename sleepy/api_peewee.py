@@ -2,14 +2,35 @@
 # -*- coding: utf-8 -*-
 '''Hello Peewee.'''
 from datetime import datetime, timedelta
+from timeit import default_timer
 
-from flask import Flask, jsonify, request, render_template, abort
-from flask.ext.classy import FlaskView
+from flask import Flask, request, render_template, abort
+from flask.ext.classy import FlaskView, route
 from flask_peewee.db import Database
 from flask_peewee.utils import get_object_or_404
 import peewee as pw
 
 from serializers import ItemSerializer, PersonSerializer
+from pagination import get_page_args, paginate
+from cache import ResourceCache
+from conditional import conditional
+from bulk import (get_bulk_rows, get_row_ids, parse_id, parse_ids,
+                    parse_row_id, row_error, row_result, bulk_results,
+                    bulk_response)
+from batching import (GroupCommit, group_commit_enabled, submit_row,
+                        row_response)
+from streaming import is_streaming, chunked, stream_json
+from projection import (ITEM_FIELDS, PERSON_FIELDS, ITEM_ATTRIBUTES,
+                        PERSON_ATTRIBUTES, get_fields, wants, get_attributes)
+from rows import (PERSON_COLUMNS, raw_rows, item_columns, person_columns,
+                    item_rows, person_rows)
+from pools import ConnectionPool, PoolStats, pool_options
+from pragmas import sqlite_pragmas, cached_statements, apply_pragmas
+from instrument import QueryStats, record_query, instrument
+from metrics import RequestMetrics, metrics_response
+from profiling import RequestProfiler
+from encoding import jsonify
+from counts import stored_item_counts, count_changes, ADD_ITEM_COUNT_COLUMN
 
 
 class Settings:
@@ -18,13 +39,82 @@ class Settings:
         "engine": "peewee.SqliteDatabase"
     }
     DEBUG = True
+    # See serializers.py
+    SERIALIZER_ENGINE = "marshmallow"
+    # See batching.py
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_TIMEOUT = 30
+    # See profiling.py
+    PROFILING = False
+    PROFILE_RATE = 0.0
+    # See encoding.py
+    JSON_ENCODER = "auto"
+    # See counts.py
+    STORED_ITEM_COUNTS = False
+    # See pools.py
+    DB_POOL_SIZE = 5
+    DB_POOL_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 3600
+    DB_POOL_PRE_PING = False
+    # See pragmas.py
+    SQLITE_TUNING = False
 
 app = Flask(__name__)
 app.config.from_object(Settings)
 
 ### Models ###
 
-db = Database(app)
+pool_stats = PoolStats()
+
+class PooledMixin(object):
+    '''Makes a peewee database take its connections from ``pool`` (see
+    ``init_db``) instead of opening and closing one each time, run
+    ``pragmas`` on each connection it opens and time its queries.
+    '''
+    pool = None
+    pragmas = ()
+
+    def open_connection(self):
+        conn = super(PooledMixin, self)._connect(self.database,
+                                                **self.connect_kwargs)
+        apply_pragmas(conn, self.pragmas)
+        return conn
+
+    def _connect(self, database, **kwargs):
+        return self.pool.checkout()
+
+    def _close(self, conn):
+        self.pool.checkin(conn)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        start = default_timer()
+        try:
+            return super(PooledMixin, self).execute_sql(sql, params,
+                                                        require_commit)
+        finally:
+            record_query(sql, default_timer() - start)
+
+class PooledDatabase(Database):
+    '''flask_peewee's ``Database``, with a pooled, thread-local connection
+    that's checked out on a request's first query (rather than when every
+    request starts) and returned when the request ends.
+    '''
+
+    def load_database(self):
+        Database.load_database(self)
+        base = self.database_class
+        self.database_class = type('Pooled' + base.__name__,
+                                    (PooledMixin, base), {})
+        self.database_config.setdefault('threadlocals', True)
+        self.database = self.database_class(self.database_name,
+                                            **self.database_config)
+
+    def register_handlers(self):
+        self.app.teardown_request(self.close_db)
+
+db = PooledDatabase(app)
 
 class BaseModel(db.Model):
     def __marshallable__(self):
@@ -34,10 +124,13 @@ class BaseModel(db.Model):
 class Person(BaseModel):
     firstname = pw.CharField(max_length=80, null=False)
     lastname = pw.CharField(max_length=80, null=False)
-    created = pw.DateTimeField(default=datetime.utcnow)
+    created = pw.DateTimeField(default=datetime.utcnow, index=True)
+    item_count = pw.IntegerField(default=0)
 
     @property
     def n_items(self):
+        if stored_item_counts():
+            return self.item_count
         return self.items.count()
 
     def __repr__(self):
@@ -47,40 +140,344 @@ class Item(BaseModel):
     name = pw.CharField(max_length=100, null=False)
     person = pw.ForeignKeyField(Person, related_name="items", null=True)
     checked_out = pw.BooleanField(default=False)
-    updated = pw.DateTimeField(default=datetime.utcnow)
+    updated = pw.DateTimeField(default=datetime.utcnow, index=True)
+
+    class Meta:
+        # Covers RecentCheckoutsView
+        indexes = (
+            (('checked_out', 'updated'), False),
+        )
 
     def __repr__(self):
         return '<Item {0!r}>'.format(self.name)
 
 
+def count_items(people):
+    '''Return a dict mapping each person's id to their number of items,
+    using a single grouped query, or their stored counts.
+    '''
+    if stored_item_counts():
+        return dict((person.id, person.item_count) for person in people)
+    ids = [person.id for person in people]
+    if not ids:
+        return {}
+    counts = Item.select(Item.person, pw.fn.Count(Item.id))\
+                .where(Item.person << ids)\
+                .group_by(Item.person).tuples()
+    return dict(counts)
+
+# SQLite allows 999 parameters per statement
+INSERT_BATCH_SIZE = 200
+
+def insert_many(model, instances):
+    '''Insert unsaved ``instances`` of ``model`` and set their ids. (Peewee
+    2.1 has no ``insert_many``.)
+
+    On SQLite, each ``INSERT_BATCH_SIZE`` of them go in one multi-row
+    INSERT. SQLite gives its rows consecutive rowids, and reports the last
+    one. Other databases don't promise either (MySQL reports the first id,
+    and Postgres sequences can skip), so there each instance is inserted on
+    its own.
+    '''
+    meta = model._meta
+    database = meta.database
+    if not isinstance(database, pw.SqliteDatabase):
+        for obj in instances:
+            obj.save()
+        return
+    compiler = database.compiler()
+    fields = [field for field in meta.get_fields()
+                if field is not meta.primary_key]
+    columns = ', '.join(compiler.quote(field.db_column) for field in fields)
+    values = '({0})'.format(', '.join([database.interpolation] * len(fields)))
+    for start in range(0, len(instances), INSERT_BATCH_SIZE):
+        batch = instances[start:start + INSERT_BATCH_SIZE]
+        sql = 'INSERT INTO {0} ({1}) VALUES {2}'.format(
+                compiler.quote(meta.db_table), columns,
+                ', '.join([values] * len(batch)))
+        params = [field.db_value(obj._data.get(field.name))
+                    for obj in batch for field in fields]
+        cursor = database.execute_sql(sql, params)
+        last_id = database.last_insert_id(cursor, model)
+        for i, obj in enumerate(batch):
+            obj.id = last_id - len(batch) + 1 + i
+
+def adjust_item_counts(old_ids=(), new_ids=()):
+    '''Update the stored item counts of the people items left (``old_ids``)
+    and joined (``new_ids``). Call it in the items' transaction.
+    '''
+    if not stored_item_counts():
+        return
+    for delta, ids in count_changes(old_ids, new_ids).items():
+        Person.update(item_count=Person.item_count + delta)\
+                .where(Person.id << ids).execute()
+
+def add_item_count_column():
+    '''Add ``item_count`` to a person table created before it existed.
+    Returns whether it was missing.
+    '''
+    table = Person._meta.db_table
+    cursor = db.database.execute_sql("SELECT * FROM {0} LIMIT 0".format(table))
+    if 'item_count' in [column[0] for column in cursor.description]:
+        return False
+    db.database.execute_sql(ADD_ITEM_COUNT_COLUMN.format(table))
+    return True
+
+def reconcile_item_counts():
+    '''Recount every person's items and fix their stored counts, in one
+    statement. Returns the number of people whose count was wrong.
+    '''
+    add_item_count_column()
+    counted = "SELECT COUNT(*) FROM item WHERE item.person_id = person.id"
+    cursor = db.database.execute_sql(
+        "UPDATE person SET item_count = ({0}) WHERE item_count != ({0})"
+        .format(counted))
+    return cursor.rowcount
+
+
+def owners_state():
+    '''Return ``(count, max(created))`` of people. Items embed their
+    person, and deleting a person orphans their items without updating
+    them, so this is part of the items' state.
+    '''
+    return Person.select(pw.fn.Count(Person.id),
+                            pw.fn.Max(Person.created)).tuples().get()
+
+def items_state(*criteria):
+    '''Return ``(count, max(updated))`` of the items matching ``criteria``,
+    which changes whenever one of them is added, updated or deleted, plus
+    ``owners_state()``.
+    '''
+    query = Item.select(pw.fn.Count(Item.id), pw.fn.Max(Item.updated))
+    if criteria:
+        query = query.where(*criteria)
+    return query.tuples().get() + owners_state()
+
+def people_state():
+    '''Return the state of the people listing, which depends on items too
+    because of ``n_items``: the same as the items listing's.
+    '''
+    return items_state()
+
+
+def get_people(ids):
+    '''Return a dict mapping ids to people, loaded in one query.'''
+    ids = set(parse_ids(ids))
+    if not ids:
+        return {}
+    return dict((p.id, p) for p in Person.select().where(Person.id << list(ids)))
+
+
+def columns(model, names):
+    '''Return the selection for the ``names`` columns of ``model``, or the
+    whole model if ``names`` is ``None``.
+    '''
+    if names is None:
+        return [model]
+    return [getattr(model, name) for name in names]
+
+def item_query(fields):
+    '''Return a query for the columns ``fields`` need, plus the ones the
+    cursor is made of, that selects each item's person in the same query
+    only if it's asked for.
+    '''
+    selection = columns(Item, get_attributes(fields, ITEM_ATTRIBUTES,
+                                            always=('id', 'updated')))
+    if not wants(fields, 'person'):
+        return Item.select(*selection)
+    return Item.select(*(selection + [Person]))\
+                .join(Person, pw.JOIN_LEFT_OUTER)
+
+def drop_empty_people(items):
+    '''Yield ``items``, without the person peewee builds from the NULL
+    columns of the outer join for an item that doesn't have one.
+    '''
+    for item in items:
+        person = item._obj_cache.get('person')
+        if person is not None and person.id is None:
+            del item._obj_cache['person']
+        yield item
+
+def person_query(fields):
+    '''Return a query for the columns ``fields`` need.'''
+    return Person.select(*columns(Person, get_attributes(
+                            fields, PERSON_ATTRIBUTES, always=('id', 'created'))))
+
+def select_items(fields):
+    '''Return a query for the items of a listing of ``fields``. If the app
+    reads raw rows, it selects just the columns that ``load_items`` expects.
+    '''
+    if not raw_rows():
+        return item_query(fields)
+    selection = [getattr(Item, name) for name in item_columns(fields)]
+    if not wants(fields, 'person'):
+        return Item.select(*selection)
+    selection.extend(getattr(Person, name) for name in PERSON_COLUMNS)
+    return Item.select(*selection).join(Person, pw.JOIN_LEFT_OUTER)
+
+def load_items(query, fields, stream=False):
+    '''Run a ``select_items`` query. If the app reads raw rows, return
+    ``ItemRow`` records built from tuples instead of instances. With
+    ``stream``, rows aren't cached on the query.
+    '''
+    if not raw_rows():
+        return drop_empty_people(query.iterator() if stream else query)
+    return item_rows(query.tuples().iterator(), item_columns(fields),
+                        wants(fields, 'person'))
+
+def select_people(fields):
+    '''Return a query for the people of a listing of ``fields``.'''
+    if not raw_rows():
+        return person_query(fields)
+    return Person.select(*[getattr(Person, name)
+                            for name in person_columns(fields)])
+
+def load_people(query, fields, stream=False):
+    '''Run a ``select_people`` query, as ``PersonRow`` records if the app
+    reads raw rows.
+    '''
+    if not raw_rows():
+        return query.iterator() if stream else query
+    return person_rows(query.tuples().iterator(), person_columns(fields))
+
 ### API ###
 
+cache = ResourceCache("peewee")
+query_stats = QueryStats()
+request_metrics = RequestMetrics()
+instrument(app, query_stats, request_metrics)
+profiler = RequestProfiler(app, app.wsgi_app)
+app.wsgi_app = profiler
+
+def insert_items(rows):
+    '''Insert items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    people = get_people(row.get("person_id") for row in rows
+                        if isinstance(row, dict))
+    results = []
+    for row in rows:
+        if not isinstance(row, dict) or not row.get("name"):
+            results.append(row_error(400, "Must specify name."))
+            continue
+        try:
+            pid = parse_id(row.get("person_id"))
+        except ValueError:
+            results.append(row_error(400, "Invalid person_id."))
+            continue
+        results.append(Item(name=row["name"], person=people.get(pid),
+                            checked_out=row.get("checked_out", False)))
+    with db.database.transaction():
+        insert_many(Item, [r for r in results if isinstance(r, Item)])
+        adjust_item_counts(new_ids=[r._data.get("person") for r in results
+                                    if isinstance(r, Item)])
+    cache.invalidate("people", *[r._data.get("person") for r in results
+                                if isinstance(r, Item)])
+    return bulk_results(results, lambda i: ItemSerializer(i).data,
+                        key="item", status=201)
+
+def update_items(rows):
+    '''Update items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    ids = parse_ids(get_row_ids(rows))
+    items = dict((item.id, item) for item in
+                Item.select().where(Item.id << ids)) if ids else {}
+    people = get_people(row.get("person_id") for row in rows
+                        if isinstance(row, dict))
+    old_person_ids = [item._data.get("person") for item in items.values()]
+    results = []
+    now = datetime.utcnow()
+    with db.database.transaction():
+        for row in rows:
+            item = items.get(parse_row_id(row))
+            if item is None:
+                results.append(row_error(404, "Item not found."))
+                continue
+            try:
+                pid = parse_id(row.get("person_id"))
+            except ValueError:
+                results.append(row_error(400, "Invalid person_id."))
+                continue
+            item.name = row.get("name", item.name)
+            item.checked_out = row.get("checked_out", item.checked_out)
+            if pid:
+                item.person = people.get(pid) or item.person
+            else:
+                item.person = None
+            item.updated = now
+            item.save()
+            # Serialized now, in case a later row updates the same item
+            results.append(row_result(ItemSerializer(item).data, "item"))
+        adjust_item_counts(old_person_ids, [item._data.get("person")
+                                            for item in items.values()])
+    cache.invalidate("items", *items.keys())
+    cache.invalidate("people", *(old_person_ids + [item._data.get("person")
+                                                for item in items.values()]))
+    return bulk_results(results)
+
+# Used by post and put with GROUP_COMMIT on. A failed transaction is
+# rolled back by transaction().
+item_inserts = GroupCommit(insert_items)
+item_updates = GroupCommit(update_items)
+
 class ItemsView(FlaskView):
     route_base = '/items/'
 
     def index(self):
-        '''Get all items.'''
-        all_items = Item.select().order_by(Item.updated.desc())
-        data = ItemSerializer(all_items, many=True).data
-        return jsonify({"items": data})
+        '''Get a page of items, most recently updated first.'''
+        state = items_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(ITEM_FIELDS)
+        query = select_items(fields).order_by(Item.updated.desc(),
+                                                Item.id.desc())
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            # iterator() doesn't cache the rows on the query
+            rows = load_items(query, fields, stream=True)
+            return stream_json("items", chunked(rows), serialize)
+        if after:
+            # Keyset pagination: (updated, id) < (after_updated, after_id)
+            updated, id = after
+            query = query.where((Item.updated < updated) |
+                                ((Item.updated == updated) & (Item.id < id)))
+        items, next_cursor = paginate(load_items(query.limit(limit + 1), fields),
+                                        limit, key=lambda i: (i.updated, i.id))
+        return jsonify({"items": serialize(items), "next": next_cursor})
 
     def get(self, id):
         '''Get an item.'''
+        fields = get_fields(ITEM_FIELDS)
+        return cache.response("items", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
         # Could also use flask_peewee.utils.get_object_or_404
         try:
-            item = Item.get(Item.id == id)
+            item = item_query(fields).where(Item.id == id).get()
         except Item.DoesNotExist:
             abort(404)
-        return jsonify(ItemSerializer(item).data)
+        item, = drop_empty_people([item])
+        return ItemSerializer(item, only=fields).data
 
     def post(self):
         '''Insert a new item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_inserts), "item",
+                                "Successfully added new item", status=201)
         data = request.json
         name = data.get("name", None)
         checked_out = data.get('checked_out', False)
         if not name:
             abort(400)  # Must specify name
-        person_id = data.get("person_id")
+        try:
+            person_id = parse_id(data.get("person_id"))
+        except ValueError:
+            abort(400)
         if person_id:
             try:
                 person = Person.get(Person.id == person_id)
@@ -88,50 +485,121 @@ class ItemsView(FlaskView):
                 person = None
         else:
             person = None
-        item = Item.create(name=name, person=person, checked_out=checked_out)
+        with db.database.transaction():
+            item = Item.create(name=name, person=person,
+                                checked_out=checked_out)
+            adjust_item_counts(new_ids=[person and person.id])
+        cache.invalidate("people", person and person.id)
         return jsonify({"message": "Successfully added new item",
                         "item": ItemSerializer(item).data}), 201
 
     def delete(self, id):
         '''Delete an item.'''
         item = get_object_or_404(Item, Item.id == id)
-        item.delete_instance()
+        with db.database.transaction():
+            item.delete_instance()
+            adjust_item_counts(old_ids=[item._data.get("person")])
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", item._data.get("person"))
         return jsonify({"message": "Successfully deleted item.",
                         "id": item.id}), 200
 
     def put(self, id):
         '''Update an item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_updates, id=int(id)), "item",
+                                "Successfully updated item.")
         item = get_object_or_404(Item, Item.id == id)
+        old_person_id = item._data.get("person")
+        try:
+            person_id = parse_id(request.json.get("person_id"))
+        except ValueError:
+            abort(400)
         # Update item
         item.name = request.json.get("name", item.name)
         item.checked_out = request.json.get("checked_out", item.checked_out)
-        if request.json.get("person_id"):
-            person = Person.get(Person.id == int(request.json['person_id']))
+        if person_id:
+            person = Person.get(Person.id == person_id)
             item.person = person or item.person
         else:
             item.person = None
         item.updated = datetime.utcnow()
-        item.save()
+        with db.database.transaction():
+            item.save()
+            adjust_item_counts([old_person_id], [item._data.get("person")])
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", old_person_id, item._data.get("person"))
         return jsonify({"message": "Successfully updated item.",
                         "item": ItemSerializer(item).data})
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many items in a single transaction.'''
+        return jsonify({"results": insert_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['PUT'])
+    def bulk_put(self):
+        '''Update many items in a single transaction.'''
+        return jsonify({"results": update_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many items, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        owners = dict(Item.select(Item.id, Item.person)
+                            .where(Item.id << ids).tuples()) if ids else {}
+        found = set(owners)
+        if found:
+            with db.database.transaction():
+                Item.delete().where(Item.id << list(found)).execute()
+                adjust_item_counts(old_ids=owners.values())
+        cache.invalidate("items", *found)
+        cache.invalidate("people", *owners.values())
+        return bulk_response([id if id in found else
+                                row_error(404, "Item not found.") for id in ids])
+
 class PeopleView(FlaskView):
     route_base = '/people/'
 
     def index(self):
-        '''Get all people, ordered by creation date.'''
-        all_items = Person.select().order_by(Person.created.desc())
-        data = PersonSerializer(all_items, exclude=('created',), many=True).data
-        return jsonify({"people": data})
+        '''Get a page of people, ordered by creation date.'''
+        state = people_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(PERSON_FIELDS)
+        query = select_people(fields).order_by(Person.created.desc(),
+                                                Person.id.desc())
+        # ``only`` takes precedence over ``exclude``
+        serialize = lambda people: PersonSerializer(people, many=True,
+                        only=fields, exclude=('created',),
+                        item_counts=count_items(people)
+                                    if wants(fields, 'n_items') else None).data
+        if is_streaming():
+            rows = load_people(query, fields, stream=True)
+            return stream_json("people", chunked(rows), serialize)
+        if after:
+            created, id = after
+            query = query.where((Person.created < created) |
+                                ((Person.created == created) & (Person.id < id)))
+        people, next_cursor = paginate(load_people(query.limit(limit + 1), fields),
+                                        limit, key=lambda p: (p.created, p.id))
+        return jsonify({"people": serialize(people), "next": next_cursor})
 
     def get(self, id):
         '''Get a person.'''
+        fields = get_fields(PERSON_FIELDS)
+        return cache.response("people", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
         # Could also use flask_peewee.utils.get_object_or_404
         try:
-            person = Person.get(Person.id == int(id))
+            person = person_query(fields).where(Person.id == int(id)).get()
         except Person.DoesNotExist:
             abort(404)
-        return jsonify(PersonSerializer(person).data)
+        return PersonSerializer(person, only=fields).data
 
     def post(self):
         '''Insert a new person.'''
@@ -149,10 +617,50 @@ class PeopleView(FlaskView):
         '''Delete a person.'''
         person = get_object_or_404(Person, Person.id == int(id))
         pid = person.id
+        item_ids = [item.id for item in person.items]
         person.delete_instance()
+        cache.invalidate("people", pid)
+        cache.invalidate("items", *item_ids)
         return jsonify({"message": "Successfully deleted person.",
                         "id": pid}), 200
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many people in a single transaction.'''
+        results = []
+        with db.database.transaction():
+            for row in get_bulk_rows():
+                if not isinstance(row, dict) or \
+                        not row.get("firstname") or not row.get("lastname"):
+                    results.append(row_error(400, "Must specify both first "
+                                                    "and last name."))
+                    continue
+                results.append(Person.create(firstname=row["firstname"],
+                                            lastname=row["lastname"]))
+        return bulk_response(results,
+                            lambda p: PersonSerializer(p, item_counts={}).data,
+                            key="person", status=201)
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many people, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        found = set(id for (id,) in Person.select(Person.id)
+                                        .where(Person.id << ids).tuples()) \
+                if ids else set()
+        item_ids = [id for (id,) in Item.select(Item.id)
+                        .where(Item.person << list(found)).tuples()] \
+                    if found else []
+        if found:
+            with db.database.transaction():
+                Item.update(person=None)\
+                    .where(Item.person << list(found)).execute()
+                Person.delete().where(Person.id << list(found)).execute()
+        cache.invalidate("people", *found)
+        cache.invalidate("items", *item_ids)
+        return bulk_response([id if id in found else
+                                row_error(404, "Person not found.") for id in ids])
+
 class RecentCheckoutsView(FlaskView):
     '''Demonstrates a more complex query.'''
 
@@ -161,30 +669,92 @@ class RecentCheckoutsView(FlaskView):
     def index(self):
         '''Return items checked out in the past hour.'''
         hour_ago  = datetime.utcnow() - timedelta(hours=1)
-        query = Item.select().where(Item.checked_out &
-                                    (Item.updated > hour_ago)) \
-                                    .order_by(Item.updated.desc())
-        recent = [item for item in query]  # Executes query
-        return jsonify({"items": ItemSerializer(recent, many=True).data})
+        state = items_state(Item.checked_out & (Item.updated > hour_ago))
+        return conditional(lambda: self._index(hour_ago), state)
+
+    def _index(self, hour_ago):
+        fields = get_fields(ITEM_FIELDS)
+        query = select_items(fields)\
+                    .where(Item.checked_out & (Item.updated > hour_ago)) \
+                    .order_by(Item.updated.desc())
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            rows = load_items(query, fields, stream=True)
+            return stream_json("items", chunked(rows), serialize)
+        recent = list(load_items(query, fields))  # Executes query
+        return jsonify({"items": serialize(recent)})
 
 @app.route("/")
 def home():
     return render_template('index.html', orm="Peewee")
 
+@app.route("/api/v1/pool")
+def pool():
+    return jsonify(pool_stats.as_dict())
+
+@app.route("/api/v1/queries")
+def queries():
+    return jsonify(query_stats.as_dict())
+
+@app.route("/admin/profiles")
+def profiles():
+    return jsonify({"profiles": list(profiler.profiles)})
+
+def prometheus_metrics():
+    return metrics_response(request_metrics, cache=cache.stats(),
+                            pool=pool_stats.as_dict())
+
 def create_tables():
     Person.create_table(True)
     Item.create_table(True)
+    add_item_count_column()
 
 def drop_tables():
     Person.drop_table(True)
     Item.drop_table(True)
 
+# The database name, connect arguments and pool options in use
+_connected_for = None
+
+def init_db(app):
+    '''Point the database and its pool at the app's ``DATABASE``,
+    ``DB_POOL_*`` and ``SQLITE_*`` settings, which may have changed since the
+    module was imported. Nothing is connected to until the first query.
+    '''
+    global _connected_for
+    database = db.database
+    config = dict(app.config['DATABASE'])
+    name = config.pop('name')
+    for key in ('engine', 'threadlocals'):
+        config.pop(key, None)
+    pragmas = ()
+    if isinstance(database, pw.SqliteDatabase):
+        # Pooled connections move between threads, one at a time
+        config.setdefault('check_same_thread', False)
+        config.setdefault('cached_statements', cached_statements(app.config))
+        pragmas = sqlite_pragmas(app.config)
+    options = pool_options(app.config)
+    if (name, config, options, pragmas) == _connected_for:
+        return
+    if not database.is_closed():
+        database.close()
+    if database.pool is not None:
+        database.pool.dispose()
+    database.init(name, **config)
+    database.pragmas = pragmas
+    database.pool = ConnectionPool(database.open_connection, stats=pool_stats,
+                                    **options)
+    _connected_for = (name, config, options, pragmas)
+
 # Register views
 api_prefix = "/api/v1/"
 ItemsView.register(app, route_prefix=api_prefix)
 PeopleView.register(app, route_prefix=api_prefix)
 RecentCheckoutsView.register(app, route_prefix=api_prefix)
+app.add_url_rule("/metrics", view_func=prometheus_metrics)
 
 if __name__ == '__main__':
+    init_db(app)
     create_tables()
     app.run(port=5000)
@@ -1,37 +1,130 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''Hello Pony.'''
+import time
 from datetime import datetime, timedelta
+from timeit import default_timer
 
-from flask import Flask, jsonify, request, render_template, abort
-from flask.ext.classy import FlaskView
+from flask import Flask, request, render_template, abort
+from flask.ext.classy import FlaskView, route
 from pony import orm
+from pony.orm.dbproviders.sqlite import SQLiteProvider
 
 from serializers import ItemSerializer, PersonSerializer
+from pagination import get_page_args, paginate
+from cache import ResourceCache
+from conditional import conditional
+from bulk import (get_bulk_rows, get_row_ids, parse_id, parse_ids,
+                    parse_row_id, row_error, row_result, bulk_results,
+                    bulk_response)
+from batching import (GroupCommit, group_commit_enabled, submit_row,
+                        row_response)
+from streaming import CHUNK_SIZE, is_streaming, stream_json
+from projection import ITEM_FIELDS, PERSON_FIELDS, get_fields, wants
+from pools import PoolStats, pool_options, ping
+from pragmas import sqlite_pragmas, apply_pragmas
+from instrument import QueryStats, record_query, instrument
+from metrics import RequestMetrics, metrics_response
+from profiling import RequestProfiler
+from encoding import jsonify
+from counts import stored_item_counts, count_changes, ADD_ITEM_COUNT_COLUMN
 
 
 class Settings:
     DB_PROVIDER = "sqlite"
     DB_NAME = "inventory.db"
     DEBUG = True
+    # See serializers.py
+    SERIALIZER_ENGINE = "marshmallow"
+    # See batching.py
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_TIMEOUT = 30
+    # See profiling.py
+    PROFILING = False
+    PROFILE_RATE = 0.0
+    # See encoding.py
+    JSON_ENCODER = "auto"
+    # See counts.py
+    STORED_ITEM_COUNTS = False
+    # See pools.py. Pony keeps a connection per thread, so these are the
+    # only pool settings that apply.
+    DB_POOL_RECYCLE = 3600
+    DB_POOL_PRE_PING = False
+    # See pragmas.py. Pony opens its own connections, so
+    # SQLITE_CACHED_STATEMENTS doesn't apply.
+    SQLITE_TUNING = False
 
 app = Flask(__name__)
 app.config.from_object(Settings)
 
 ### Models ###
 
-db = orm.Database('sqlite', 'inventory.db', create_db=True)
+pool_stats = PoolStats()
+
+class TimedSQLiteProvider(SQLiteProvider):
+    '''Records each checkout of a thread's connection in ``pool_stats``,
+    and reopens the connection if it's older than ``recycle`` seconds or,
+    with ``pre_ping``, fails a ``SELECT 1``. New connections run
+    ``pragmas`` first.
+    '''
+    recycle = -1
+    pre_ping = False
+    pragmas = ()
+
+    def connect(provider):
+        start = default_timer()
+        pool = provider.pool
+        reused = pool.con is not None
+        con = SQLiteProvider.connect(provider)
+        if reused and provider.stale(con, getattr(pool, 'opened', 0)):
+            pool.drop(con)
+            con = SQLiteProvider.connect(provider)
+            reused = False
+        if not reused:
+            apply_pragmas(con, provider.pragmas)
+            pool.opened = time.time()
+        pool_stats.checkout(default_timer() - start)
+        return con
+
+    def stale(provider, con, opened):
+        if provider.recycle > -1 and time.time() - opened > provider.recycle:
+            return True
+        return provider.pre_ping and not ping(con)
+
+    def release(provider, con):
+        pool_stats.checkin()
+        return SQLiteProvider.release(provider, con)
+
+    def drop(provider, con):
+        pool_stats.checkin()
+        return SQLiteProvider.drop(provider, con)
+
+class TimedDatabase(orm.Database):
+    '''Passes each query to ``record_query`` from the hook Pony keeps its
+    own query statistics with.
+    '''
+
+    def _update_local_stat(database, sql, query_start_time):
+        orm.Database._update_local_stat(database, sql, query_start_time)
+        record_query(sql, time.time() - query_start_time)
+
+db = TimedDatabase(TimedSQLiteProvider, 'inventory.db', create_db=True)
 
 
 class Person(db.Entity):
     _table_ = 'people'
     firstname = orm.Required(unicode, 80, nullable=False)
     lastname = orm.Required(unicode, 80, nullable=False)
-    created = orm.Required(datetime, default=datetime.utcnow)
+    created = orm.Required(datetime, default=datetime.utcnow,
+                            index='idx_people__created')
+    item_count = orm.Required(int, default=0)
     items = orm.Set("Item")
 
     @property
     def n_items(self):
+        if stored_item_counts():
+            return self.item_count
         return orm.count(item for item in self.items)
 
     def __repr__(self):
@@ -43,46 +136,328 @@ class Item(db.Entity):
     name = orm.Required(unicode, 100, nullable=False)
     person = orm.Optional(Person)
     checked_out = orm.Required(bool, default=False)
-    updated = orm.Required(datetime, default=datetime.utcnow)
+    updated = orm.Required(datetime, default=datetime.utcnow,
+                            index='idx_items__updated')
 
     def __repr__(self):
         return '<Item {0!r}>'.format(self.name)
 
 
+def load_people(items):
+    '''Load the people who own ``items`` in a single query, so that
+    serializing each item's person doesn't issue a query per item.
+    '''
+    person_ids = list(set(item.person.id for item in items if item.person))
+    if person_ids:
+        orm.select(p for p in Person if p.id in person_ids)[:]
+    return items
+
+def count_items(people):
+    '''Return a dict mapping each person's id to their number of items,
+    using a single grouped query, or their stored counts.
+    '''
+    if stored_item_counts():
+        return dict((person.id, person.item_count) for person in people)
+    ids = [person.id for person in people]
+    if not ids:
+        return {}
+    counts = orm.select((item.person.id, orm.count(item)) for item in Item
+                        if item.person.id in ids)[:]
+    return dict(counts)
+
+def adjust_item_counts(old_ids=(), new_ids=()):
+    '''Update the stored item counts of the people items left (``old_ids``)
+    and joined (``new_ids``), in the db session's transaction. The counts
+    are incremented in the database, not through the cached people.
+    '''
+    if not stored_item_counts():
+        return
+    for delta, ids in count_changes(old_ids, new_ids).items():
+        for id in ids:
+            db.execute("UPDATE people SET item_count = item_count + $delta "
+                        "WHERE id = $id", {'delta': delta, 'id': id})
+
+def add_item_count_column():
+    '''Add ``item_count`` to a people table created before it existed.
+    Returns whether it was missing.
+    '''
+    table = Person._table_
+    with orm.db_session:
+        cursor = db.execute("SELECT * FROM {0} LIMIT 0".format(table))
+        if 'item_count' in [column[0] for column in cursor.description]:
+            return False
+        db.execute(ADD_ITEM_COUNT_COLUMN.format(table))
+    return True
+
+def create_tables():
+    '''Create the tables and indexes, and add any column an older database
+    lacks.
+    '''
+    db.create_tables()
+    add_item_count_column()
+
+def reconcile_item_counts():
+    '''Recount every person's items and fix their stored counts, in one
+    statement. Returns the number of people whose count was wrong.
+    '''
+    add_item_count_column()
+    counted = "SELECT COUNT(*) FROM items WHERE items.person = people.id"
+    with orm.db_session:
+        cursor = db.execute("UPDATE people SET item_count = ({0}) "
+                            "WHERE item_count != ({0})".format(counted))
+        return cursor.rowcount
+
+def get_by_ids(entity, ids):
+    '''Return a dict mapping ids to instances of ``entity``, loaded in one
+    query.
+    '''
+    ids = list(set(parse_ids(ids)))
+    if not ids:
+        return {}
+    return dict((obj.id, obj) for obj in
+                orm.select(obj for obj in entity if obj.id in ids)[:])
+
+def owners_state():
+    '''Return ``(count, max(created))`` of people. Items embed their
+    person, and deleting a person orphans their items without updating
+    them, so this is part of the items' state.
+    '''
+    return (orm.count(p for p in Person),
+            orm.max(p.created for p in Person))
+
+def items_state():
+    '''Return ``(count, max(updated))`` of all items, which changes whenever
+    one of them is added, updated or deleted, plus ``owners_state()``.
+    '''
+    return (orm.count(item for item in Item),
+            orm.max(item.updated for item in Item)) + owners_state()
+
+def recent_state(since):
+    '''Return ``(count, max(updated))`` of the items checked out since
+    ``since``, plus ``owners_state()``.
+    '''
+    return (orm.count(item for item in Item
+                        if item.checked_out and item.updated > since),
+            orm.max(item.updated for item in Item
+                        if item.checked_out and item.updated > since)) + \
+            owners_state()
+
+def people_state():
+    '''Return the state of the people listing, which depends on items too
+    because of ``n_items``: the same as the items listing's.
+    '''
+    return items_state()
+
+def items_query(after=None):
+    '''Return a query for items, most recently updated first, that come
+    after an optional ``(updated, id)`` cursor.
+    '''
+    if after:
+        # Keyset pagination: (updated, id) < (after_updated, after_id)
+        updated, id = after
+        query = orm.select(item for item in Item
+                            if item.updated < updated or
+                                (item.updated == updated and item.id < id))
+    else:
+        query = orm.select(item for item in Item)
+    return query.order_by(orm.desc(Item.updated), orm.desc(Item.id))
+
+def people_query(after=None):
+    '''Return a query for people, newest first, that come after an optional
+    ``(created, id)`` cursor.
+    '''
+    if after:
+        created, id = after
+        query = orm.select(p for p in Person
+                            if p.created < created or
+                                (p.created == created and p.id < id))
+    else:
+        query = orm.select(p for p in Person)
+    return query.order_by(orm.desc(Person.created), orm.desc(Person.id))
+
+def recent_query(since, after=None):
+    '''Return a query for items checked out since ``since``, most recently
+    updated first, that come after an optional ``(updated, id)`` cursor.
+    '''
+    if after:
+        updated, id = after
+        query = orm.select(item for item in Item
+                            if item.checked_out and item.updated > since and
+                                (item.updated < updated or
+                                    (item.updated == updated and item.id < id)))
+    else:
+        query = orm.select(item for item in Item
+                            if item.checked_out and item.updated > since)
+    return query.order_by(orm.desc(Item.updated), orm.desc(Item.id))
+
+def iter_pages(make_query, key, size=CHUNK_SIZE):
+    '''Yield every result of ``make_query(after)`` in lists of ``size``,
+    fetching each keyset page in its own db_session so that loaded objects
+    don't pile up in the identity map.
+    '''
+    after = None
+    while True:
+        with orm.db_session:
+            page = make_query(after)[:size]
+            if page:
+                yield page
+        if len(page) < size:
+            return
+        after = key(page[-1])
+
 ### API ###
 
+cache = ResourceCache("pony")
+query_stats = QueryStats()
+request_metrics = RequestMetrics()
+instrument(app, query_stats, request_metrics)
+profiler = RequestProfiler(app, app.wsgi_app)
+app.wsgi_app = profiler
+
+def person_id(item):
+    return item.person.id if item.person else None
+
+def insert_items(rows):
+    '''Insert items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    people = get_by_ids(Person, (row.get("person_id") for row in rows
+                                    if isinstance(row, dict)))
+    results = []
+    for row in rows:
+        if not isinstance(row, dict) or not row.get("name"):
+            results.append(row_error(400, "Must specify name."))
+            continue
+        try:
+            pid = parse_id(row.get("person_id"))
+        except ValueError:
+            results.append(row_error(400, "Invalid person_id."))
+            continue
+        results.append(Item(name=row["name"], person=people.get(pid),
+                            checked_out=row.get("checked_out", False)))
+    adjust_item_counts(new_ids=[person_id(r) for r in results
+                                if isinstance(r, Item)])
+    orm.commit()  # Pony flushes all the new items at once
+    cache.invalidate("people", *[person_id(r) for r in results
+                                if isinstance(r, Item)])
+    return bulk_results(results, lambda i: ItemSerializer(i).data,
+                        key="item", status=201)
+
+def update_items(rows):
+    '''Update items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    items = get_by_ids(Item, get_row_ids(rows))
+    people = get_by_ids(Person, (row.get("person_id") for row in rows
+                                    if isinstance(row, dict)))
+    old_person_ids = [person_id(item) for item in items.values()]
+    results = []
+    now = datetime.utcnow()
+    for row in rows:
+        item = items.get(parse_row_id(row))
+        if item is None:
+            results.append(row_error(404, "Item not found."))
+            continue
+        try:
+            pid = parse_id(row.get("person_id"))
+        except ValueError:
+            results.append(row_error(400, "Invalid person_id."))
+            continue
+        item.name = row.get("name", item.name)
+        item.checked_out = row.get("checked_out", item.checked_out)
+        if pid:
+            item.person = people.get(pid) or item.person
+        else:
+            item.person = None
+        item.updated = now
+        # Serialized now, in case a later row updates the same item
+        results.append(row_result(ItemSerializer(item).data, "item"))
+    adjust_item_counts(old_person_ids,
+                        [person_id(item) for item in items.values()])
+    orm.commit()
+    cache.invalidate("items", *items.keys())
+    cache.invalidate("people", *(old_person_ids +
+                                [person_id(item) for item in items.values()]))
+    return bulk_results(results)
+
+# Used by post and put with GROUP_COMMIT on. The rows are written in the
+# first request's db session.
+item_inserts = GroupCommit(insert_items, rollback=orm.rollback)
+item_updates = GroupCommit(update_items, rollback=orm.rollback)
+
+def serialize_items(items, fields):
+    '''Serialize ``fields`` of a list of items, loading their people only
+    if they're asked for. (Pony loads whole rows, so there are no columns to
+    leave out.)
+    '''
+    if wants(fields, 'person'):
+        load_people(items)
+    return ItemSerializer(items, many=True, only=fields).data
+
+def serialize_people(people, fields):
+    '''Serialize ``fields`` of a list of people, counting their items only
+    if ``n_items`` is asked for.
+    '''
+    # ``only`` takes precedence over ``exclude``
+    item_counts = count_items(people) if wants(fields, 'n_items') else None
+    return PersonSerializer(people, many=True, only=fields,
+                            exclude=('created',), item_counts=item_counts).data
+
 class ItemsView(FlaskView):
     route_base = '/items/'
 
     def index(self):
-        '''Get all items.'''
-        all_items = orm.select(item for item in Item)\
-                                .order_by(orm.desc(Item.updated))[:]
-        data = ItemSerializer(all_items, many=True).data
-        return jsonify({"items": data})
+        '''Get a page of items, most recently updated first.'''
+        state = items_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(ITEM_FIELDS)
+        if is_streaming():
+            pages = iter_pages(items_query, key=lambda i: (i.updated, i.id))
+            return stream_json("items", pages,
+                                lambda items: serialize_items(items, fields))
+        items, next_cursor = paginate(items_query(after)[:limit + 1], limit,
+                                        key=lambda i: (i.updated, i.id))
+        return jsonify({"items": serialize_items(items, fields),
+                        "next": next_cursor})
 
     def get(self, id):
         '''Get an item.'''
+        fields = get_fields(ITEM_FIELDS)
+        return cache.response("items", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
         try:
             item = Item[id]
         except orm.ObjectNotFound:
             abort(404)
-        return jsonify(ItemSerializer(item).data)
+        return ItemSerializer(item, only=fields).data
 
     def post(self):
         '''Insert a new item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_inserts), "item",
+                                "Successfully added new item", status=201)
         data = request.json
         name = data.get("name", None)
         checked_out = data.get('checked_out', False)
         if not name:
             abort(400)
-        pid = data.get("person_id")
+        try:
+            pid = parse_id(data.get("person_id"))
+        except ValueError:
+            abort(400)
         if pid:
             person = Person.get(id=pid)  # None if not found
         else:
             person = None
         item = Item(name=name, person=person, checked_out=checked_out)
+        adjust_item_counts(new_ids=[person_id(item)])
         orm.commit()
+        cache.invalidate("people", person_id(item))
         return jsonify({"message": "Successfully added new item",
                         "item": ItemSerializer(item).data}), 201
 
@@ -92,47 +467,102 @@ class ItemsView(FlaskView):
             item = Item[id]
         except orm.ObjectNotFound:
             abort(404)
+        old_person_id = person_id(item)
         item.delete()
+        adjust_item_counts(old_ids=[old_person_id])
         orm.commit()
+        cache.invalidate("items", id)
+        cache.invalidate("people", old_person_id)
         return jsonify({"message": "Successfully deleted item.",
                         "id": id}), 200
 
     def put(self, id):
         '''Update an item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_updates, id=int(id)), "item",
+                                "Successfully updated item.")
         try:
             item = Item[id]
         except orm.ObjectNotFound:
             abort(404)
+        old_person_id = person_id(item)
+        try:
+            pid = parse_id(request.json.get("person_id"))
+        except ValueError:
+            abort(400)
         # Update item
         item.name = request.json.get("name", item.name)
         item.checked_out = request.json.get("checked_out", item.checked_out)
-        pid = request.json.get("person_id")
         if pid:
             person = Person.get(id=pid)
             item.person = person or item.person
         else:
             item.person = None
         item.updated = datetime.utcnow()
+        adjust_item_counts([old_person_id], [person_id(item)])
         orm.commit()
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", old_person_id, person_id(item))
         return jsonify({"message": "Successfully updated item.",
                         "item": ItemSerializer(item).data})
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many items in a single transaction.'''
+        return jsonify({"results": insert_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['PUT'])
+    def bulk_put(self):
+        '''Update many items in a single transaction.'''
+        return jsonify({"results": update_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many items, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        items = get_by_ids(Item, ids)
+        old_person_ids = [person_id(item) for item in items.values()]
+        for item in items.values():
+            item.delete()
+        adjust_item_counts(old_ids=old_person_ids)
+        orm.commit()
+        cache.invalidate("items", *items.keys())
+        cache.invalidate("people", *old_person_ids)
+        return bulk_response([id if id in items else
+                                row_error(404, "Item not found.") for id in ids])
+
 class PeopleView(FlaskView):
     route_base = '/people/'
 
     def index(self):
-        '''Get all people, ordered by creation date.'''
-        all_people = orm.select(p for p in Person).order_by(orm.desc(Person.created))[:]
-        data = PersonSerializer(all_people, many=True, exclude=('created',)).data
-        return jsonify({"people": data})
+        '''Get a page of people, ordered by creation date.'''
+        state = people_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(PERSON_FIELDS)
+        if is_streaming():
+            pages = iter_pages(people_query, key=lambda p: (p.created, p.id))
+            return stream_json("people", pages,
+                                lambda people: serialize_people(people, fields))
+        people, next_cursor = paginate(people_query(after)[:limit + 1], limit,
+                                        key=lambda p: (p.created, p.id))
+        return jsonify({"people": serialize_people(people, fields),
+                        "next": next_cursor})
 
     def get(self, id):
         '''Get a person.'''
+        fields = get_fields(PERSON_FIELDS)
+        return cache.response("people", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
         try:
             person = Person[id]
         except orm.ObjectNotFound:
             abort(404)
-        return jsonify(PersonSerializer(person).data)
+        return PersonSerializer(person, only=fields).data
 
     def post(self):
         '''Insert a new person.'''
@@ -152,11 +582,47 @@ class PeopleView(FlaskView):
             person = Person[id]
         except orm.ObjectNotFound:
             abort(404)
+        item_ids = [item.id for item in person.items]
         person.delete()
         orm.commit()
+        cache.invalidate("people", id)
+        cache.invalidate("items", *item_ids)
         return jsonify({"message": "Successfully deleted person.",
                         "id": id}), 200
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many people in a single transaction.'''
+        results = []
+        for row in get_bulk_rows():
+            if not isinstance(row, dict) or \
+                    not row.get("firstname") or not row.get("lastname"):
+                results.append(row_error(400, "Must specify both first and "
+                                                "last name."))
+                continue
+            results.append(Person(firstname=row["firstname"],
+                                    lastname=row["lastname"]))
+        orm.commit()
+        return bulk_response(results,
+                            lambda p: PersonSerializer(p, item_counts={}).data,
+                            key="person", status=201)
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many people, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        people = get_by_ids(Person, ids)
+        person_ids = list(people)
+        item_ids = orm.select(item.id for item in Item
+                                if item.person.id in person_ids)[:]
+        for person in people.values():
+            person.delete()
+        orm.commit()
+        cache.invalidate("people", *people.keys())
+        cache.invalidate("items", *item_ids)
+        return bulk_response([id if id in people else
+                                row_error(404, "Person not found.") for id in ids])
+
 class RecentCheckoutsView(FlaskView):
     '''Demonstrates a more complex query.'''
     route_base = '/recentcheckouts/'
@@ -164,28 +630,79 @@ class RecentCheckoutsView(FlaskView):
     def index(self):
         '''Return items checked out in the past hour.'''
         hour_ago  = datetime.utcnow() - timedelta(hours=1)
-        recent = orm.select(item for item in Item
-                                if item.checked_out and
-                                    item.updated > hour_ago)\
-                                    .order_by(Item.updated.desc())[:]
-        return jsonify({"items": ItemSerializer(recent, many=True).data})
+        state = recent_state(hour_ago)
+        return conditional(lambda: self._index(hour_ago), state)
+
+    def _index(self, hour_ago):
+        fields = get_fields(ITEM_FIELDS)
+        if is_streaming():
+            pages = iter_pages(lambda after: recent_query(hour_ago, after),
+                                key=lambda i: (i.updated, i.id))
+            return stream_json("items", pages,
+                                lambda items: serialize_items(items, fields))
+        recent = recent_query(hour_ago)[:]
+        return jsonify({"items": serialize_items(recent, fields)})
 
 @app.route("/")
 def home():
     return render_template('index.html', orm="Pony ORM")
 
-# Generate object-database mapping
-db.generate_mapping(check_tables=False)
+@app.route("/api/v1/pool")
+def pool():
+    return jsonify(pool_stats.as_dict())
+
+@app.route("/api/v1/queries")
+def queries():
+    return jsonify(query_stats.as_dict())
+
+@app.route("/admin/profiles")
+def profiles():
+    return jsonify({"profiles": list(profiler.profiles)})
+
+def prometheus_metrics():
+    return metrics_response(request_metrics, cache=cache.stats(),
+                            pool=pool_stats.as_dict())
+
+def add_indexes(schema):
+    '''Add the indexes Pony can't declare on attributes to the generated
+    ``schema``, so that ``db.create_tables()`` creates them with the rest.
+    '''
+    items = schema.tables['items']
+    # Covers RecentCheckoutsView
+    items.add_index('idx_items__checked_out_updated',
+                    (items.column_dict['checked_out'],
+                        items.column_dict['updated']))
+
+def init_db(app):
+    '''Generate the object-database mapping, once, apply the app's pool
+    and SQLite settings and give each request a db session.
+    '''
+    if db.schema is None:
+        db.generate_mapping(check_tables=False)
+        add_indexes(db.schema)
+    options = pool_options(app.config)
+    db.provider.recycle = options['recycle']
+    db.provider.pre_ping = options['pre_ping']
+    pragmas = sqlite_pragmas(app.config)
+    if pragmas != db.provider.pragmas:
+        db.provider.pragmas = pragmas
+        # Reopen the connection Database() made, with the new pragmas
+        db.disconnect()
+    if 'pony' not in app.extensions:
+        # The session (and the thread's connection) ends when the response
+        # has been returned. Streaming responses open their own.
+        app.wsgi_app = orm.db_session(app.wsgi_app)
+        app.extensions['pony'] = db
 
 # Register views
 api_prefix = "/api/v1/"
 ItemsView.register(app, route_prefix=api_prefix)
 PeopleView.register(app, route_prefix=api_prefix)
 RecentCheckoutsView.register(app, route_prefix=api_prefix)
+app.add_url_rule("/metrics", view_func=prometheus_metrics)
 
 
 if __name__ == '__main__':
-    db.create_tables()
-    # Make sure each thread gets a db session
-    app.wsgi_app = orm.db_session(app.wsgi_app)
+    init_db(app)
+    create_tables()
     app.run(port=5000)
@@ -2,12 +2,36 @@
 # -*- coding: utf-8 -*-
 '''Hello SQLAlchemy.'''
 from datetime import datetime, timedelta
+from timeit import default_timer
 
-from flask import Flask, jsonify, request, render_template, abort
+from flask import Flask, request, render_template, abort
 from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.classy import FlaskView
+from flask.ext.classy import FlaskView, route
+from sqlalchemy import exc, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 
 from serializers import ItemSerializer, PersonSerializer
+from pagination import get_page_args, paginate
+from cache import ResourceCache
+from conditional import conditional
+from bulk import (get_bulk_rows, get_row_ids, parse_id, parse_ids,
+                    parse_row_id, row_error, row_result, bulk_results,
+                    bulk_response)
+from batching import (GroupCommit, group_commit_enabled, submit_row,
+                        row_response)
+from streaming import CHUNK_SIZE, is_streaming, chunked, stream_json
+from projection import (ITEM_FIELDS, PERSON_FIELDS, ITEM_ATTRIBUTES,
+                        PERSON_ATTRIBUTES, get_fields, wants, get_attributes)
+from rows import (PERSON_COLUMNS, raw_rows, item_columns, person_columns,
+                    item_rows, person_rows)
+from pools import PoolStats, pool_options, ping
+from pragmas import sqlite_pragmas, cached_statements, apply_pragmas
+from instrument import QueryStats, record_query, instrument
+from metrics import RequestMetrics, metrics_response
+from profiling import RequestProfiler
+from encoding import jsonify
+from counts import stored_item_counts, count_changes, ADD_ITEM_COUNT_COLUMN
 
 
 class Settings:
@@ -15,24 +39,129 @@ class Settings:
     # Put the db file in project root
     SQLALCHEMY_DATABASE_URI = "sqlite:///{0}".format(DB_NAME)
     DEBUG = True
+    # See serializers.py
+    SERIALIZER_ENGINE = "marshmallow"
+    # See batching.py
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_TIMEOUT = 30
+    # See profiling.py
+    PROFILING = False
+    PROFILE_RATE = 0.0
+    # See encoding.py
+    JSON_ENCODER = "auto"
+    # See counts.py
+    STORED_ITEM_COUNTS = False
+    # See pools.py
+    DB_POOL_SIZE = 5
+    DB_POOL_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 3600
+    DB_POOL_PRE_PING = False
+    # See pragmas.py
+    SQLITE_TUNING = False
 
 app = Flask(__name__)
 app.config.from_object(Settings)
 
 ### Models ###
 
-db = SQLAlchemy()
-db.init_app(app)
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    '''A ``QueuePool`` that records checkouts in ``stats`` and, with
+    ``pre_ping``, replaces connections that fail a ``SELECT 1``.
+    '''
+
+    def __init__(self, creator, pre_ping=False, stats=None, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.pre_ping = pre_ping
+        self.stats = stats or PoolStats()
+
+    def connect(self):
+        conn = self._timed_connect()
+        if self.pre_ping and not ping(conn):
+            conn.invalidate()
+            conn = self._timed_connect()
+        return conn
+
+    def _timed_connect(self):
+        start = default_timer()
+        try:
+            conn = QueuePool.connect(self)
+        except exc.TimeoutError:
+            self.stats.timeout()
+            raise
+        self.stats.checkout(default_timer() - start)
+        return conn
+
+    def _do_return_conn(self, conn):
+        self.stats.checkin()
+        QueuePool._do_return_conn(self, conn)
+
+    def recreate(self):
+        return self.__class__(self._creator, pre_ping=self.pre_ping,
+                            stats=self.stats, pool_size=self._pool.maxsize,
+                            max_overflow=self._max_overflow,
+                            timeout=self._timeout, recycle=self._recycle,
+                            echo=self.echo,
+                            logging_name=self._orig_logging_name,
+                            use_threadlocal=self._use_threadlocal,
+                            reset_on_return=self._reset_on_return,
+                            _dispatch=self.dispatch, _dialect=self._dialect)
+
+class PooledSQLAlchemy(SQLAlchemy):
+    '''Builds the engine's pool from the ``DB_POOL_*`` settings, and tunes
+    SQLite connections as they're opened.
+    '''
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite':
+            pragmas = sqlite_pragmas(app.config)
+            options['pool_events'] = [
+                (lambda conn, record: apply_pragmas(conn, pragmas), 'connect')]
+            if info.database in (None, '', ':memory:'):
+                # Each connection to an in-memory db is a different db
+                return
+        settings = pool_options(app.config)
+        options.update(poolclass=TimedQueuePool, stats=pool_stats,
+                        pool_size=settings['size'],
+                        max_overflow=settings['max_overflow'],
+                        pool_timeout=settings['timeout'],
+                        pool_recycle=settings['recycle'],
+                        pre_ping=settings['pre_ping'])
+        if info.drivername == 'sqlite':
+            # Pooled connections move between threads, one at a time
+            options['connect_args'] = {
+                'check_same_thread': False,
+                'cached_statements': cached_statements(app.config)}
+
+db = PooledSQLAlchemy()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(default_timer())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    record_query(statement,
+                default_timer() - conn.info['query_started'].pop())
 
 class Person(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     firstname = db.Column(db.String(80), nullable=False)
     lastname = db.Column(db.String(80), nullable=False)
-    created = db.Column(db.DateTime, default=datetime.utcnow)
+    created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    item_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default='0')
 
     @property
     def n_items(self):
-        return len(self.items)
+        if stored_item_counts():
+            return self.item_count
+        return db.session.query(db.func.count(Item.id))\
+                            .filter(Item.person_id == self.id).scalar()
 
     def __repr__(self):
         return "<Person '{0} {1}'>".format(self.firstname, self.lastname)
@@ -43,39 +172,300 @@ class Item(db.Model):
     person_id = db.Column(db.Integer, db.ForeignKey('person.id'), nullable=True)
     person = db.relationship("Person", backref=db.backref("items"))
     checked_out = db.Column(db.Boolean, default=False)
-    updated = db.Column(db.DateTime, default=datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        # Covers RecentCheckoutsView; partial on databases that support it
+        db.Index('ix_item_checked_out_updated', checked_out, updated,
+                    postgresql_where=checked_out == True),
+    )
 
     def __repr__(self):
         return '<Item {0!r}>'.format(self.name)
 
 
+def count_items(people):
+    '''Return a dict mapping each person's id to their number of items,
+    using a single grouped query, or their stored counts.
+    '''
+    if stored_item_counts():
+        return dict((person.id, person.item_count) for person in people)
+    ids = [person.id for person in people]
+    if not ids:
+        return {}
+    counts = db.session.query(Item.person_id, db.func.count(Item.id))\
+                        .filter(Item.person_id.in_(ids))\
+                        .group_by(Item.person_id)
+    return dict(counts)
+
+def adjust_item_counts(old_ids=(), new_ids=()):
+    '''Update the stored item counts of the people items left (``old_ids``)
+    and joined (``new_ids``), as part of the session's transaction.
+    '''
+    if not stored_item_counts():
+        return
+    for delta, ids in count_changes(old_ids, new_ids).items():
+        Person.query.filter(Person.id.in_(ids))\
+                    .update({Person.item_count: Person.item_count + delta},
+                            synchronize_session=False)
+
+def add_item_count_column():
+    '''Add ``item_count`` to a people table created before it existed.
+    Returns whether it was missing.
+    '''
+    columns = db.inspect(db.engine).get_columns(Person.__table__.name)
+    if 'item_count' in [column['name'] for column in columns]:
+        return False
+    db.engine.execute(ADD_ITEM_COUNT_COLUMN.format(Person.__table__.name))
+    return True
+
+def reconcile_item_counts():
+    '''Recount every person's items and fix their stored counts, in one
+    statement. Returns the number of people whose count was wrong.
+    '''
+    add_item_count_column()
+    counted = db.select([db.func.count(Item.id)])\
+                .where(Item.person_id == Person.id)\
+                .correlate(Person.__table__).as_scalar()
+    repaired = Person.query.filter(Person.item_count != counted)\
+                            .update({Person.item_count: counted},
+                                    synchronize_session=False)
+    db.session.commit()
+    return repaired
+
+
+def owners_state():
+    '''Return ``(count, max(created))`` of people. Items embed their
+    person, and deleting a person orphans their items without updating
+    them, so this is part of the items' state.
+    '''
+    return tuple(db.session.query(db.func.count(Person.id),
+                                    db.func.max(Person.created)).one())
+
+def items_state(*criteria):
+    '''Return ``(count, max(updated))`` of the items matching ``criteria``,
+    which changes whenever one of them is added, updated or deleted, plus
+    ``owners_state()``.
+    '''
+    return tuple(db.session.query(db.func.count(Item.id),
+                                    db.func.max(Item.updated))
+                            .filter(*criteria).one()) + owners_state()
+
+def people_state():
+    '''Return the state of the people listing, which depends on items too
+    because of ``n_items``: the same as the items listing's.
+    '''
+    return items_state()
+
+
+def get_people(ids):
+    '''Return a dict mapping ids to people, loaded in one query.'''
+    ids = set(parse_ids(ids))
+    if not ids:
+        return {}
+    return dict((p.id, p) for p in Person.query.filter(Person.id.in_(ids)))
+
+
+# An item's person is loaded through its foreign key column
+ITEM_COLUMNS = dict(ITEM_ATTRIBUTES, person=('person_id',))
+
+def load_only(model, names):
+    '''Return query options that defer every column of ``model`` but
+    ``names``, or none if ``names`` is ``None``. (SQLAlchemy 0.8 has no
+    ``load_only`` option.)
+    '''
+    if names is None:
+        return []
+    return [db.defer(column.key) for column in model.__table__.columns
+            if column.key not in names]
+
+def item_options(fields):
+    '''Return query options that load only the columns ``fields`` need,
+    plus the ones the cursor is made of, and join each item's person only
+    if it's asked for.
+    '''
+    options = load_only(Item, get_attributes(fields, ITEM_COLUMNS,
+                                            always=('id', 'updated')))
+    if wants(fields, 'person'):
+        options.append(db.joinedload(Item.person))
+    return options
+
+def person_options(fields):
+    '''Return query options that load only the columns ``fields`` need.'''
+    return load_only(Person, get_attributes(fields, PERSON_ATTRIBUTES,
+                                            always=('id', 'created')))
+
+def select_items(fields):
+    '''Return a query for the items of a listing of ``fields``. If the app
+    reads raw rows, it selects tuples of columns rather than instances.
+    '''
+    if not raw_rows():
+        return Item.query.options(*item_options(fields))
+    columns = [getattr(Item, name) for name in item_columns(fields)]
+    if not wants(fields, 'person'):
+        return db.session.query(*columns)
+    columns.extend(getattr(Person, name) for name in PERSON_COLUMNS)
+    return db.session.query(*columns).outerjoin(Item.person)
+
+def load_items(results, fields):
+    '''Return the items from the results of a ``select_items`` query.'''
+    if not raw_rows():
+        return results
+    return item_rows(results, item_columns(fields), wants(fields, 'person'))
+
+def select_people(fields):
+    '''Return a query for the people of a listing of ``fields``, selecting
+    tuples of columns if the app reads raw rows.
+    '''
+    if not raw_rows():
+        return Person.query.options(*person_options(fields))
+    return db.session.query(*[getattr(Person, name)
+                                for name in person_columns(fields)])
+
+def load_people(results, fields):
+    '''Return the people from the results of a ``select_people`` query.'''
+    if not raw_rows():
+        return results
+    return person_rows(results, person_columns(fields))
+
 ### API ###
 
+cache = ResourceCache("sqlalchemy")
+query_stats = QueryStats()
+request_metrics = RequestMetrics()
+instrument(app, query_stats, request_metrics)
+profiler = RequestProfiler(app, app.wsgi_app)
+app.wsgi_app = profiler
+
+def insert_items(rows):
+    '''Insert items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    people = get_people(row.get("person_id") for row in rows
+                        if isinstance(row, dict))
+    results = []
+    for row in rows:
+        if not isinstance(row, dict) or not row.get("name"):
+            results.append(row_error(400, "Must specify name."))
+            continue
+        try:
+            pid = parse_id(row.get("person_id"))
+        except ValueError:
+            results.append(row_error(400, "Invalid person_id."))
+            continue
+        results.append(Item(name=row["name"], person=people.get(pid),
+                            checked_out=row.get("checked_out", False)))
+    db.session.add_all(r for r in results if isinstance(r, Item))
+    # Flush to get ids without expiring the new items
+    db.session.flush()
+    adjust_item_counts(new_ids=[r.person_id for r in results
+                                if isinstance(r, Item)])
+    data = bulk_results(results, lambda i: ItemSerializer(i).data,
+                        key="item", status=201)
+    db.session.commit()
+    cache.invalidate("people", *[r.person_id for r in results
+                                if isinstance(r, Item)])
+    return data
+
+def update_items(rows):
+    '''Update items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    items = dict((item.id, item) for item in
+                Item.query.filter(Item.id.in_(parse_ids(get_row_ids(rows)))))
+    people = get_people(row.get("person_id") for row in rows
+                        if isinstance(row, dict))
+    old_person_ids = [item.person_id for item in items.values()]
+    results = []
+    now = datetime.utcnow()
+    for row in rows:
+        item = items.get(parse_row_id(row))
+        if item is None:
+            results.append(row_error(404, "Item not found."))
+            continue
+        try:
+            pid = parse_id(row.get("person_id"))
+        except ValueError:
+            results.append(row_error(400, "Invalid person_id."))
+            continue
+        item.name = row.get("name", item.name)
+        item.checked_out = row.get("checked_out", item.checked_out)
+        if pid:
+            item.person = people.get(pid) or item.person
+        else:
+            item.person = None
+        item.updated = now
+        # Serialized now, in case a later row updates the same item
+        results.append(row_result(ItemSerializer(item).data, "item"))
+    db.session.flush()
+    adjust_item_counts(old_person_ids,
+                        [item.person_id for item in items.values()])
+    data = bulk_results(results)
+    db.session.commit()
+    cache.invalidate("items", *items.keys())
+    cache.invalidate("people", *(old_person_ids +
+                                [item.person_id for item in items.values()]))
+    return data
+
+# Used by post and put with GROUP_COMMIT on
+item_inserts = GroupCommit(insert_items, rollback=db.session.rollback)
+item_updates = GroupCommit(update_items, rollback=db.session.rollback)
+
 class ItemsView(FlaskView):
     route_base = '/items/'
 
     def index(self):
-        '''Get all items.'''
-        all_items = Item.query.order_by(Item.updated.desc()).all()
-        data = ItemSerializer(all_items, many=True).data
-        return jsonify({"items": data})
+        '''Get a page of items, most recently updated first.'''
+        state = items_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(ITEM_FIELDS)
+        query = select_items(fields).order_by(Item.updated.desc(),
+                                                Item.id.desc())
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            rows = load_items(query.yield_per(CHUNK_SIZE), fields)
+            return stream_json("items", chunked(rows), serialize)
+        if after:
+            # Keyset pagination: (updated, id) < (after_updated, after_id)
+            updated, id = after
+            query = query.filter((Item.updated < updated) |
+                                ((Item.updated == updated) & (Item.id < id)))
+        items, next_cursor = paginate(load_items(query.limit(limit + 1), fields),
+                                        limit, key=lambda i: (i.updated, i.id))
+        return jsonify({"items": serialize(items), "next": next_cursor})
 
     def get(self, id):
         '''Get an item.'''
-        item = Item.query.get_or_404(int(id))
-        return jsonify(ItemSerializer(item).data)
+        fields = get_fields(ITEM_FIELDS)
+        return cache.response("items", id, lambda: ItemSerializer(
+                    Item.query.options(*item_options(fields))
+                                .get_or_404(int(id)), only=fields).data,
+                    cached=fields is None)
 
     def post(self):
         '''Insert a new item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_inserts), "item",
+                                "Successfully added new item", status=201)
         data = request.json
         name = data.get("name", None)
         checked_out = data.get("checked_out", False)
         if not name:
             abort(400)
-        person = Person.query.filter_by(id=data.get("person_id", None)).first()
+        try:
+            pid = parse_id(data.get("person_id"))
+        except ValueError:
+            abort(400)
+        person = Person.query.get(pid) if pid else None
         item = Item(name=name, person=person, checked_out=checked_out)
         db.session.add(item)
+        adjust_item_counts(new_ids=[person.id if person else None])
         db.session.commit()
+        cache.invalidate("people", item.person_id)
         return jsonify({"message": "Successfully added new item",
                         "item": ItemSerializer(item).data}), 201
 
@@ -83,40 +473,103 @@ class ItemsView(FlaskView):
         '''Delete an item.'''
         item = Item.query.get_or_404(int(id))
         db.session.delete(item)
+        adjust_item_counts(old_ids=[item.person_id])
         db.session.commit()
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", item.person_id)
         return jsonify({"message": "Successfully deleted item.",
                         "id": item.id}), 200
 
     def put(self, id):
         '''Update an item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_updates, id=int(id)), "item",
+                                "Successfully updated item.")
         item = Item.query.get_or_404(int(id))
+        old_person_id = item.person_id
+        try:
+            pid = parse_id(request.json.get("person_id"))
+        except ValueError:
+            abort(400)
         # Update item
         item.name = request.json.get("name", item.name)
         item.checked_out = request.json.get("checked_out", item.checked_out)
-        if request.json.get("person_id"):
-            person = Person.query.get(int(request.json['person_id']))
+        if pid:
+            person = Person.query.get(pid)
             item.person = person or item.person
         else:
             item.person = None
         item.updated = datetime.utcnow()
         db.session.add(item)
+        adjust_item_counts([old_person_id],
+                            [item.person.id if item.person else None])
         db.session.commit()
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", old_person_id, item.person_id)
         return jsonify({"message": "Successfully updated item.",
                         "item": ItemSerializer(item).data})
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many items in a single transaction.'''
+        return jsonify({"results": insert_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['PUT'])
+    def bulk_put(self):
+        '''Update many items in a single transaction.'''
+        return jsonify({"results": update_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many items, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        owners = dict(db.session.query(Item.id, Item.person_id)
+                                .filter(Item.id.in_(ids)))
+        found = set(owners)
+        Item.query.filter(Item.id.in_(found)).delete(synchronize_session=False)
+        adjust_item_counts(old_ids=owners.values())
+        db.session.commit()
+        cache.invalidate("items", *found)
+        cache.invalidate("people", *owners.values())
+        return bulk_response([id if id in found else
+                                row_error(404, "Item not found.") for id in ids])
+
 class PeopleView(FlaskView):
     route_base = '/people/'
 
     def index(self):
-        '''Get all people, ordered by creation date.'''
-        all_people = Person.query.order_by(Person.created.desc()).all()
-        data = PersonSerializer(all_people, exclude=('created',), many=True).data
-        return jsonify({"people": data})
+        '''Get a page of people, ordered by creation date.'''
+        state = people_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(PERSON_FIELDS)
+        query = select_people(fields).order_by(Person.created.desc(),
+                                                Person.id.desc())
+        # ``only`` takes precedence over ``exclude``
+        serialize = lambda people: PersonSerializer(people, many=True,
+                        only=fields, exclude=('created',),
+                        item_counts=count_items(people)
+                                    if wants(fields, 'n_items') else None).data
+        if is_streaming():
+            rows = load_people(query.yield_per(CHUNK_SIZE), fields)
+            return stream_json("people", chunked(rows), serialize)
+        if after:
+            created, id = after
+            query = query.filter((Person.created < created) |
+                                ((Person.created == created) & (Person.id < id)))
+        people, next_cursor = paginate(load_people(query.limit(limit + 1), fields),
+                                        limit, key=lambda p: (p.created, p.id))
+        return jsonify({"people": serialize(people), "next": next_cursor})
 
     def get(self, id):
         '''Get a person.'''
-        person = Person.query.get_or_404(int(id))
-        return jsonify(PersonSerializer(person).data)
+        fields = get_fields(PERSON_FIELDS)
+        return cache.response("people", id, lambda: PersonSerializer(
+                    Person.query.options(*person_options(fields))
+                                .get_or_404(int(id)), only=fields).data,
+                    cached=fields is None)
 
     def post(self):
         '''Insert a new person.'''
@@ -134,11 +587,56 @@ class PeopleView(FlaskView):
     def delete(self, id):
         '''Delete a person.'''
         person = Person.query.get_or_404(int(id))
+        item_ids = [item.id for item in person.items]
         db.session.delete(person)
         db.session.commit()
+        cache.invalidate("people", person.id)
+        # Their items no longer have a person
+        cache.invalidate("items", *item_ids)
         return jsonify({"message": "Successfully deleted person.",
                         "id": person.id}), 200
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many people in a single transaction.'''
+        results = []
+        for row in get_bulk_rows():
+            if not isinstance(row, dict) or \
+                    not row.get("firstname") or not row.get("lastname"):
+                results.append(row_error(400, "Must specify both first and "
+                                                "last name."))
+                continue
+            results.append(Person(firstname=row["firstname"],
+                                    lastname=row["lastname"]))
+        db.session.add_all(r for r in results if isinstance(r, Person))
+        db.session.flush()
+        response = bulk_response(results,
+                                lambda p: PersonSerializer(p, item_counts={}).data,
+                                key="person", status=201)
+        db.session.commit()
+        return response
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many people, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        found = set(id for (id,) in
+                    db.session.query(Person.id).filter(Person.id.in_(ids)))
+        item_ids = [id for (id,) in db.session.query(Item.id)
+                                            .filter(Item.person_id.in_(found))] \
+                    if found else []
+        if found:
+            # Orphan their items, as deleting a single person does
+            Item.query.filter(Item.person_id.in_(found))\
+                        .update({Item.person_id: None}, synchronize_session=False)
+            Person.query.filter(Person.id.in_(found))\
+                        .delete(synchronize_session=False)
+        db.session.commit()
+        cache.invalidate("people", *found)
+        cache.invalidate("items", *item_ids)
+        return bulk_response([id if id in found else
+                                row_error(404, "Person not found.") for id in ids])
+
 class RecentCheckoutsView(FlaskView):
     '''Demonstrates a more complex query.'''
     route_base = '/recentcheckouts/'
@@ -146,22 +644,57 @@ class RecentCheckoutsView(FlaskView):
     def index(self):
         '''Return items checked out in the past hour.'''
         hour_ago  = datetime.utcnow() - timedelta(hours=1)
-        recent = Item.query.filter(Item.checked_out &
+        state = items_state(Item.checked_out, Item.updated > hour_ago)
+        return conditional(lambda: self._index(hour_ago), state)
+
+    def _index(self, hour_ago):
+        fields = get_fields(ITEM_FIELDS)
+        query = select_items(fields)\
+                            .filter(Item.checked_out &
                                     (Item.updated > hour_ago)) \
-                                    .order_by(Item.updated.desc()).all()
-        return jsonify({"items": ItemSerializer(recent, many=True).data})
+                            .order_by(Item.updated.desc())
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            rows = load_items(query.yield_per(CHUNK_SIZE), fields)
+            return stream_json("items", chunked(rows), serialize)
+        return jsonify({"items": serialize(list(load_items(query, fields)))})
 
 @app.route("/")
 def home():
     return render_template('index.html', orm="SQLAlchemy")
 
+@app.route("/api/v1/pool")
+def pool():
+    return jsonify(pool_stats.as_dict())
+
+@app.route("/api/v1/queries")
+def queries():
+    return jsonify(query_stats.as_dict())
+
+@app.route("/admin/profiles")
+def profiles():
+    return jsonify({"profiles": list(profiler.profiles)})
+
+def prometheus_metrics():
+    return metrics_response(request_metrics, cache=cache.stats(),
+                            pool=pool_stats.as_dict())
+
+def init_db(app):
+    '''Bind the db to the app. The engine is created on first use.'''
+    if 'sqlalchemy' not in app.extensions:
+        db.init_app(app)
+
 # Register views
 api_prefix = "/api/v1/"
 ItemsView.register(app, route_prefix=api_prefix)
 PeopleView.register(app, route_prefix=api_prefix)
 RecentCheckoutsView.register(app, route_prefix=api_prefix)
+app.add_url_rule("/metrics", view_func=prometheus_metrics)
 
 if __name__ == '__main__':
+    init_db(app)
     with app.app_context():
         db.create_all()
+        add_item_count_column()
     app.run(port=5000)
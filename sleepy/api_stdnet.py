@@ -1,33 +1,84 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''Hello Stdnet.'''
+import calendar
 import logging
 from datetime import datetime, timedelta
 
-from flask import Flask, jsonify, request, render_template, abort
-from flask.ext.classy import FlaskView
+from flask import Flask, request, render_template, abort
+from flask.ext.classy import FlaskView, route
 from stdnet import odm
+from stdnet.backends.redisb import client as redis_client
 from serializers import ItemSerializer, PersonSerializer
+from pagination import get_page_args, paginate
+from cache import ResourceCache
+from conditional import conditional
+from bulk import (get_bulk_rows, get_row_ids, row_error, row_result,
+                    bulk_results, bulk_response)
+from batching import (GroupCommit, group_commit_enabled, submit_row,
+                        row_response)
+from streaming import CHUNK_SIZE, is_streaming, stream_json
+from projection import (ITEM_FIELDS, PERSON_FIELDS, ITEM_ATTRIBUTES,
+                        PERSON_ATTRIBUTES, get_fields, wants, get_attributes)
+from instrument import QueryStats, time_method, instrument
+from metrics import RequestMetrics, metrics_response
+from profiling import RequestProfiler
+from encoding import jsonify
+from counts import stored_item_counts, count_changes
 
 
 class Settings:
     REDIS_URL = 'redis://'
     DEBUG = True
+    # See serializers.py
+    SERIALIZER_ENGINE = "marshmallow"
+    # See batching.py
+    GROUP_COMMIT = False
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_TIMEOUT = 30
+    # See profiling.py
+    PROFILING = False
+    PROFILE_RATE = 0.0
+    # See encoding.py
+    JSON_ENCODER = "auto"
+    # See counts.py
+    STORED_ITEM_COUNTS = False
 
 app = Flask(__name__)
 app.config.from_object(Settings)
 
 ### Models ###
 
-models = odm.Router(app.config['REDIS_URL'])
+def describe_command(client, *args, **options):
+    '''Describe a command by its name and first key, e.g. "HGETALL item:1".'''
+    return " ".join(str(arg) for arg in args[:2])
+
+def describe_pipeline(pipeline, *args, **kwargs):
+    return "PIPELINE ({0} commands)".format(len(pipeline.command_stack))
+
+# stdnet's client overrides redis-py's, so it's the one to time. Commands
+# queued on a pipeline are sent, and timed, together.
+time_method(redis_client.Redis, 'execute_command', describe_command)
+time_method(redis_client.Pipeline, 'execute', describe_pipeline)
+
+# Models are registered against the app's REDIS_URL by ``init_db``
+models = odm.Router()
 
 class Person(odm.StdModel):
     firstname = odm.CharField(required=True)
     lastname = odm.CharField(required=True)
-    created = odm.DateTimeField(default=datetime.utcnow)
+    created = odm.DateTimeField(default=datetime.utcnow, index=True)
+    # Incremented in place by ``adjust_item_counts``
+    item_count = odm.IntegerField(default=0)
+
+    class Meta:
+        # Keep ids in a sorted set scored by creation time
+        ordering = '-created'
 
     @property
     def n_items(self):
+        if stored_item_counts():
+            return self.item_count
         return len(self.items.all())
 
     def __unicode__(self):
@@ -38,33 +89,373 @@ class Item(odm.StdModel):
     name = odm.CharField(required=True)
     person = odm.ForeignKey(Person, related_name='items', required=False)
     checked_out = odm.BooleanField(default=False)
-    updated = odm.DateTimeField(default=datetime.utcnow)
+    updated = odm.DateTimeField(default=datetime.utcnow, index=True)
+
+    class Meta:
+        # Keep ids in a sorted set scored by update time
+        ordering = '-updated'
 
     def __unicode__(self):
         return '<Item {0!r}>'.format(self.name)
 
 
+def keyset_page(manager, field, after, limit, related=(), only=None):
+    '''Return up to ``limit + 1`` instances ordered by ``-field, -id`` that
+    come after the ``(timestamp, id)`` cursor, using a range over the
+    model's sorted set. Foreign keys named in ``related`` are fetched in a
+    single batch rather than one lookup per instance. If given, only the
+    fields in ``only`` are loaded.
+    '''
+    query = manager.query().sort_by('-' + field)
+    if only is not None:
+        query = query.load_only(*only)
+    for name in related:
+        query = query.load_related(name)
+    if not after:
+        return query[:limit + 1]
+    timestamp, id = after
+    # Rows that share the cursor's timestamp are ordered by id
+    ties = [obj for obj in query.filter(**{field: timestamp})
+            if int(obj.id) < int(id)]
+    ties.sort(key=lambda obj: int(obj.id), reverse=True)
+    older = query.filter(**{field + '__lt': timestamp})[:limit + 1]
+    return (ties + list(older))[:limit + 1]
+
+def iter_slices(fetch, size=CHUNK_SIZE):
+    '''Yield lists of up to ``size`` results, where ``fetch(start, stop)``
+    returns one range of a sorted set.
+    '''
+    start = 0
+    while True:
+        chunk = list(fetch(start, start + size))
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        start += size
+
+def count_items(people):
+    '''Return a dict mapping each person's id to their number of items,
+    fetching the owners of all their items in a single query, or their
+    stored counts.
+    '''
+    if stored_item_counts():
+        return dict((person.id, person.item_count) for person in people)
+    counts = dict((person.id, 0) for person in people)
+    if counts:
+        owned = models.item.filter(person=list(counts)).load_only('person')
+        for item in owned:
+            counts[item.person_id] += 1
+    return counts
+
+def person_key(id):
+    '''Return the key of the hash a person's fields are stored in.'''
+    return models.person.backend.basekey(models.person._meta, 'obj', id)
+
+def adjust_item_counts(old_ids=(), new_ids=()):
+    '''Update the stored item counts of the people items left (``old_ids``)
+    and joined (``new_ids``), with a HINCRBY on each person's hash, all in
+    one MULTI. stdnet commits the items with a script in a MULTI of its own,
+    so this one follows it; ``reconcile_item_counts`` repairs the counts if
+    it's lost.
+    '''
+    if not stored_item_counts():
+        return
+    changes = count_changes(old_ids, new_ids)
+    if not changes:
+        return
+    pipe = models.person.backend.client.pipeline()
+    for delta, ids in changes.items():
+        for id in ids:
+            pipe.hincrby(person_key(id), 'item_count', delta)
+    pipe.execute()
+
+def reconcile_item_counts():
+    '''Recount every person's items, reading only the items' owners, and
+    fix their stored counts in one MULTI. Returns the number of people whose
+    count was wrong.
+    '''
+    counted = {}
+    for item in models.item.query().load_only('person'):
+        if item.person_id:
+            counted[item.person_id] = counted.get(item.person_id, 0) + 1
+    pipe = models.person.backend.client.pipeline()
+    repaired = 0
+    for person in models.person.query().load_only('item_count'):
+        count = counted.get(person.id, 0)
+        if person.item_count != count:
+            pipe.hset(person_key(person.id), 'item_count', count)
+            repaired += 1
+    pipe.execute()
+    return repaired
+
+def load_fields(fields, attributes, always=()):
+    '''Return the model fields ``fields`` need, plus ``always``, for
+    ``load_only``, or ``None`` to load all of them. The id is always loaded.
+    '''
+    names = get_attributes(fields, attributes, always=always)
+    if names is None:
+        return None
+    return [name for name in names if name != 'id']
+
+def person_related(fields):
+    '''Return the foreign keys to fetch along with items.'''
+    return ('person',) if wants(fields, 'person') else ()
+
+def get_by_ids(manager, ids, related=()):
+    '''Return a dict mapping string ids to instances, fetched in a single
+    query.
+    '''
+    ids = list(set(str(id) for id in ids if id))
+    if not ids:
+        return {}
+    query = manager.filter(id=ids)
+    for name in related:
+        query = query.load_related(name)
+    return dict((str(obj.id), obj) for obj in query.all())
+
+def save_all(instances):
+    '''Save instances in a single transaction, i.e. one pipelined round
+    trip to redis.
+    '''
+    if instances:
+        with models.session().begin() as t:
+            for instance in instances:
+                t.add(instance)
+    return instances
+
+def model_state(manager, field):
+    '''Return ``(count, max(field))`` of a model, reading the max from the
+    head of the model's sorted set.
+    '''
+    latest = manager.query().sort_by('-' + field).load_only(field)[:1]
+    return (manager.query().count(),
+            getattr(latest[0], field) if latest else None)
+
+def owners_state():
+    '''Return ``model_state`` of people. Items embed their person, and
+    deleting a person orphans their items without updating them, so this is
+    part of the items' state.
+    '''
+    return model_state(models.person, 'created')
+
+def items_state():
+    '''Return ``model_state`` of items plus ``owners_state()``.'''
+    return model_state(models.item, 'updated') + owners_state()
+
+def people_state():
+    '''Return the state of the people listing, which depends on items too
+    because of ``n_items``: the same as the items listing's.
+    '''
+    return items_state()
+
+def to_score(dt):
+    '''Return a UTC datetime as a sorted set score.'''
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+class CheckoutIndex(object):
+    '''A sorted set of the ids of checked out items, scored by their update
+    time, so that recent checkouts are a ZREVRANGEBYSCORE rather than a scan
+    over every checked out item. Kept up to date by the router's commit and
+    delete events (see ``register_models``).
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.key = manager.backend.basekey(manager._meta, 'checked_out')
+
+    @property
+    def client(self):
+        return self.manager.backend.client
+
+    def update(self, *args, **kwargs):
+        '''Add or remove committed items depending on their state.'''
+        pipe = self.client.pipeline()
+        for item in kwargs.get('instances') or ():
+            if item.checked_out:
+                pipe.zadd(self.key, to_score(item.updated), item.id)
+            else:
+                pipe.zrem(self.key, item.id)
+        pipe.execute()
+
+    def remove(self, *args, **kwargs):
+        '''Drop deleted items.'''
+        ids = [getattr(item, 'id', item) for item in kwargs.get('instances') or ()]
+        if ids:
+            self.client.zrem(self.key, *ids)
+
+    def rebuild(self):
+        '''Re-index every checked out item, e.g. for data saved before the
+        index existed.
+        '''
+        self.client.delete(self.key)
+        self.update(instances=self.manager.filter(checked_out=True).all())
+
+    def state(self, since):
+        '''Return ``(count, last updated)`` of the items checked out after
+        ``since``.
+        '''
+        min_score = '({0!r}'.format(to_score(since))
+        pipe = self.client.pipeline()
+        pipe.zcount(self.key, min_score, '+inf')
+        pipe.zrevrangebyscore(self.key, '+inf', min_score, start=0, num=1,
+                                withscores=True)
+        count, latest = pipe.execute()
+        if not latest:
+            return count, None
+        return count, datetime.utcfromtimestamp(latest[0][1])
+
+    def recent(self, since, limit=None, start=0, related=('person',),
+                only=None):
+        '''Return up to ``limit`` (or all) items checked out after ``since``,
+        most recently updated first, skipping the first ``start``. ``related``
+        and ``only`` are as for ``keyset_page``.
+        '''
+        # A negative count makes Redis return the rest of the range
+        ids = self.client.zrevrangebyscore(self.key, '+inf',
+                                            '({0!r}'.format(to_score(since)),
+                                            start=start,
+                                            num=-1 if limit is None else limit)
+        if not ids:
+            return []
+        query = self.manager.filter(id=ids)
+        if only is not None:
+            query = query.load_only(*only)
+        for name in related:
+            query = query.load_related(name)
+        items = query.all()
+        return sorted(items, key=lambda item: item.updated, reverse=True)
+
 ### API ###
 
+cache = ResourceCache("stdnet")
+query_stats = QueryStats()
+request_metrics = RequestMetrics()
+instrument(app, query_stats, request_metrics)
+profiler = RequestProfiler(app, app.wsgi_app)
+app.wsgi_app = profiler
+
+def owned_item_ids(person_ids):
+    '''Return the ids of the items owned by any of ``person_ids``.'''
+    if not person_ids:
+        return []
+    return [item.id for item in
+            models.item.filter(person=list(person_ids)).load_only('person')]
+
+def insert_items(rows):
+    '''Insert items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    people = get_by_ids(models.person, (row.get("person_id") for row in rows
+                                        if isinstance(row, dict)))
+    results = []
+    for row in rows:
+        if not isinstance(row, dict) or not row.get("name"):
+            results.append(row_error(400, "Must specify name."))
+            continue
+        results.append(Item(name=row["name"],
+                            person=people.get(str(row.get("person_id"))),
+                            checked_out=row.get("checked_out", False)))
+    created = save_all([r for r in results if isinstance(r, Item)])
+    adjust_item_counts(new_ids=[item.person_id for item in created])
+    cache.invalidate("people", *[item.person_id for item in created])
+    return bulk_results(results, lambda i: ItemSerializer(i).data,
+                        key="item", status=201)
+
+def update_items(rows):
+    '''Update items in a single transaction. Returns the result of each
+    row, as the bulk endpoints do.
+    '''
+    items = get_by_ids(models.item, get_row_ids(rows), related=('person',))
+    people = get_by_ids(models.person, (row.get("person_id") for row in rows
+                                        if isinstance(row, dict)))
+    old_person_ids = dict((id, item.person_id) for id, item in items.items())
+    results, written = [], {}
+    now = datetime.utcnow()
+    for row in rows:
+        item = items.get(str(row.get("id"))) if isinstance(row, dict) else None
+        if item is None:
+            results.append(row_error(404, "Item not found."))
+            continue
+        if row.get("person_id"):
+            person = people.get(str(row["person_id"]))
+            if person is None:
+                results.append(row_error(404, "Person not found."))
+                continue
+            item.person = person
+        else:
+            item.person = None
+        item.name = row.get("name", item.name)
+        item.checked_out = row.get("checked_out", item.checked_out)
+        item.updated = now
+        # Serialized now, in case a later row updates the same item
+        results.append(row_result(ItemSerializer(item).data, "item"))
+        written[str(item.id)] = item
+    # Each item is saved once, in the state its last row left it in
+    save_all(list(written.values()))
+    adjust_item_counts([old_person_ids[id] for id in written],
+                        [item.person_id for item in written.values()])
+    cache.invalidate("items", *written.keys())
+    cache.invalidate("people", *(list(old_person_ids.values()) +
+                                [item.person_id for item in written.values()]))
+    return bulk_results(results)
+
+# Used by post and put with GROUP_COMMIT on. Redis doesn't undo the rest of
+# a transaction when one command fails, so a failed batch isn't retried.
+item_inserts = GroupCommit(insert_items, retry=False)
+item_updates = GroupCommit(update_items, retry=False)
+
 class ItemsView(FlaskView):
     route_base = '/items/'
 
     def index(self):
-        '''Get all items.'''
-        all_items = models.item.query().sort_by("-updated").all()
-        data = ItemSerializer(all_items, many=True).data
-        return jsonify({"items": data})
+        '''Get a page of items, most recently updated first.'''
+        state = items_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(ITEM_FIELDS)
+        only = load_fields(fields, ITEM_ATTRIBUTES, always=('updated',))
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            query = models.item.query().sort_by("-updated")
+            if only is not None:
+                query = query.load_only(*only)
+            for name in person_related(fields):
+                query = query.load_related(name)
+            return stream_json("items",
+                                iter_slices(lambda start, stop: query[start:stop]),
+                                serialize)
+        page = keyset_page(models.item, 'updated', after, limit,
+                            related=person_related(fields), only=only)
+        items, next_cursor = paginate(page, limit,
+                                        key=lambda i: (i.updated, i.id))
+        return jsonify({"items": serialize(items), "next": next_cursor})
 
     def get(self, id):
         '''Get an item.'''
+        fields = get_fields(ITEM_FIELDS)
+        return cache.response("items", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
+        query = models.item.query()
+        only = load_fields(fields, ITEM_ATTRIBUTES)
+        if only:
+            query = query.load_only(*only)
         try:
-            item = models.item.query().get(id=id)
+            item = query.get(id=id)
         except Item.DoesNotExist:
             abort(404)
-        return jsonify(ItemSerializer(item).data)
+        return ItemSerializer(item, only=fields).data
 
     def post(self):
         '''Insert a new item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_inserts), "item",
+                                "Successfully added new item", status=201)
         data = request.json
         name = data.get("name", None)
         person_id = data.get("person_id")
@@ -78,6 +469,8 @@ class ItemsView(FlaskView):
             except Person.DoesNotExist:
                 pass
         item = models.item.new(name=name, person=person, checked_out=checked_out)
+        adjust_item_counts(new_ids=[item.person_id])
+        cache.invalidate("people", item.person_id)
         return jsonify({"message": "Successfully added new item",
                         "item": ItemSerializer(item).data}), 201
 
@@ -88,15 +481,22 @@ class ItemsView(FlaskView):
         except Item.DoesNotExist:
             abort(404)
         item.delete()
+        adjust_item_counts(old_ids=[item.person_id])
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", item.person_id)
         return jsonify({"message": "Successfully deleted item.",
                         "id": item.id}), 200
 
     def put(self, id):
         '''Update an item.'''
+        if group_commit_enabled():
+            return row_response(submit_row(item_updates, id=id), "item",
+                                "Successfully updated item.")
         try:
             item = models.item.query().get(id=int(id))
         except Item.DoesNotExist:
             abort(404)
+        old_person_id = item.person_id
         # Update item
         item.name = request.json.get("name", item.name)
         item.checked_out = request.json.get("checked_out", item.checked_out)
@@ -110,25 +510,81 @@ class ItemsView(FlaskView):
             item.person = None
         item.updated = datetime.utcnow()
         item.save()
+        adjust_item_counts([old_person_id], [item.person_id])
+        cache.invalidate("items", item.id)
+        cache.invalidate("people", old_person_id, item.person_id)
         return jsonify({"message": "Successfully updated item.",
                         "item": ItemSerializer(item).data})
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many items in a single transaction.'''
+        return jsonify({"results": insert_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['PUT'])
+    def bulk_put(self):
+        '''Update many items in a single transaction.'''
+        return jsonify({"results": update_items(get_bulk_rows())})
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many items, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        found = get_by_ids(models.item, ids)
+        if found:
+            models.item.filter(id=list(found)).delete()
+            adjust_item_counts(old_ids=[item.person_id
+                                        for item in found.values()])
+        cache.invalidate("items", *found.keys())
+        cache.invalidate("people", *[item.person_id for item in found.values()])
+        return bulk_response([id if str(id) in found else
+                                row_error(404, "Item not found.") for id in ids])
+
 class PeopleView(FlaskView):
     route_base = '/people/'
 
     def index(self):
-        '''Get all people, ordered by creation date.'''
-        all_people = models.person.query().sort_by("-created")
-        data = PersonSerializer(all_people, exclude=('created',), many=True).data
-        return jsonify({"people": data})
+        '''Get a page of people, ordered by creation date.'''
+        state = people_state()
+        return conditional(self._index, state)
+
+    def _index(self):
+        limit, after = get_page_args()
+        fields = get_fields(PERSON_FIELDS)
+        only = load_fields(fields, PERSON_ATTRIBUTES, always=('created',))
+        # ``only`` takes precedence over ``exclude``
+        serialize = lambda people: PersonSerializer(people, many=True,
+                        only=fields, exclude=('created',),
+                        item_counts=count_items(people)
+                                    if wants(fields, 'n_items') else None).data
+        if is_streaming():
+            query = models.person.query().sort_by("-created")
+            if only is not None:
+                query = query.load_only(*only)
+            return stream_json("people",
+                                iter_slices(lambda start, stop: query[start:stop]),
+                                serialize)
+        page = keyset_page(models.person, 'created', after, limit, only=only)
+        people, next_cursor = paginate(page, limit,
+                                        key=lambda p: (p.created, p.id))
+        return jsonify({"people": serialize(people), "next": next_cursor})
 
     def get(self, id):
         '''Get a person.'''
+        fields = get_fields(PERSON_FIELDS)
+        return cache.response("people", id, lambda: self._get_data(id, fields),
+                                cached=fields is None)
+
+    def _get_data(self, id, fields):
+        query = models.person.query()
+        only = load_fields(fields, PERSON_ATTRIBUTES)
+        if only:
+            query = query.load_only(*only)
         try:
-            person = models.person.query().get(id=id)
+            person = query.get(id=id)
         except Person.DoesNotExist:
             abort(404)
-        return jsonify(PersonSerializer(person).data)
+        return PersonSerializer(person, only=fields).data
 
     def post(self):
         '''Insert a new person.'''
@@ -148,10 +604,43 @@ class PeopleView(FlaskView):
             person = models.person.query().get(id=id)
         except Person.DoesNotExist:
             abort(404)
+        item_ids = owned_item_ids([person.id])
         person.delete()
+        cache.invalidate("people", person.id)
+        cache.invalidate("items", *item_ids)
         return jsonify({"message": "Successfully deleted person.",
                         "id": person.id}), 200
 
+    @route('/bulk', methods=['POST'])
+    def bulk_post(self):
+        '''Insert many people in a single transaction.'''
+        results = []
+        for row in get_bulk_rows():
+            if not isinstance(row, dict) or \
+                    not row.get("firstname") or not row.get("lastname"):
+                results.append(row_error(400, "Must specify both first and "
+                                                "last name."))
+                continue
+            results.append(Person(firstname=row["firstname"],
+                                    lastname=row["lastname"]))
+        save_all([r for r in results if isinstance(r, Person)])
+        return bulk_response(results,
+                            lambda p: PersonSerializer(p, item_counts={}).data,
+                            key="person", status=201)
+
+    @route('/bulk', methods=['DELETE'])
+    def bulk_delete(self):
+        '''Delete many people, given a list of ids, in a single transaction.'''
+        ids = get_bulk_rows()
+        found = get_by_ids(models.person, ids)
+        item_ids = owned_item_ids(found)
+        if found:
+            models.person.filter(id=list(found)).delete()
+        cache.invalidate("people", *found.keys())
+        cache.invalidate("items", *item_ids)
+        return bulk_response([id if str(id) in found else
+                                row_error(404, "Person not found.") for id in ids])
+
 class RecentCheckoutsView(FlaskView):
     '''Demonstrates a more complex query.'''
     route_base = '/recentcheckouts/'
@@ -159,26 +648,83 @@ class RecentCheckoutsView(FlaskView):
     def index(self):
         '''Return items checked out in the past hour.'''
         hour_ago  = datetime.utcnow() - timedelta(hours=1)
-        recent = models.item.filter(checked_out=True).sort_by("-updated").all()
-        return jsonify({"items": ItemSerializer(recent, many=True).data})
+        checkouts = CheckoutIndex(models.item)
+        state = checkouts.state(hour_ago) + owners_state()
+        return conditional(lambda: self._index(checkouts, hour_ago), state)
+
+    def _index(self, checkouts, hour_ago):
+        fields = get_fields(ITEM_FIELDS)
+        # Sorting the page needs each item's update time
+        options = dict(related=person_related(fields),
+                        only=load_fields(fields, ITEM_ATTRIBUTES,
+                                        always=('updated',)))
+        serialize = lambda items: ItemSerializer(items, many=True,
+                                                    only=fields).data
+        if is_streaming():
+            fetch = lambda start, stop: checkouts.recent(hour_ago, stop - start,
+                                                        start=start, **options)
+            return stream_json("items", iter_slices(fetch), serialize)
+        recent = checkouts.recent(hour_ago, **options)
+        return jsonify({"items": serialize(recent)})
 
 @app.route("/")
 def home():
     return render_template('index.html', orm="Stdnet")
 
-def register_models(router):
-    router.register(Item)
-    router.register(Person)
+@app.route("/api/v1/queries")
+def queries():
+    return jsonify(query_stats.as_dict())
+
+@app.route("/admin/profiles")
+def profiles():
+    return jsonify({"profiles": list(profiler.profiles)})
+
+def prometheus_metrics():
+    return metrics_response(request_metrics, cache=cache.stats())
+
+def register_models(router, backend=None):
+    '''Register the models with ``router``, on ``backend`` (a Redis URL)
+    or the router's default, and keep the checkout index up to date.
+    '''
+    router.register(Item, backend=backend)
+    router.register(Person, backend=backend)
+    checkouts = CheckoutIndex(router.item)
+    # Strong references: nothing else holds on to ``checkouts``
+    router.post_commit.connect(checkouts.update, sender=Item, weak=False,
+                                dispatch_uid='checkouts')
+    router.post_delete.connect(checkouts.remove, sender=Item, weak=False,
+                                dispatch_uid='checkouts')
     return router
 
+def unregister_models(router):
+    router.post_commit.disconnect(sender=Item, dispatch_uid='checkouts')
+    router.post_delete.disconnect(sender=Item, dispatch_uid='checkouts')
+    router.unregister(Item)
+    router.unregister(Person)
+
+# The REDIS_URL the models were registered with
+_connected_for = None
+
+def init_db(app):
+    '''Register the models against the app's ``REDIS_URL``. Redis isn't
+    connected to until the first command.
+    '''
+    global _connected_for
+    url = app.config['REDIS_URL']
+    if url == _connected_for:
+        return
+    unregister_models(models)
+    register_models(models, url)
+    _connected_for = url
+
 # Register views
 api_prefix = "/api/v1/"
 ItemsView.register(app, route_prefix=api_prefix)
 PeopleView.register(app, route_prefix=api_prefix)
 RecentCheckoutsView.register(app, route_prefix=api_prefix)
-
-# Register models
-register_models(models)
+app.add_url_rule("/metrics", view_func=prometheus_metrics)
 
 if __name__ == '__main__':
+    init_db(app)
+    CheckoutIndex(models.item).rebuild()
     app.run(port=5000)
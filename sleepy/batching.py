@@ -0,0 +1,165 @@
+'''Group commit for the single-item write endpoints.
+
+With ``GROUP_COMMIT = True``, ``PUT /items/<id>`` and ``POST /items/`` don't
+each commit their own transaction. The first request to arrive waits up to
+``GROUP_COMMIT_WINDOW`` seconds (2ms by default) for others. Then it writes
+all their rows in one transaction, the same way the bulk endpoints do, and
+commits once. Each request is answered with its own row's result, and only
+after the commit, so an acknowledged write is as durable as before.
+
+If writing a batch fails, its rows are written again one at a time, so a
+bad row only fails its own request. The exception is where a failed write
+may have been partly applied (Mongo has no transactions): there, every
+request in the batch fails.
+
+A request that joins a batch waits at most ``GROUP_COMMIT_TIMEOUT`` seconds
+(30 by default) for it, then gets a 503. If its row hadn't been taken into
+a batch yet, it won't be written; otherwise it may still be. The same goes
+for every request in a batch whose writer is killed before it's done (e.g.
+by a gevent ``Timeout``).
+'''
+import threading
+from timeit import default_timer
+
+from flask import request, abort, current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+from bulk import MAX_BULK_SIZE
+from encoding import jsonify
+
+DEFAULT_WINDOW = 0.002  # seconds
+DEFAULT_TIMEOUT = 30  # seconds
+
+
+def group_commit_enabled():
+    return current_app.config.get('GROUP_COMMIT', False)
+
+
+class _Waiter(object):
+    '''A submitted row, and its result once the batch is written.'''
+
+    def __init__(self, row):
+        self.row = row
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    '''Collects the rows that concurrent requests submit and writes them
+    together with ``apply``.
+
+    :param apply: Function that writes a list of rows in one transaction
+        and returns a result per row, as :func:`bulk.bulk_results` does.
+    :param rollback: Function to call if ``apply`` fails.
+    :param bool retry: Whether to write the rows of a failed batch again,
+        one at a time. Only safe if a failed ``apply`` writes nothing.
+    '''
+
+    def __init__(self, apply, rollback=None, retry=True):
+        self.apply = apply
+        self.rollback = rollback
+        self.retry = retry
+        self._pending = []
+        self._leading = False
+        self._arrived = threading.Condition()
+        # Batches are written one at a time; the next one fills up meanwhile
+        self._writing = threading.Lock()
+
+    def submit(self, row):
+        '''Return the result of writing ``row``, once it's committed.
+        Raises what writing it raised.
+        '''
+        window = current_app.config.get('GROUP_COMMIT_WINDOW', DEFAULT_WINDOW)
+        timeout = current_app.config.get('GROUP_COMMIT_TIMEOUT', DEFAULT_TIMEOUT)
+        max_rows = current_app.config.get('MAX_BULK_SIZE', MAX_BULK_SIZE)
+        waiter = _Waiter(row)
+        with self._arrived:
+            self._pending.append(waiter)
+            leader = not self._leading
+            self._leading = True
+            if len(self._pending) >= max_rows:
+                self._arrived.notify()
+        if leader:
+            self._lead(window, max_rows)
+        elif not waiter.done.wait(timeout):
+            with self._arrived:
+                if waiter in self._pending:
+                    self._pending.remove(waiter)
+            abort(503)
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    def _lead(self, window, max_rows):
+        '''Wait for the batch to fill up, then write it. Whatever happens,
+        every request in the batch is answered.
+        '''
+        batch = []
+        try:
+            deadline = default_timer() + window
+            with self._arrived:
+                try:
+                    while len(self._pending) < max_rows:
+                        remaining = deadline - default_timer()
+                        if remaining <= 0:
+                            break
+                        self._arrived.wait(remaining)
+                finally:
+                    batch, self._pending = self._pending, []
+                    self._leading = False
+            with self._writing:
+                try:
+                    results = self._write([waiter.row for waiter in batch])
+                except Exception as error:
+                    results = [error] * len(batch)
+            for waiter, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    waiter.error = result
+                else:
+                    waiter.result = result
+                waiter.done.set()
+        finally:
+            # Killed before the results were in (e.g. by a gevent Timeout)
+            for waiter in batch:
+                if not waiter.done.is_set():
+                    waiter.error = ServiceUnavailable()
+                    waiter.done.set()
+
+    def _write(self, rows):
+        '''Return the results of writing ``rows``, or the exception that
+        writing each one raised.
+        '''
+        try:
+            return self.apply(rows)
+        except Exception:
+            if self.rollback is not None:
+                self.rollback()
+            if not self.retry or len(rows) == 1:
+                raise
+        results = []
+        for row in rows:
+            try:
+                results.extend(self._write([row]))
+            except Exception as error:
+                results.append(error)
+        return results
+
+
+def submit_row(commit, **fields):
+    '''Submit the request's JSON object, with ``fields`` set, to ``commit``
+    and return its result. Aborts with a 400 if the body isn't an object.
+    '''
+    row = request.json
+    if not isinstance(row, dict):
+        abort(400)
+    return commit.submit(dict(row, **fields))
+
+
+def row_response(result, key, message, status=200):
+    '''Return the response to a single-item write from its row's result,
+    or abort with the row's error status.
+    '''
+    if "error" in result:
+        abort(result["status"])
+    return jsonify({"message": message, key: result[key]}), status
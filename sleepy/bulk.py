@@ -0,0 +1,107 @@
+'''Helpers for the bulk endpoints common to all apps.
+
+``POST``, ``PUT`` and ``DELETE`` on ``/<resource>/bulk`` take a JSON array
+of rows (or of ids, for ``DELETE``), apply it in one transaction and return
+a result per row, in order.
+'''
+from flask import request, abort, current_app
+
+from encoding import jsonify
+
+MAX_BULK_SIZE = 1000
+
+
+def get_bulk_rows():
+    '''Return the JSON array in the request body. Aborts with a 400 if the
+    body isn't an array or has more than ``MAX_BULK_SIZE`` rows.
+    '''
+    rows = request.json
+    max_size = current_app.config.get('MAX_BULK_SIZE', MAX_BULK_SIZE)
+    if not isinstance(rows, list) or len(rows) > max_size:
+        abort(400)
+    return rows
+
+
+def get_row_ids(rows):
+    '''Return the ``id`` of each row that is an object.'''
+    return [row.get('id') for row in rows if isinstance(row, dict)]
+
+
+def parse_id(value):
+    '''Return the integer id in ``value``, as the SQL apps use, or ``None``
+    if it's empty. Clients may send ids as strings (the browser interface
+    does). Raises ValueError if ``value`` isn't an id.
+    '''
+    if not value:
+        return None
+    if isinstance(value, bool):
+        raise ValueError('Not an id: {0!r}'.format(value))
+    try:
+        return int(value)
+    except TypeError:
+        raise ValueError('Not an id: {0!r}'.format(value))
+
+
+def parse_ids(values):
+    '''Return the integer ids in ``values``, leaving out the empty ones and
+    those that aren't ids.
+    '''
+    ids = []
+    for value in values:
+        try:
+            id = parse_id(value)
+        except ValueError:
+            continue
+        if id is not None:
+            ids.append(id)
+    return ids
+
+
+def parse_row_id(row):
+    '''Return the integer ``id`` of ``row``, or ``None`` if the row isn't
+    an object or its id isn't one.
+    '''
+    if not isinstance(row, dict):
+        return None
+    ids = parse_ids([row.get('id')])
+    return ids[0] if ids else None
+
+
+def row_error(status, message):
+    return {"status": status, "error": message}
+
+
+def row_result(data, key, status=200):
+    '''Return the result of a row whose object was written and serialized
+    as ``data``. Rows that update the same object serialize it as soon as
+    it's written, so that each gets the state it wrote.
+    '''
+    return {"status": status, key: data}
+
+
+def bulk_results(results, serialize=None, key=None, status=200):
+    '''Return the per-row results of a bulk request, ready to be sent.
+
+    :param list results: One entry per row, either an error built with
+        :func:`row_error`, a result built with :func:`row_result` or the
+        object that was written.
+    :param serialize: Function that serializes a written object.
+    :param str key: Key for the serialized object in each result.
+    :param int status: Status for each written object.
+    '''
+    data = []
+    for result in results:
+        if isinstance(result, dict):
+            data.append(result)
+        elif serialize is None:
+            data.append({"status": status, "id": result})
+        else:
+            data.append(row_result(serialize(result), key, status))
+    return data
+
+
+def bulk_response(results, serialize=None, key=None, status=200):
+    '''Return the response to a bulk request. Takes the arguments of
+    :func:`bulk_results`.
+    '''
+    return jsonify({"results": bulk_results(results, serialize, key, status)})
@@ -0,0 +1,253 @@
+'''Read-through cache for single-resource GETs, common to all apps.
+
+Each app keeps a module-level ``ResourceCache`` that stores the serialized
+JSON of ``/items/<id>`` and ``/people/<id>`` under
+``(backend, resource, id)``. Write handlers invalidate the entries they
+change, including the owning person's entry when an item changes, since
+``n_items`` is part of a person's JSON. Responses carry a hash of the
+cached body as their ETag, so ``If-None-Match`` is answered with a 304
+straight from the cache.
+
+The store is picked by the app's config:
+
+- ``CACHE_TYPE``: ``"redis"`` (shared), ``"lru"`` (in-process) or ``"null"``
+  (no caching). The default is ``"redis"`` if ``CACHE_REDIS_URL`` or
+  ``CACHE_REDIS_CLIENT`` is set, and ``"null"`` otherwise. Only the process
+  that handles a write drops its LRU entries, so under several server
+  workers the others would serve stale resources until they expire; use
+  ``"lru"`` only with a single process.
+- ``CACHE_MAX_SIZE`` and ``CACHE_TTL``: entries and seconds.
+- ``CACHE_REDIS_URL``, or ``CACHE_REDIS_CLIENT`` for any object with the
+  ``get``/``setex``/``delete``/``keys`` methods of a redis client, such as
+  ``DictClient``.
+'''
+import fnmatch
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from encoding import jsonify
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 60  # seconds
+
+
+class CacheStats(object):
+    '''Hit, miss and eviction counters.'''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def as_dict(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class NullCache(object):
+    '''A store that never holds anything.'''
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key):
+        self.stats.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(object):
+    '''An in-process, thread-safe LRU cache whose entries expire after
+    ``ttl`` seconds. Expired and least recently used entries both count as
+    evictions.
+    '''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(object):
+    '''A cache shared between processes, backed by a redis client. Redis
+    expires and evicts entries itself, so ``evictions`` stays at 0.
+    '''
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix="sleepy:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = CacheStats()
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, value)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = self.client.keys(self.prefix + "*")
+        if keys:
+            self.client.delete(*keys)
+
+
+class DictClient(object):
+    '''A dict-backed stand-in for a redis client, for running the shared
+    cache without a redis server. TTLs are ignored.
+    '''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def setex(self, name, time, value):
+        self.data[name] = value
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def keys(self, pattern="*"):
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+
+def default_cache_type(config):
+    '''Return the ``CACHE_TYPE`` to use when it isn't set: the shared store
+    if one is configured, no caching otherwise.
+    '''
+    if config.get('CACHE_REDIS_URL') or config.get('CACHE_REDIS_CLIENT'):
+        return 'redis'
+    return 'null'
+
+
+def make_store(config):
+    '''Return the store configured by an app's ``CACHE_*`` settings.'''
+    cache_type = config.get('CACHE_TYPE', default_cache_type(config))
+    ttl = config.get('CACHE_TTL', DEFAULT_TTL)
+    if cache_type == 'null':
+        return NullCache()
+    if cache_type == 'redis':
+        client = config.get('CACHE_REDIS_CLIENT')
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(
+                config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+        return RedisCache(client, ttl=ttl)
+    if cache_type == 'lru':
+        return LRUCache(config.get('CACHE_MAX_SIZE', DEFAULT_MAX_SIZE), ttl=ttl)
+    raise ValueError('Unknown CACHE_TYPE: {0!r}'.format(cache_type))
+
+
+class ResourceCache(object):
+    '''Caches serialized resources for one backend.
+
+    :param str backend: Name of the backend, used in every key so that
+        apps can share a redis store.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def store(self):
+        '''The current app's store, created on first use.'''
+        extensions = current_app.extensions
+        if 'sleepy_cache' not in extensions:
+            extensions['sleepy_cache'] = make_store(current_app.config)
+        return extensions['sleepy_cache']
+
+    def key(self, resource, id):
+        return "{0}:{1}:{2}".format(self.backend, resource, id)
+
+    def response(self, resource, id, load, cached=True):
+        '''Return a JSON response for a resource, calling ``load()`` for its
+        serialized data on a miss. ``load`` may abort, e.g. with a 404, in
+        which case nothing is cached. Answers a matching ``If-None-Match``
+        with a 304.
+
+        :param bool cached: If False, always call ``load()`` and don't store
+            the result, e.g. for a partial representation.
+        '''
+        key = self.key(resource, id)
+        body = self.store.get(key) if cached else None
+        if body is None:
+            body = jsonify(load()).get_data()
+            if cached:
+                self.store.set(key, body)
+        response = Response(body, mimetype='application/json')
+        # The body is the whole entity, so its hash is a strong validator
+        response.set_etag(hashlib.sha1(body).hexdigest())
+        return response.make_conditional(request)
+
+    def invalidate(self, resource, *ids):
+        '''Drop the entries for ``ids``, ignoring any that are ``None``.'''
+        keys = [self.key(resource, id) for id in set(ids) if id is not None]
+        self.store.delete(*keys)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        '''Return the store's hit, miss and eviction counters.'''
+        return self.store.stats.as_dict()
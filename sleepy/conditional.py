@@ -0,0 +1,40 @@
+'''Conditional GET support common to all apps.
+
+List endpoints describe the state of the rows they return with a cheap
+aggregate, e.g. ``(count(items), max(items.updated))``. That state (plus the
+request's path and query string) hashes to a strong ETag, so
+``If-None-Match`` can be answered with a 304 before the list is queried or
+serialized.
+
+No ``Last-Modified`` is sent: deleting a row doesn't move the newest
+timestamp, and HTTP dates drop the fraction of a second, so
+``If-Modified-Since`` would get a 304 for a listing that has changed.
+'''
+import hashlib
+
+from flask import request, current_app
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*state):
+    '''Return a strong ETag for the current request given the state of the
+    rows it reads.
+    '''
+    raw = repr((request.full_path,) + state)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def conditional(build, state):
+    '''Return a 304 if the client's copy matches ``state``, otherwise the
+    response returned by ``build()``, with ``ETag`` set.
+
+    :param build: Function that returns the full response.
+    :param tuple state: Values that change whenever the response would.
+    '''
+    etag = make_etag(*state)
+    if not is_resource_modified(request.environ, etag=etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(build())
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,50 @@
+'''Stored item counts common to all apps.
+
+A person's ``n_items`` is counted from their items whenever it's read. With
+``STORED_ITEM_COUNTS = True``, the apps read it from the person's
+``item_count`` instead, which the item views keep up to date. Whenever an
+item is added, deleted or moved to another person, the counts of the people
+it left and joined are incremented or decremented along with it: in the
+same transaction in the SQL apps, and in the same update as the change to
+the person's ``items`` (with ``$inc``) in the Mongo app. The Redis app
+sends a ``HINCRBY`` per person in a ``MULTI`` right after the item's own,
+since stdnet doesn't let other commands into its transactions.
+
+Counts kept while the setting was off, or written by anything but the item
+views, can drift. Each app's ``reconcile_item_counts`` recounts every
+person's items in bulk and fixes the counts that are wrong::
+
+    $ python -m sleepy.reconcile --backend sqlalchemy
+
+The SQL apps always map ``item_count``, so a database created before it
+existed needs the column. Each SQL app's ``add_item_count_column`` adds it
+with ``ADD_ITEM_COUNT_COLUMN`` if it's missing. Creating the schema (the
+apps' ``__main__``, ``sleepy.server``) and reconciling both do that first.
+'''
+from flask import current_app
+
+ADD_ITEM_COUNT_COLUMN = ("ALTER TABLE {0} ADD COLUMN item_count INTEGER "
+                            "NOT NULL DEFAULT 0")
+
+
+def stored_item_counts():
+    '''Return whether the current app reads and keeps stored item counts.'''
+    return current_app.config.get('STORED_ITEM_COUNTS', False)
+
+
+def count_changes(old_ids=(), new_ids=()):
+    '''Return a dict mapping each change in item count to the ids of the
+    people whose count changes by it, when items leave the people
+    ``old_ids`` and join the people ``new_ids``. An id is listed once per
+    item, and ``None`` (no person) is skipped.
+    '''
+    deltas = {}
+    for ids, step in ((old_ids, -1), (new_ids, 1)):
+        for id in ids:
+            if id is not None:
+                deltas[id] = deltas.get(id, 0) + step
+    changes = {}
+    for id, delta in deltas.items():
+        if delta:
+            changes.setdefault(delta, []).append(id)
+    return changes
@@ -0,0 +1,91 @@
+'''JSON responses common to all apps.
+
+The apps use this module's ``jsonify`` instead of Flask's. Flask 0.10
+indents every response that isn't an XMLHttpRequest, and encodes through
+its ``JSONEncoder``. This ``jsonify`` only indents in debug mode. Otherwise
+it encodes compactly with the fastest encoder available and puts the
+encoded bytes straight into the response.
+
+``JSON_ENCODER`` chooses the encoder: ``"ujson"``, ``"simplejson"``,
+``"json"`` (the standard library's), or ``"auto"`` (the default) for the
+first of those that can be imported. The ``json`` and ``simplejson``
+encoders run their C speedups and write stray datetimes, UUIDs and so on
+the way Flask does. ``ujson`` would write datetimes as timestamps, so it's
+only for data the serializers have already formatted, which is all the
+apps send. orjson isn't among them because it needs Python 3, and this
+tree runs on Python 2, where ujson is the fastest of the three.
+'''
+from timeit import default_timer
+
+from flask import current_app, request, json as flask_json
+
+from instrument import record_serialization
+
+ENCODERS = ('ujson', 'simplejson', 'json')
+MIMETYPE = 'application/json'
+
+# Encoding functions by JSON_ENCODER setting
+_encoders = {}
+
+
+def _flask_default(obj):
+    # The base class's ``default``, which knows datetimes and UUIDs
+    return flask_json.JSONEncoder().default(obj)
+
+
+def load_encoder(name):
+    '''Return a function that encodes an object to compact JSON bytes with
+    the encoder ``name``. Raises ImportError if it isn't installed.
+    '''
+    if name == 'auto':
+        for name in ENCODERS:
+            try:
+                return load_encoder(name)
+            except ImportError:
+                continue
+    if name == 'ujson':
+        import ujson
+        return ujson.dumps
+    if name == 'simplejson':
+        import simplejson as module
+    elif name == 'json':
+        import json as module
+    else:
+        raise ValueError('Unknown JSON_ENCODER: {0!r}'.format(name))
+    return module.JSONEncoder(separators=(',', ':'),
+                                default=_flask_default).encode
+
+
+def get_encoder():
+    '''Return the current app's encoding function.'''
+    name = current_app.config.get('JSON_ENCODER', 'auto')
+    encode = _encoders.get(name)
+    if encode is None:
+        encode = _encoders[name] = load_encoder(name)
+    return encode
+
+
+def dumps(obj):
+    '''Encode ``obj`` with the current app's encoder, recording the time
+    with ``record_serialization``.
+    '''
+    encode = get_encoder()
+    start = default_timer()
+    try:
+        return encode(obj)
+    finally:
+        record_serialization(default_timer() - start)
+
+
+def jsonify(*args, **kwargs):
+    '''Return a JSON response for ``dict(*args, **kwargs)``, like Flask's
+    ``jsonify``.
+    '''
+    data = dict(*args, **kwargs)
+    if current_app.debug and not request.is_xhr:
+        start = default_timer()
+        body = flask_json.dumps(data, indent=2)
+        record_serialization(default_timer() - start)
+    else:
+        body = dumps(data)
+    return current_app.response_class(body, mimetype=MIMETYPE)
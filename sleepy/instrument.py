@@ -0,0 +1,168 @@
+'''Per-request query counts and database time, common to all apps.
+
+Each app hooks its driver so that every round trip to the database (a SQL
+statement, a Mongo message, a Redis command or pipeline) is passed to
+``record_query``. Each response then reports the request's share in a
+``Server-Timing`` header, e.g.::
+
+    Server-Timing: db;dur=3.20;desc="4 queries", app;dur=5.10
+
+``GET /api/v1/queries`` reports, per route and method, the number of
+requests, the queries and database time per request and the slowest
+statement seen. A streaming response runs most of its queries after its
+headers are sent. Those queries count towards the route's totals, but
+not towards the header.
+
+The time spent serializing (marshalling and JSON encoding) is recorded
+the same way, with ``record_serialization``, and reported with the
+database time by the ``/metrics`` endpoint (see ``metrics.py``).
+'''
+import threading
+from timeit import default_timer
+
+from flask import g, request
+
+# Longest statement kept as a route's slowest
+MAX_STATEMENT_LENGTH = 300
+
+
+class RequestQueries(object):
+    '''The queries of one request.'''
+    __slots__ = ('count', 'seconds', 'slowest', 'slowest_statement',
+                'serialize_seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.serialize_seconds = 0.0
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds >= self.slowest:
+            self.slowest = seconds
+            self.slowest_statement = statement
+
+
+# The current request's queries, if the thread (or greenlet) is handling
+# one. Cheaper to look up than ``g``.
+_current = threading.local()
+
+
+def record_query(statement, seconds):
+    '''Count a query that took ``seconds`` towards the current request, if
+    there is one.
+    '''
+    queries = getattr(_current, 'queries', None)
+    if queries is not None:
+        queries.add(statement, seconds)
+
+
+def record_serialization(seconds):
+    '''Count ``seconds`` of serializing towards the current request, if
+    there is one.
+    '''
+    queries = getattr(_current, 'queries', None)
+    if queries is not None:
+        queries.serialize_seconds += seconds
+
+
+def timed(func, describe):
+    '''Return ``func``, recording each call with ``record_query``.
+    ``describe`` is called with the same arguments and returns the
+    statement to record, before ``func`` is.
+    '''
+    def timed_func(*args, **kwargs):
+        statement = describe(*args, **kwargs)
+        start = default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_query(statement, default_timer() - start)
+    timed_func.__name__ = func.__name__
+    timed_func.untimed = func
+    return timed_func
+
+
+def time_method(owner, name, describe):
+    '''Replace ``owner.name`` with a :func:`timed` version, once.'''
+    method = getattr(owner, name)
+    if not hasattr(method, 'untimed'):
+        setattr(owner, name, timed(method, describe))
+
+
+class QueryStats(object):
+    '''Query counts and database time per route.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+    def record(self, route, queries):
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {"requests": 0, "queries": 0,
+                    "seconds": 0.0, "slowest": 0.0, "slowest_statement": None}
+            stats["requests"] += 1
+            stats["queries"] += queries.count
+            stats["seconds"] += queries.seconds
+            if queries.slowest_statement is not None and \
+                    queries.slowest >= stats["slowest"]:
+                stats["slowest"] = queries.slowest
+                stats["slowest_statement"] = \
+                    queries.slowest_statement[:MAX_STATEMENT_LENGTH]
+
+    def as_dict(self):
+        with self._lock:
+            return dict((route, {
+                "requests": s["requests"],
+                "queries_per_request": float(s["queries"]) / s["requests"],
+                "db_ms_per_request": s["seconds"] * 1e3 / s["requests"],
+                "slowest_ms": s["slowest"] * 1e3,
+                "slowest_statement": s["slowest_statement"],
+            }) for route, s in self._routes.items())
+
+
+def instrument(app, stats, metrics=None):
+    '''Time the queries of each of ``app``'s requests, adding them up in
+    ``stats``, and record each request in ``metrics``, a
+    :class:`metrics.RequestMetrics`, if given.
+    '''
+    @app.before_request
+    def start_timing():
+        g._queries = _current.queries = RequestQueries()
+        g._started = default_timer()
+        if metrics is not None:
+            metrics.start()
+
+    @app.after_request
+    def add_server_timing(response):
+        queries = getattr(g, '_queries', None)
+        if queries is not None:
+            response.headers['Server-Timing'] = (
+                'db;dur={0:.2f};desc="{1} queries", app;dur={2:.2f}'.format(
+                queries.seconds * 1e3, queries.count,
+                (default_timer() - g._started) * 1e3))
+            g._status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_timing(exc):
+        queries = getattr(g, '_queries', None)
+        if queries is None:
+            return
+        _current.queries = None
+        rule = request.url_rule.rule if request.url_rule is not None else ""
+        if rule:
+            stats.record("{0} {1}".format(request.method, rule), queries)
+        if metrics is not None:
+            # Unhandled exceptions skip after_request
+            metrics.finish(request.method, rule, getattr(g, '_status', 500),
+                            default_timer() - g._started, queries)
@@ -0,0 +1,211 @@
+'''Prometheus metrics common to all apps.
+
+``GET /metrics`` serves, in Prometheus' text format:
+
+- ``sleepy_requests_total``: requests by method, route and status.
+- ``sleepy_request_duration_seconds``: a latency histogram per method and
+  route.
+- ``sleepy_requests_in_flight``: requests being handled.
+- ``sleepy_db_seconds_total``, ``sleepy_db_queries_total`` and
+  ``sleepy_serialization_seconds_total``: where each route's time went, as
+  recorded by ``instrument.py``.
+- ``sleepy_cache_*``: the cache's hits, misses and evictions.
+- ``sleepy_pool_*``: for the SQL apps, the connection pool counters served
+  at ``/api/v1/pool``.
+
+Counts are per process, so with several workers each one must be scraped.
+
+Recording a request takes no lock: it appends a tuple to a deque, which is
+atomic. The tuples are added to the totals when the metrics are read, or
+by whichever request finds more than ``MAX_PENDING`` of them waiting.
+'''
+import threading
+from bisect import bisect_left
+from collections import deque
+
+from flask import Response
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+            2.5, 5.0, 10.0)
+# Requests recorded before they're added up without waiting for a scrape
+MAX_PENDING = 10000
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (name, type, help) of the counters in ``CacheStats.as_dict``
+CACHE_METRICS = {
+    "hits": ("sleepy_cache_hits_total", "counter", "Cache hits."),
+    "misses": ("sleepy_cache_misses_total", "counter", "Cache misses."),
+    "evictions": ("sleepy_cache_evictions_total", "counter",
+                    "Cache entries evicted or expired."),
+}
+# And in ``PoolStats.as_dict``
+POOL_METRICS = {
+    "checkouts": ("sleepy_pool_checkouts_total", "counter",
+                    "Connections checked out of the pool."),
+    "timeouts": ("sleepy_pool_timeouts_total", "counter",
+                    "Checkouts that gave up waiting."),
+    "wait_ms_avg": ("sleepy_pool_wait_milliseconds_avg", "gauge",
+                    "Average wait for a connection."),
+    "wait_ms_max": ("sleepy_pool_wait_milliseconds_max", "gauge",
+                    "Longest wait for a connection."),
+    "in_use": ("sleepy_pool_connections_in_use", "gauge",
+                "Connections checked out."),
+    "peak_in_use": ("sleepy_pool_connections_in_use_max", "gauge",
+                    "Most connections checked out at once."),
+}
+
+
+class RouteTotals(object):
+    '''The requests of one method and route.'''
+    __slots__ = ('buckets', 'count', 'seconds', 'db_seconds', 'queries',
+                'serialize_seconds')
+
+    def __init__(self, n_buckets):
+        # Not cumulative; the last one is for slower requests than any bound
+        self.buckets = [0] * (n_buckets + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.serialize_seconds = 0.0
+
+
+class RequestMetrics(object):
+    '''Request counts and latencies per route, for one app.'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = tuple(buckets)
+        self._pending = deque()
+        self._adding = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._adding:
+            self._pending.clear()
+            self._started = 0
+            self._finished = 0
+            self._statuses = {}  # (method, route, status) -> requests
+            self._routes = {}  # (method, route) -> RouteTotals
+
+    def start(self):
+        '''Record that a request has started.'''
+        self._pending.append(None)
+
+    def finish(self, method, route, status, seconds, queries=None):
+        '''Record a request that took ``seconds``. ``queries`` is its
+        :class:`instrument.RequestQueries`.
+        '''
+        pending = self._pending
+        pending.append((method, route, status, seconds, queries))
+        if len(pending) > MAX_PENDING and self._adding.acquire(False):
+            try:
+                self._add_pending()
+            finally:
+                self._adding.release()
+
+    def _add_pending(self):
+        pending = self._pending
+        # Only those already waiting, so that busy threads can't keep a
+        # scrape going
+        for _ in range(len(pending)):
+            request = pending.popleft()
+            if request is None:
+                self._started += 1
+                continue
+            method, route, status, seconds, queries = request
+            self._finished += 1
+            key = (method, route, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+            totals = self._routes.get(key[:2])
+            if totals is None:
+                totals = self._routes[key[:2]] = RouteTotals(len(self.bounds))
+            totals.buckets[bisect_left(self.bounds, seconds)] += 1
+            totals.count += 1
+            totals.seconds += seconds
+            if queries is not None:
+                totals.db_seconds += queries.seconds
+                totals.queries += queries.count
+                totals.serialize_seconds += queries.serialize_seconds
+
+    def render(self, cache=None, pool=None):
+        '''Return the metrics in Prometheus' text format, with the cache's
+        and pool's counters, as returned by ``ResourceCache.stats`` and
+        ``PoolStats.as_dict``, if given.
+        '''
+        with self._adding:
+            self._add_pending()
+            lines = []
+            header(lines, "sleepy_requests_total", "counter",
+                    "Requests handled.")
+            for (method, route, status), count in sorted(
+                    self._statuses.items()):
+                sample(lines, "sleepy_requests_total", count, method=method,
+                        route=route, status=status)
+            header(lines, "sleepy_requests_in_flight", "gauge",
+                    "Requests being handled.")
+            sample(lines, "sleepy_requests_in_flight",
+                    self._started - self._finished)
+            routes = sorted(self._routes.items())
+            self._render_histogram(lines, routes)
+            for name, attr, kind, help in (
+                    ("sleepy_db_seconds_total", 'db_seconds', "counter",
+                        "Time spent in database round trips."),
+                    ("sleepy_db_queries_total", 'queries', "counter",
+                        "Database round trips."),
+                    ("sleepy_serialization_seconds_total",
+                        'serialize_seconds', "counter",
+                        "Time spent marshalling and encoding JSON.")):
+                header(lines, name, kind, help)
+                for (method, route), totals in routes:
+                    sample(lines, name, getattr(totals, attr), method=method,
+                            route=route)
+        for stats, metrics in ((cache, CACHE_METRICS), (pool, POOL_METRICS)):
+            if stats is None:
+                continue
+            for key, value in sorted(stats.items()):
+                if key in metrics:
+                    name, kind, help = metrics[key]
+                    header(lines, name, kind, help)
+                    sample(lines, name, value)
+        lines.append("")
+        return "\n".join(lines)
+
+    def _render_histogram(self, lines, routes):
+        name = "sleepy_request_duration_seconds"
+        header(lines, name, "histogram", "Request latency.")
+        bounds = [repr(float(bound)) for bound in self.bounds] + ["+Inf"]
+        for (method, route), totals in routes:
+            cumulative = 0
+            for bound, count in zip(bounds, totals.buckets):
+                cumulative += count
+                sample(lines, name + "_bucket", cumulative, method=method,
+                        route=route, le=bound)
+            sample(lines, name + "_sum", totals.seconds, method=method,
+                    route=route)
+            sample(lines, name + "_count", totals.count, method=method,
+                    route=route)
+
+
+def header(lines, name, kind, help):
+    lines.append("# HELP {0} {1}".format(name, help))
+    lines.append("# TYPE {0} {1}".format(name, kind))
+
+
+def escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def sample(lines, name, value, **labels):
+    if labels:
+        name += "{" + ",".join('{0}="{1}"'.format(label, escape(labels[label]))
+                                for label in sorted(labels)) + "}"
+    # repr for every digit of a float, str for an int (no "L")
+    value = repr(value) if isinstance(value, float) else str(value)
+    lines.append("{0} {1}".format(name, value))
+
+
+def metrics_response(metrics, cache=None, pool=None):
+    '''Return a response with the text of ``metrics.render``.'''
+    return Response(metrics.render(cache, pool), content_type=CONTENT_TYPE)
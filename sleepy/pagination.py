@@ -0,0 +1,61 @@
+'''Keyset (cursor) pagination common to all apps.
+
+List endpoints accept ``?limit=`` and an opaque ``?after=`` cursor. The
+cursor encodes the ``(timestamp, id)`` of the last row on the previous page,
+so each app can turn it into a range scan instead of an OFFSET.
+'''
+import base64
+import json
+from datetime import datetime
+
+from flask import request, abort, current_app
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+CURSOR_DATEFORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(timestamp, id):
+    '''Return an opaque cursor for a ``(timestamp, id)`` pair.'''
+    raw = json.dumps([timestamp.strftime(CURSOR_DATEFORMAT), id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Return the ``(timestamp, id)`` pair for a cursor. Aborts with a 400 if
+    the cursor is malformed.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+        timestamp, id = json.loads(raw)
+        return datetime.strptime(timestamp, CURSOR_DATEFORMAT), id
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def get_page_args():
+    '''Return ``(limit, after)`` from the request's query string, where
+    ``after`` is ``None`` or a decoded ``(timestamp, id)`` pair.
+    '''
+    default = current_app.config.get('PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    limit = request.args.get('limit', default, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, current_app.config.get('MAX_PAGE_SIZE', MAX_PAGE_SIZE))
+    cursor = request.args.get('after')
+    after = decode_cursor(cursor) if cursor else None
+    return limit, after
+
+
+def paginate(rows, limit, key):
+    '''Split up to ``limit + 1`` fetched rows into ``(page, next_cursor)``.
+
+    :param rows: Iterable of results, fetched with a limit of ``limit + 1``.
+    :param int limit: The page size.
+    :param key: Function that returns the ``(timestamp, id)`` of a row.
+    '''
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(*key(page[-1]))
@@ -0,0 +1,204 @@
+'''Connection pool settings and metrics common to the SQL apps.
+
+The SQLAlchemy, Peewee and Pony apps read the same settings from their
+config:
+
+- ``DB_POOL_SIZE``: connections kept open between requests.
+- ``DB_POOL_MAX_OVERFLOW``: extra connections opened under load, and closed
+  when they're returned (``-1`` for no limit).
+- ``DB_POOL_TIMEOUT``: seconds a checkout waits for a free connection
+  before giving up.
+- ``DB_POOL_RECYCLE``: seconds after which a connection is reopened on
+  checkout (``-1`` never).
+- ``DB_POOL_PRE_PING``: test each connection with ``SELECT 1`` on checkout
+  and reopen it if that fails.
+
+A request checks a connection out on its first query and returns it when
+it ends. Each app's ``pool_stats`` records how long checkouts wait, so
+that ``DB_POOL_SIZE`` can be sized for the server's thread count; they're
+served at ``/api/v1/pool``. Pony keeps one connection per thread, so only
+the last two settings apply to it.
+'''
+import threading
+import time
+from timeit import default_timer
+
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_POOL_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 3600,
+    'DB_POOL_PRE_PING': False,
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def pool_options(config):
+    '''Return the ``DB_POOL_*`` settings of an app's config, with defaults
+    for the missing ones, as keyword arguments for ``ConnectionPool``, e.g.
+    ``{"size": 5, "max_overflow": 10, ...}``.
+    '''
+    return dict((key[len('DB_POOL_'):].lower(), config.get(key, default))
+                for key, default in POOL_DEFAULTS.items())
+
+
+def ping(conn):
+    '''Return whether a DB-API connection still works.'''
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+class PoolStats(object):
+    '''Checkout and wait-time counters for a connection pool. Times are in
+    seconds; ``as_dict`` reports them in milliseconds.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.in_use = 0
+            self.peak_in_use = 0
+
+    def checkout(self, waited):
+        '''Record a checkout that waited ``waited`` seconds.'''
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def checkin(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def as_dict(self):
+        with self._lock:
+            average = self.wait_total / self.checkouts if self.checkouts else 0
+            return {"checkouts": self.checkouts,
+                    "timeouts": self.timeouts,
+                    "wait_ms_avg": average * 1e3,
+                    "wait_ms_max": self.wait_max * 1e3,
+                    "in_use": self.in_use,
+                    "peak_in_use": self.peak_in_use}
+
+
+class ConnectionPool(object):
+    '''A thread-safe pool of the DB-API connections returned by
+    ``connect()``, for drivers that don't have one. The other arguments are
+    those of ``pool_options``.
+    '''
+
+    def __init__(self, connect, size=5, max_overflow=10, timeout=30,
+                recycle=-1, pre_ping=False, stats=None):
+        self.connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.stats = stats or PoolStats()
+        self._idle = []  # (opened, connection), most recently returned last
+        self._opened = {}  # id(connection) -> time it was opened
+        self._open = 0
+        self._available = threading.Condition()
+
+    def _full(self):
+        return (self.max_overflow > -1 and
+                self._open >= self.size + self.max_overflow)
+
+    def checkout(self):
+        '''Return a connection, waiting up to ``timeout`` seconds for one to
+        be returned if the pool is at its limit.
+        '''
+        start = default_timer()
+        with self._available:
+            while not self._idle and self._full():
+                remaining = start + self.timeout - default_timer()
+                if remaining <= 0:
+                    self.stats.timeout()
+                    raise PoolTimeout("Connection pool of size {0} overflow "
+                        "{1} timed out after {2}s".format(
+                        self.size, self.max_overflow, self.timeout))
+                self._available.wait(remaining)
+            if self._idle:
+                opened, conn = self._idle.pop()
+            else:
+                opened, conn = None, None
+                self._open += 1
+        try:
+            if conn is not None and (self._expired(opened) or
+                                    self.pre_ping and not ping(conn)):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+                self._opened[id(conn)] = time.time()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+        self.stats.checkout(default_timer() - start)
+        return conn
+
+    def checkin(self, conn):
+        '''Return a connection, rolling back anything left uncommitted.'''
+        self.stats.checkin()
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._available:
+            if len(self._idle) < self.size:
+                self._idle.append((self._opened[id(conn)], conn))
+                self._available.notify()
+                return
+        self._discard(conn)
+
+    def dispose(self):
+        '''Close the idle connections.'''
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._available.notify_all()
+        for _, conn in idle:
+            self._close(conn)
+
+    def _expired(self, opened):
+        return self.recycle > -1 and time.time() - opened > self.recycle
+
+    def _close(self, conn):
+        self._opened.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        self._close(conn)
+        with self._available:
+            self._open -= 1
+            self._available.notify()
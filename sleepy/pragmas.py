@@ -0,0 +1,58 @@
+'''SQLite tuning common to the SQL apps.
+
+With ``SQLITE_TUNING = True`` in an app's config, every SQLite connection
+the app opens runs ``TUNED_PRAGMAS`` first:
+
+- ``journal_mode=WAL`` lets readers carry on while a writer commits,
+  instead of blocking behind the rollback journal.
+- ``synchronous=NORMAL`` syncs at checkpoints rather than on every commit.
+  This is safe in WAL mode, though a power cut can lose the last commits.
+- ``mmap_size`` and ``cache_size`` keep more of the file in memory.
+- ``busy_timeout`` makes a writer wait for the lock rather than fail with
+  "database is locked". Python's sqlite3 waits 5s by default too, but
+  not every driver does.
+- ``temp_store=MEMORY`` keeps temporary tables and indexes in memory.
+
+Individual values can be overridden with ``SQLITE_PRAGMAS``, e.g.
+``{"mmap_size": 0}``. ``SQLITE_CACHED_STATEMENTS`` sets the size of the
+driver's prepared statement cache, where the app can pass it on.
+'''
+TUNED_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),  # In KiB when negative
+    ('busy_timeout', 5000),  # ms
+    ('temp_store', 'MEMORY'),
+)
+DEFAULT_CACHED_STATEMENTS = 100  # sqlite3's own default
+
+
+def sqlite_pragmas(config):
+    '''Return the ``(name, value)`` pragmas to run on each new connection
+    for an app's config, which are none unless ``SQLITE_TUNING`` is on.
+    '''
+    if not config.get('SQLITE_TUNING', False):
+        return ()
+    overrides = config.get('SQLITE_PRAGMAS') or {}
+    return tuple((name, overrides.get(name, value))
+                for name, value in TUNED_PRAGMAS)
+
+
+def cached_statements(config):
+    '''Return the ``cached_statements`` argument for ``sqlite3.connect``.'''
+    if not config.get('SQLITE_TUNING', False):
+        return DEFAULT_CACHED_STATEMENTS
+    return config.get('SQLITE_CACHED_STATEMENTS', DEFAULT_CACHED_STATEMENTS)
+
+
+def apply_pragmas(conn, pragmas):
+    '''Run ``pragmas`` on a DB-API connection.'''
+    if not pragmas:
+        return
+    cursor = conn.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute("PRAGMA {0} = {1}".format(name, value))
+    finally:
+        cursor.close()
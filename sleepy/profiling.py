@@ -0,0 +1,187 @@
+'''Sampling profiles of individual requests, common to all apps.
+
+With ``PROFILING = True``, a ``PROFILE_RATE`` fraction of requests (none by
+default), and any request with a ``X-Sleepy-Profile`` header, is profiled:
+while it's handled, and while its body is written, another thread samples
+its stack every ``PROFILE_INTERVAL`` seconds (1ms by default). Each sample
+is put down to the phase of the innermost frame it recognizes:
+
+- ``query``: the database driver, or the ORM sending a statement.
+- ``hydration``: the rest of the ORM, e.g. building instances from rows.
+- ``serialization``: marshmallow and the compiled serializers.
+- ``json``: encoding the response.
+- ``app``: anything else, e.g. the views and Flask.
+
+The last ``PROFILE_HISTORY`` profiles are served at ``/admin/profiles``,
+newest first, with the time in each phase and the most sampled functions
+and stacks.
+
+Stacks are sampled with ``sys._current_frames``, which only sees OS
+threads, so requests can't be profiled under the gevent worker.
+'''
+import random
+import sys
+import threading
+import time
+from collections import deque
+from timeit import default_timer
+
+from werkzeug.wsgi import ClosingIterator
+
+PROFILE_HEADER = 'HTTP_X_SLEEPY_PROFILE'
+DEFAULT_INTERVAL = 0.001  # seconds
+DEFAULT_HISTORY = 50
+# Functions and stacks kept per profile
+TOP_FUNCTIONS = 20
+TOP_STACKS = 20
+PHASES = ('query', 'hydration', 'serialization', 'json', 'app')
+
+# Modules (and their submodules) by phase, most specific first
+PHASE_MODULES = (
+    ('query', ('sqlalchemy.engine', 'sqlalchemy.pool',
+                'pony.orm.dbapiprovider', 'pony.orm.dbproviders', 'pymongo',
+                'bson', 'redis', 'stdnet.backends', 'pools')),
+    ('hydration', ('sqlalchemy', 'flask_sqlalchemy', 'peewee', 'playhouse',
+                    'flask_peewee', 'pony', 'mongoengine', 'flask_mongoengine',
+                    'stdnet', 'rows')),
+    ('serialization', ('marshmallow', 'serializers')),
+    ('json', ('json', 'simplejson', 'flask.json')),
+)
+# Peewee is a single module
+QUERY_FUNCTIONS = frozenset(['execute_sql'])
+
+
+def frame_phase(frame):
+    '''Return the phase of a frame, or None if it's the app's.'''
+    code = frame.f_code
+    if code.co_name in QUERY_FUNCTIONS:
+        return 'query'
+    if code.co_filename.startswith('<compiled '):
+        return 'serialization'
+    module = frame.f_globals.get('__name__') or ''
+    if module.startswith('sleepy.'):
+        module = module[len('sleepy.'):]
+    for phase, prefixes in PHASE_MODULES:
+        for prefix in prefixes:
+            if module == prefix or module.startswith(prefix + '.'):
+                return phase
+    return None
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{0}:{1}({2})".format(frame.f_globals.get('__name__', '?'),
+                                    code.co_firstlineno, code.co_name)
+
+
+class Sampler(threading.Thread):
+    '''Samples the stack of the thread ``ident`` until stopped.'''
+
+    def __init__(self, ident, interval):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.target = ident
+        self.interval = interval
+        self.samples = 0
+        self.phases = dict.fromkeys(PHASES, 0)
+        self.functions = {}  # innermost frame -> samples
+        self.stacks = {}  # "outer;...;inner" -> samples
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.sample(frame)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def sample(self, frame):
+        self.samples += 1
+        phase = None
+        names = []
+        while frame is not None:
+            if phase is None:
+                phase = frame_phase(frame)
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        self.phases[phase or 'app'] += 1
+        self.functions[names[0]] = self.functions.get(names[0], 0) + 1
+        stack = ";".join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+def most_sampled(counts, n):
+    return [{"name": name, "samples": samples} for name, samples in
+            sorted(counts.items(), key=lambda item: -item[1])[:n]]
+
+
+class RequestProfiler(object):
+    '''WSGI middleware that profiles some of an app's requests.
+
+    :param app: The Flask app, for its settings.
+    :param wsgi_app: The WSGI application to wrap, e.g. ``app.wsgi_app``.
+    '''
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.profiles = deque(maxlen=DEFAULT_HISTORY)
+
+    def wants_profile(self, environ):
+        config = self.app.config
+        if not config.get('PROFILING', False):
+            return False
+        return (PROFILE_HEADER in environ or
+                random.random() < config.get('PROFILE_RATE', 0.0))
+
+    def __call__(self, environ, start_response):
+        if not self.wants_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        interval = self.app.config.get('PROFILE_INTERVAL', DEFAULT_INTERVAL)
+        sampler = Sampler(threading.current_thread().ident, interval)
+        started = default_timer()
+        status = []
+
+        def start(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(None, 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            sampler.stop()
+            self.store(environ, status, default_timer() - started, sampler)
+
+        sampler.start()
+        try:
+            body = self.wsgi_app(environ, start)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+    def store(self, environ, status, seconds, sampler):
+        history = self.app.config.get('PROFILE_HISTORY', DEFAULT_HISTORY)
+        if self.profiles.maxlen != history:
+            # Newest first, so keep the first ones
+            self.profiles = deque(list(self.profiles)[:history],
+                                    maxlen=history)
+        ms_per_sample = seconds * 1e3 / max(sampler.samples, 1)
+        path = environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        self.profiles.appendleft({
+            "method": environ.get('REQUEST_METHOD'),
+            "path": path,
+            "status": status[0] if status else 500,
+            "started": time.time() - seconds,
+            "ms": seconds * 1e3,
+            "samples": sampler.samples,
+            # Each phase's share of the request's time
+            "phases_ms": dict((phase, count * ms_per_sample)
+                                for phase, count in sampler.phases.items()),
+            "functions": most_sampled(sampler.functions, TOP_FUNCTIONS),
+            "stacks": most_sampled(sampler.stacks, TOP_STACKS),
+        })
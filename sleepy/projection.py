@@ -0,0 +1,60 @@
+'''Field projection common to all apps.
+
+List and detail endpoints accept ``?fields=id,name`` to return only some of
+a resource's fields. Each app loads just the columns those fields read, and
+skips the join (or the extra query) for an item's ``person`` or a person's
+``n_items`` unless they're asked for.
+'''
+from flask import request, abort
+
+ITEM_FIELDS = ('id', 'name', 'checked_out', 'updated', 'person')
+PERSON_FIELDS = ('id', 'name', 'created', 'n_items')
+
+# The model attributes each serialized field reads. ``n_items`` is counted
+# with a separate query by the relational apps, unless they read the stored
+# ``item_count`` (see counts.py).
+ITEM_ATTRIBUTES = {
+    'id': ('id',),
+    'name': ('name',),
+    'checked_out': ('checked_out',),
+    'updated': ('updated',),
+    'person': ('person',),
+}
+PERSON_ATTRIBUTES = {
+    'id': ('id',),
+    'name': ('firstname', 'lastname'),
+    'created': ('created',),
+    'n_items': ('id', 'item_count'),
+}
+
+
+def get_fields(allowed):
+    '''Return the fields asked for with ``?fields=``, in the order of
+    ``allowed``, or ``None`` if the parameter wasn't given. Aborts with a 400
+    if a field is unknown or none are given.
+    '''
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    names = set(name.strip() for name in value.split(',') if name.strip())
+    if not names or not names.issubset(allowed):
+        abort(400)
+    return tuple(name for name in allowed if name in names)
+
+
+def wants(fields, name):
+    '''Return whether ``name`` is among the requested ``fields``.'''
+    return fields is None or name in fields
+
+
+def get_attributes(fields, attributes, always=()):
+    '''Return the model attributes needed to serialize ``fields``, plus
+    ``always`` (e.g. the columns a page's cursor is made of), or ``None`` if
+    every field was asked for.
+    '''
+    if fields is None:
+        return None
+    needed = list(always)
+    for name in fields:
+        needed.extend(attr for attr in attributes[name] if attr not in needed)
+    return tuple(needed)
@@ -0,0 +1,41 @@
+'''Repair the stored item counts of an app's people.
+
+    $ python -m sleepy.reconcile --backend sqlalchemy
+
+Recounts every person's items and fixes the ``item_count`` of those whose
+count is wrong (see ``counts.py``), e.g. before turning
+``STORED_ITEM_COUNTS`` on, or after items were written some other way.
+Takes the same settings as ``sleepy.server``, i.e. ``ProductionSettings``
+with the overrides in ``$SLEEPY_SETTINGS``.
+'''
+from __future__ import print_function
+import argparse
+import importlib
+import sys
+
+from sleepy import BACKENDS, configure_app
+from sleepy.server import production_settings
+
+
+def reconcile(backend):
+    '''Repair a backend's stored item counts. Returns the number of people
+    whose count was wrong.
+    '''
+    app = configure_app(backend, production_settings())
+    api = importlib.import_module('sleepy.api_' + backend)
+    with app.app_context():
+        return api.reconcile_item_counts()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=BACKENDS, default='sqlalchemy')
+    args = parser.parse_args(argv)
+
+    repaired = reconcile(args.backend)
+    print("Repaired the item counts of {0} people".format(repaired))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+'''Lightweight rows for read-only listings in the SQLAlchemy and Peewee apps.
+
+With ``RAW_ROWS = True`` in an app's config, the list endpoints select
+plain tuples of the columns they serialize and wrap them in ``ItemRow`` and
+``PersonRow`` records instead of hydrating (and identity-mapping) a model
+instance per row. The serializers read the same attributes from either.
+'''
+from flask import current_app
+
+from projection import (ITEM_FIELDS, PERSON_FIELDS, ITEM_ATTRIBUTES,
+                        PERSON_ATTRIBUTES, get_attributes)
+
+# The columns a nested person is serialized from, after an item's own
+PERSON_COLUMNS = ('id', 'firstname', 'lastname')
+
+
+def raw_rows():
+    '''Return whether the current app reads listings as raw rows.'''
+    return current_app.config.get('RAW_ROWS', False)
+
+
+class Row(object):
+    '''A record with a fixed set of attributes. Attributes that weren't
+    selected are ``None``.
+    '''
+    __slots__ = ()
+
+    def __init__(self, names, values):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(self.__class__.__name__, self.id)
+
+
+class PersonRow(Row):
+    __slots__ = ('id', 'firstname', 'lastname', 'created', 'item_count')
+
+
+class ItemRow(Row):
+    __slots__ = ('id', 'name', 'checked_out', 'updated', 'person')
+
+
+def item_columns(fields):
+    '''Return the item columns to select for a page of ``fields``, not
+    counting the person's.
+    '''
+    names = get_attributes(fields or ITEM_FIELDS, ITEM_ATTRIBUTES,
+                            always=('id', 'updated'))
+    return [name for name in names if name != 'person']
+
+
+def person_columns(fields):
+    '''Return the person columns to select for a page of ``fields``.'''
+    return list(get_attributes(fields or PERSON_FIELDS, PERSON_ATTRIBUTES,
+                                always=('id', 'created')))
+
+
+def item_rows(tuples, names, with_person=False):
+    '''Yield an ``ItemRow`` for each tuple of the ``names`` columns. If
+    ``with_person``, each tuple ends with the ``PERSON_COLUMNS`` of the
+    item's person, which are ``None`` if it doesn't have one.
+    '''
+    n = len(names)
+    for values in tuples:
+        item = ItemRow(names, values[:n])
+        if with_person and values[n] is not None:
+            item.person = PersonRow(PERSON_COLUMNS, values[n:])
+        yield item
+
+
+def person_rows(tuples, names):
+    '''Yield a ``PersonRow`` for each tuple of the ``names`` columns.'''
+    for values in tuples:
+        yield PersonRow(names, values)
@@ -1,17 +1,424 @@
-'''Serializers common to all apps.'''
+'''Serializers common to all apps.
 
-from marshmallow import Serializer, fields
+Serializers that subclass ``CompiledSerializer`` can skip marshmallow's
+per-field dispatch: when the app's ``SERIALIZER_ENGINE`` setting is
+``"compiled"`` (the default is ``"marshmallow"``), their field declarations
+are compiled into one specialized Python function per schema, which
+produces the same data as marshmallow. The compiler builds on marshmallow
+0.5's internals, so with any other version the setting is ignored and
+marshmallow serializes as usual.
 
+Either way, the time spent serializing counts towards the request's
+serialization time (see ``instrument.py``).
+'''
+import keyword
+import re
+import threading
+import types
+from functools import wraps
+from timeit import default_timer
 
-class PersonSerializer(Serializer):
+from flask import current_app, has_app_context
+from marshmallow import Serializer, fields, utils
+from marshmallow.compat import text_type, basestring
+from marshmallow.exceptions import MarshallingError
+try:
+    from marshmallow.serializer import SerializerOpts
+except ImportError:
+    SerializerOpts = None
+
+from instrument import record_serialization
+
+### Compiled serializers ###
+
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Whether this marshmallow has the internals the compiled engine uses
+COMPILABLE = (SerializerOpts is not None and
+                hasattr(fields, '_get_value') and
+                hasattr(fields, 'Marshaller') and
+                hasattr(Serializer, '_update_fields'))
+
+
+def rfcformat(dt):
+    '''Same as ``marshmallow.utils.rfcformat``, without the round trip
+    through a timestamp for naive (UTC) datetimes.
+    '''
+    if dt.tzinfo is not None:
+        return utils.rfcformat(dt)
+    return '%s, %02d %s %04d %02d:%02d:%02d -0000' % (
+        DAY_NAMES[dt.weekday()], dt.day, MONTH_NAMES[dt.month - 1], dt.year,
+        dt.hour, dt.minute, dt.second)
+
+
+def isoformat(dt):
+    '''Same as ``marshmallow.utils.isoformat``.'''
+    if dt.tzinfo is not None:
+        return utils.isoformat(dt)
+    return dt.isoformat() + '+00:00'
+
+
+def compiled_enabled():
+    '''Return whether the current app has the compiled engine turned on,
+    and this marshmallow can run it.
+    '''
+    return (COMPILABLE and has_app_context() and
+            current_app.config.get('SERIALIZER_ENGINE') == 'compiled')
+
+
+def field_source(first, name):
+    '''Return the value marshmallow infers an undeclared field's type from.'''
+    if hasattr(first, '__marshallable__'):
+        return first.__marshallable__()[name]
+    if hasattr(first, '__getitem__'):
+        return first[name]
+    return getattr(first, name, None)
+
+
+class SchemaCompiler(object):
+    '''Generates the source of a function ``serialize(obj, parent)`` that
+    marshals objects with a set of fields, and execs it.
+
+    If ``obj_class`` is given, attributes are read the fastest way for that
+    class and objects of any other class are handed to
+    ``fallback(obj, parent)``.
+    '''
+
+    def __init__(self, field_items, obj_class=None, fallback=None):
+        self.field_items = field_items
+        self.obj_class = obj_class
+        self.namespace = {
+            'obj_class': obj_class,
+            'fallback': fallback,
+            'text_type': text_type,
+            'rfcformat': rfcformat,
+            'isoformat': isoformat,
+            'get_value': fields._get_value,
+            'MarshallingError': MarshallingError,
+        }
+        self.lines = ['def serialize(obj, parent):']
+        if obj_class is not None:
+            self.emit('if obj.__class__ is not obj_class:')
+            self.emit('return fallback(obj, parent)', 2)
+
+    def bind(self, name, value):
+        self.namespace[name] = value
+        return name
+
+    def emit(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    def load(self, var, i, field, key, indent=1):
+        '''Emit statements that get the field's raw value into ``var``.'''
+        key = key if field.attribute is None else field.attribute
+        if self.obj_class is not None and isinstance(key, basestring) and \
+                '.' not in key:
+            if self.obj_class is dict:
+                self.emit('{0} = obj.get({1!r})'.format(var, key), indent)
+                return
+            if not utils.is_indexable_but_not_string(self.obj_class) and \
+                    IDENTIFIER.match(key) and not keyword.iskeyword(key):
+                # Same as getattr(obj, key, None), minus the call
+                self.emit('try:', indent)
+                self.emit('{0} = obj.{1}'.format(var, key), indent + 1)
+                self.emit('except AttributeError:', indent)
+                self.emit('{0} = None'.format(var), indent + 1)
+                return
+        self.emit('{0} = get_value({1}, obj)'.format(
+                    var, self.bind('key%d' % i, key)), indent)
+
+    def value(self, i, key, field):
+        '''Emit statements that leave the field's output in ``v<i>``.'''
+        var = 'v%d' % i
+        cls = type(field)
+        if cls is fields.Function:
+            func = self.bind('func%d' % i, field.func)
+            self.emit('try:')
+            self.emit('{0} = {1}(obj)'.format(var, func), 2)
+            self.emit('except (TypeError, AttributeError):')
+            self.emit('{0} = None'.format(var), 2)
+            return
+        if cls is fields.Method:
+            self.emit('try:')
+            self.emit('{0} = getattr(parent, {1!r})(obj)'.format(
+                        var, field.method_name), 2)
+            self.emit('except AttributeError:')
+            self.emit('{0} = None'.format(var), 2)
+            return
+        if cls is fields.Nested and isinstance(field.nested, type) and \
+                issubclass(field.nested, CompiledSerializer):
+            self.nested(i, key, field)
+            return
+        formatter, errors = self.formatter(i, field)
+        if formatter is None:
+            # Any other field: let marshmallow do it
+            out = self.bind('field%d' % i, field)
+            self.emit('try:')
+            self.emit('{0} = {1}.output({2!r}, obj)'.format(var, out, key), 2)
+            self.emit('except MarshallingError:')
+            self.emit('{0} = None'.format(var), 2)
+            return
+        default = self.bind('default%d' % i, field.default)
+        self.load(var, i, field, key)
+        if errors is None:
+            self.emit('{0} = {1} if {0} is None else {2}'.format(
+                        var, default, formatter.format(var)))
+            return
+        # marshmallow stores formatting errors and outputs None
+        self.emit('if {0} is None:'.format(var))
+        self.emit('{0} = {1}'.format(var, default), 2)
+        self.emit('else:')
+        self.emit('try:', 2)
+        self.emit('{0} = {1}'.format(var, formatter.format(var)), 3)
+        self.emit('except {0}:'.format(errors), 2)
+        self.emit('{0} = None'.format(var), 3)
+
+    def formatter(self, i, field):
+        '''Return ``(format string, errors)``, where the format string is for
+        the expression that formats a non-null value and ``errors`` names the
+        exceptions marshmallow turns into a null, if any. The format string
+        is None if the field isn't supported.
+        '''
+        cls = type(field)
+        if cls is fields.Raw:
+            return '{0}', None
+        if cls is fields.Boolean:
+            return 'bool({0})', None
+        if cls in (fields.String, fields.UUID):
+            return 'text_type({0})', 'ValueError'
+        if cls in (fields.Integer, fields.Float):
+            num = self.bind('num%d' % i, field.num_type)
+            if field.as_string:
+                return 'repr(%s({0}))' % num, 'ValueError'
+            return '%s({0})' % num, 'ValueError'
+        if cls is fields.DateTime:
+            dateformat = field.dateformat or 'rfc'
+            if dateformat == 'rfc':
+                return 'rfcformat({0})', 'Exception'
+            if dateformat == 'iso':
+                return 'isoformat({0})', 'Exception'
+            return '{0}.strftime(%r)' % dateformat, 'Exception'
+        return None, None
+
+    def nested(self, i, key, field):
+        var = 'v%d' % i
+        plan = self.bind('nested%d' % i, CompiledPlan(
+            field.nested, only=field.only, exclude=field.exclude))
+        nested_parent = self.bind('nested_parent%d' % i, field.nested(None))
+        by_class = self.bind('by_class%d' % i, self.namespace[plan].by_class)
+        self.load(var, i, field, key)
+        if field.allow_null:
+            self.emit('if {0} is not None:'.format(var))
+        else:
+            self.emit('if True:')
+        if field.many:
+            self.emit('if {0} is not None:'.format(var), 2)
+            self.emit('{0} = [{1}(o, {2}) for o in {0}]'.format(
+                        var, plan, nested_parent), 3)
+            self.emit('else:', 2)
+            self.emit('{0} = {1}({0}, {2})'.format(var, plan, nested_parent), 3)
+        else:
+            # Skip the plan's lookup when its function for the class is known
+            self.emit('f = {0}.get({1}.__class__)'.format(by_class, var), 2)
+            self.emit('{0} = f({0}, {1}) if f is not None else {2}({0}, {1})'
+                        .format(var, nested_parent, plan), 2)
+        if isinstance(field.only, basestring):
+            if field.many:
+                self.emit('if isinstance({0}, list):'.format(var), 2)
+                self.emit('{0} = [d[{1!r}] for d in {0}]'.format(
+                            var, field.only), 3)
+                self.emit('else:', 2)
+                self.emit('{0} = {0}[{1!r}]'.format(var, field.only), 3)
+            else:
+                self.emit('{0} = {0}[{1!r}]'.format(var, field.only), 2)
+
+    def compile(self):
+        items = []
+        for i, (key, field) in enumerate(self.field_items):
+            self.value(i, key, field)
+            items.append('{0!r}: v{1}'.format(key, i))
+        self.emit('return {' + ', '.join(items) + '}')
+        source = '\n'.join(self.lines)
+        name = getattr(self.obj_class, '__name__', 'any object')
+        exec(compile(source, '<compiled {0}>'.format(name), 'exec'),
+                self.namespace)
+        return self.namespace['serialize']
+
+
+class CompiledPlan(object):
+    '''Marshals objects with a ``CompiledSerializer`` subclass's fields,
+    compiling a function the first time each class of object (and type of
+    each inferred field) is seen.
+    '''
+
+    def __init__(self, serializer_class, only=None, exclude=()):
+        self.serializer_class = serializer_class
+        if isinstance(only, basestring):
+            # A Nested field that outputs a single value still marshals
+            # just that field
+            only = (only,)
+        self.only = tuple(only or ())
+        self.exclude = tuple(exclude or ())
+        self.functions = {}
+        # Functions by class alone, when no field's type is inferred
+        self.by_class = {}
+        self.inferred = None
+
+    def prototype(self, first):
+        '''Return a bare serializer whose fields are the ones marshmallow
+        would use for ``first``.
+        '''
+        proto = object.__new__(self.serializer_class)
+        Serializer.__init__(proto, None, only=self.only, exclude=self.exclude,
+                            many=True)
+        if first is not None:
+            proto.obj = [first]
+            proto._update_fields(proto.obj)
+        return proto
+
+    def fields_for(self, first):
+        if self.inferred is None:
+            proto = self.prototype(first)
+            declared = self.serializer_class._declared_fields
+            self.inferred = [name for name in proto.fields
+                                if name not in declared]
+        key = (first.__class__,) + tuple(
+                type(field_source(first, name)) for name in self.inferred)
+        function = self.functions.get(key)
+        if function is None:
+            # Objects of other classes in the same list are marshalled with
+            # the same fields, as marshmallow infers them from the first one
+            field_items = list(self.prototype(first).fields.items())
+            fallback = SchemaCompiler(field_items).compile()
+            compiler = SchemaCompiler(field_items, first.__class__, fallback)
+            function = self.functions[key] = compiler.compile()
+            if not self.inferred:
+                self.by_class[first.__class__] = function
+        return function
+
+    def __call__(self, obj, parent):
+        function = self.by_class.get(obj.__class__)
+        if function is None:
+            function = self.fields_for(obj)
+        return function(obj, parent)
+
+
+# Whether the thread is serializing, so that nested serializers aren't
+# timed twice
+_serializing = threading.local()
+
+
+def timed_serialization(method):
+    '''Decorate a serializer method to record its time with
+    ``record_serialization``, unless another serializer is running.
+    '''
+    @wraps(method)
+    def timed_method(*args, **kwargs):
+        if getattr(_serializing, 'active', False):
+            return method(*args, **kwargs)
+        _serializing.active = True
+        start = default_timer()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _serializing.active = False
+            record_serialization(default_timer() - start)
+    return timed_method
+
+
+class CompiledSerializer(Serializer):
+    '''A marshmallow serializer that marshals with a compiled function when
+    ``SERIALIZER_ENGINE = "compiled"`` is set in the app's config.
+    '''
+
+    _plans = {}
+
+    @timed_serialization
+    def __init__(self, obj=None, extra=None, only=None, exclude=None,
+                prefix='', strict=False, many=False):
+        self._compiled_data = None
+        strict = strict or getattr(self.Meta, 'strict', False)
+        if obj is None or prefix or strict or not compiled_enabled():
+            super(CompiledSerializer, self).__init__(obj, extra=extra,
+                only=only, exclude=exclude, prefix=prefix, strict=strict,
+                many=many)
+            return
+        if many or isinstance(obj, types.GeneratorType):
+            obj = list(obj)
+        self.obj = obj
+        self.many = many
+        self.extra = extra
+        self.only = only or ()
+        self.exclude = exclude or ()
+        self.prefix = prefix
+        self.strict = strict
+        self.opts = SerializerOpts(self.Meta)
+        self.marshal = fields.Marshaller(prefix=prefix, strict=strict)
+        self.fields = {}
+        plan = self.get_plan(self.only, self.exclude)
+        if many:
+            if obj:
+                serialize = plan.fields_for(obj[0])
+                self._compiled_data = [serialize(o, self) for o in obj]
+            else:
+                self._compiled_data = []
+        else:
+            self._compiled_data = plan(obj, self)
+            if extra:
+                self._compiled_data.update(extra)
+
+    @classmethod
+    def get_plan(cls, only, exclude):
+        key = (cls, tuple(only), tuple(exclude))
+        plan = CompiledSerializer._plans.get(key)
+        if plan is None:
+            plan = CompiledSerializer._plans[key] = CompiledPlan(cls, only,
+                                                                exclude)
+        return plan
+
+    @property
+    @timed_serialization
+    def data(self):
+        if self._compiled_data is not None:
+            return self._compiled_data
+        return Serializer.data.fget(self)
+
+
+class PersonSerializer(CompiledSerializer):
     id = fields.Integer()
     name = fields.Function(lambda p: "{0}, {1}".format(p.lastname, p.firstname))
     created = fields.DateTime()
-    n_items = fields.Integer()
+    n_items = fields.Method("get_n_items")
+
+    def __init__(self, *args, **kwargs):
+        # Optional mapping of person id -> number of items, so that listings
+        # can count every person's items in one query
+        self.item_counts = kwargs.pop('item_counts', None)
+        super(PersonSerializer, self).__init__(*args, **kwargs)
+
+    def get_n_items(self, person):
+        if self.item_counts is None:
+            return person.n_items
+        return self.item_counts.get(person.id, 0)
+
+
+class ItemPersonSerializer(PersonSerializer):
+    '''The person nested in an item. marshmallow reads every field of
+    the nested serializer off the first person to infer their types, so the
+    fields are limited here rather than with ``only``, which would still
+    count the person's items.
+    '''
+
+    class Meta:
+        fields = ('id', 'name')
 
 
-class ItemSerializer(Serializer):
-    person = fields.Nested(PersonSerializer, only=('id', 'name'), allow_null=True)
+class ItemSerializer(CompiledSerializer):
+    person = fields.Nested(ItemPersonSerializer, only=('id', 'name'),
+                            allow_null=True)
 
     class Meta:
         additional = ('id', 'name', 'checked_out', 'updated')
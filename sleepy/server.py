@@ -0,0 +1,146 @@
+'''Production server for the example apps.
+
+    $ python -m sleepy.server --backend sqlalchemy --workers 4 --threads 8
+    $ python -m sleepy.server --backend mongoengine --gevent --connections 2000
+
+Runs an app under gunicorn instead of Flask's development server. The
+master process never imports the app: each worker builds it after it is
+forked, so workers don't share SQLite connections, Mongo clients or Redis
+connection pools with each other.
+
+With ``--gevent``, each worker serves its requests from greenlets on an
+event loop, with the standard library patched so that waiting on a socket
+or a lock switches to another request. The views, URLs and responses are
+the same; a worker just holds thousands of slow or idle connections where
+a threaded one holds ``--threads``. Pymongo and redis-py talk over those
+patched sockets. SQLite queries don't yield, so the SQL apps gain less,
+and a request that can't get a pooled connection waits for one as usual.
+
+Settings in the Python file named by ``$SLEEPY_SETTINGS`` override
+``ProductionSettings``, e.g.::
+
+    SQLALCHEMY_DATABASE_URI = "sqlite:////srv/inventory.db"
+'''
+import argparse
+import importlib
+import multiprocessing
+import os
+import sys
+
+from flask import Config
+from gunicorn.app.base import BaseApplication
+
+from sleepy import BACKENDS, configure_app
+
+
+class ProductionSettings:
+    DEBUG = False
+    TESTING = False
+    JSONIFY_PRETTYPRINT_REGULAR = False
+    # See pragmas.py
+    SQLITE_TUNING = True
+
+
+def production_settings():
+    '''Return ``ProductionSettings``, with the overrides in
+    ``$SLEEPY_SETTINGS``, if it's set.
+    '''
+    config = Config(os.getcwd())
+    config.from_object(ProductionSettings)
+    config.from_envvar('SLEEPY_SETTINGS', silent=True)
+    return dict(config)
+
+
+def create_schema(backend):
+    '''Create a backend's tables and indexes, as its ``__main__`` does.'''
+    app = configure_app(backend, production_settings())
+    api = importlib.import_module('sleepy.api_' + backend)
+    if backend == 'sqlalchemy':
+        with app.app_context():
+            api.db.create_all()
+            api.add_item_count_column()
+    elif backend == 'peewee':
+        api.create_tables()
+    elif backend == 'pony':
+        api.create_tables()
+    elif backend == 'stdnet':
+        api.CheckoutIndex(api.models.item).rebuild()
+
+
+def load_app(backend):
+    '''Return a backend's app, configured for production.'''
+    return configure_app(backend, production_settings())
+
+
+class Server(BaseApplication):
+    '''Gunicorn application that loads the app in each worker.'''
+
+    def __init__(self, backend, options):
+        self.backend = backend
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return load_app(self.backend)
+
+
+def in_child(func, *args):
+    '''Run ``func(*args)`` in a child process so that the connections it
+    opens aren't inherited by the workers. Raises ``RuntimeError`` if it
+    fails.
+    '''
+    process = multiprocessing.Process(target=func, args=args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('{0} exited with {1}'.format(func.__name__,
+                                                        process.exitcode))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=BACKENDS, default='sqlalchemy')
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--gevent", action="store_true",
+                        help="Serve requests from greenlets, not threads")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="Concurrent requests per worker with --gevent")
+    parser.add_argument("--timeout", type=int, default=30)
+    parser.add_argument("--no-schema", action="store_true",
+                        help="Don't create the tables and indexes first")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and production_settings().get('CACHE_TYPE') == 'lru':
+        # A write only invalidates the cache of the worker that handled it
+        parser.error("CACHE_TYPE = 'lru' needs --workers 1; set "
+                        "CACHE_REDIS_URL to share the cache between workers")
+    if not args.no_schema:
+        in_child(create_schema, args.backend)
+    if args.gevent:
+        worker_class = "gevent"
+    else:
+        worker_class = "gthread" if args.threads > 1 else "sync"
+    options = {
+        "bind": "{0}:{1}".format(args.host, args.port),
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": worker_class,
+        "worker_connections": args.connections,
+        "timeout": args.timeout,
+        "preload_app": False,
+        "accesslog": "-",
+    }
+    Server(args.backend, options).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+'''Streaming JSON responses common to all apps.
+
+List endpoints called with ``?stream=1`` return every row as a chunked
+response. Rows are fetched, serialized and written one chunk at a time, so
+memory use stays constant regardless of table size and the first bytes go
+out before the query has finished.
+'''
+from flask import Response, request, stream_with_context
+
+from encoding import dumps
+
+CHUNK_SIZE = 1000
+
+
+def is_streaming():
+    '''Return whether the client asked for a streaming response.'''
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def chunked(iterable, size=CHUNK_SIZE):
+    '''Yield lists of up to ``size`` items from ``iterable``.'''
+    chunk = []
+    for obj in iterable:
+        chunk.append(obj)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_json(key, chunks, serialize):
+    '''Return a response that writes ``{key: [...]}`` one chunk at a time.
+
+    :param str key: The top-level key of the JSON object.
+    :param chunks: Iterable of lists of objects, e.g. from :func:`chunked`.
+    :param serialize: Function that returns the serialized data for a list
+        of objects.
+    '''
+    def generate():
+        yield '{{"{0}":['.format(key)
+        separator = ''
+        for chunk in chunks:
+            data = serialize(chunk)
+            if data:
+                yield separator + ','.join(dumps(obj) for obj in data)
+                separator = ','
+        yield ']}'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
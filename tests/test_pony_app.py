@@ -5,7 +5,9 @@ from nose.tools import *  # PEP8 asserts
 from flask.ext.testing import TestCase
 from flask import json
 
-from sleepy.api_pony import Person, Item, app, db
+from sleepy import configure_app
+from sleepy.api_pony import (Person, Item, app, db, cache, create_tables,
+                                reconcile_item_counts, add_item_count_column)
 from sleepy.serializers import ItemSerializer
 from pony import orm
 from pony.orm import db_session
@@ -16,13 +18,14 @@ class TestPonyAPI(TestCase):
 
     TESTING = True
     DEBUG = True
+    CACHE_TYPE = "lru"
+    SQLITE_TUNING = True
 
     def create_app(self):
-        app.config.from_object(self)
-        return app
+        return configure_app('pony', self)
 
     def setUp(self):
-        db.create_tables()
+        create_tables()
         # create some items
         with db_session:
             self.person = Person(firstname="Steve", lastname="Loria")
@@ -32,6 +35,7 @@ class TestPonyAPI(TestCase):
 
     def tearDown(self):
         db.drop_all_tables(with_all_data=True)
+        cache.clear()
 
     @db_session
     def test_get_items(self):
@@ -43,6 +47,99 @@ class TestPonyAPI(TestCase):
         assert_equal(len(data['items']), 2)
         assert_equal(data['items'][0]['name'], item.name)
 
+    @db_session
+    def test_get_items_paginated(self):
+        res = self.client.get("/api/v1/items/?limit=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], Item[self.item2.id].name)
+        assert_true(res.json['next'])
+        res = self.client.get("/api/v1/items/?limit=1&after={0}"
+                                .format(res.json['next']))
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], Item[self.item.id].name)
+        assert_equal(res.json['next'], None)
+
+    @db_session
+    def test_get_items_streaming(self):
+        res = self.client.get("/api/v1/items/?stream=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(res.json['items'][0]['name'], Item[self.item2.id].name)
+
+    @db_session
+    def test_get_items_fields(self):
+        res = self.client.get("/api/v1/items/?fields=id,name")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(sorted(res.json['items'][0]), ['id', 'name'])
+
+    @db_session
+    def test_get_items_unknown_field(self):
+        res = self.client.get("/api/v1/items/?fields=id,password")
+        assert_equal(res.status_code, 400)
+
+    @db_session
+    def test_get_person_fields(self):
+        url = '/api/v1/people/{0}?fields=n_items'.format(self.person.id)
+        res = self.client.get(url)
+        assert_equal(res.status_code, 200)
+        assert_equal(res.json, {"n_items": 1})
+
+    @db_session
+    def test_get_pool_stats(self):
+        self.client.get("/api/v1/items/")
+        res = self.client.get("/api/v1/pool")
+        assert_equal(res.status_code, 200)
+        assert_true(res.json['checkouts'] >= 1)
+
+    @db_session
+    def test_connections_are_tuned(self):
+        assert_equal(db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    @db_session
+    def test_create_tables_creates_indexes(self):
+        names = db.select("name FROM sqlite_master WHERE type = 'index'")
+        assert_in('idx_items__checked_out_updated', names)
+        assert_in('idx_items__updated', names)
+
+    @db_session
+    def test_get_items_bad_cursor(self):
+        res = self.client.get("/api/v1/items/?after=notacursor")
+        assert_equal(res.status_code, 400)
+
+    @db_session
+    def test_get_items_not_modified(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+        self._post_json(url, {"name": "Ipad"})
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    @db_session
+    def test_delete_person_changes_items_etag(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        self.client.delete('/api/v1/people/{0}'.format(self.person.id))
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    def test_get_items_ignores_if_modified_since(self):
+        url = "/api/v1/items/"
+        assert_not_in('Last-Modified', self.client.get(url).headers)
+        res = self.client.get(url, headers={
+                "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        assert_equal(res.status_code, 200)
+
+    @db_session
+    def test_get_item_not_modified(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+
     @db_session
     def test_get_item(self):
         url = '/api/v1/items/{0}'.format(self.item.id)
@@ -53,6 +150,25 @@ class TestPonyAPI(TestCase):
         assert_equal(data['name'], item.name)
         assert_equal(data['person']['id'], self.person.id)
 
+    @db_session
+    def test_get_item_is_cached(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        self.client.get(url)
+        hits = cache.stats()['hits']
+        res = self.client.get(url)
+        assert_equal(cache.stats()['hits'], hits + 1)
+        assert_equal(res.json['name'], "Foo")
+
+    @db_session
+    def test_put_item_invalidates_cache(self):
+        item_url = '/api/v1/items/{0}'.format(self.item.id)
+        person_url = '/api/v1/people/{0}'.format(self.person2.id)
+        self.client.get(item_url)
+        assert_equal(self.client.get(person_url).json['n_items'], 0)
+        self._put_json(item_url, {"name": "Baz", "person_id": self.person2.id})
+        assert_equal(self.client.get(item_url).json['name'], "Baz")
+        assert_equal(self.client.get(person_url).json['n_items'], 1)
+
     @db_session
     def test_get_persons(self):
         res = self.client.get('/api/v1/people/')
@@ -62,6 +178,13 @@ class TestPonyAPI(TestCase):
         assert_equal(res.json['people'][0]['name'],
                     "{0}, {1}".format(person.lastname, person.firstname))
 
+    @db_session
+    def test_get_persons_item_counts(self):
+        res = self.client.get('/api/v1/people/')
+        counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+        assert_equal(counts[self.person.id], 1)
+        assert_equal(counts[self.person2.id], 0)
+
     @db_session
     def test_get_person(self):
         res = self.client.get('/api/v1/people/{0}'.format(self.person.id))
@@ -129,6 +252,125 @@ class TestPonyAPI(TestCase):
         assert_true(item.checked_out)
         assert_equal(item.person, person)
 
+    @db_session
+    def test_put_item_group_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        try:
+            res = self._put_json("/api/v1/items/{0}".format(self.item.id),
+                                {"checked_out": True,
+                                "person_id": self.person2.id})
+            assert_equal(res.status_code, 200)
+            assert_true(res.json['item']['checked_out'])
+            res = self._put_json("/api/v1/items/0", {"checked_out": True})
+            assert_equal(res.status_code, 404)
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+
+    def test_group_commit_string_person_id(self):
+        # The browser interface sends ids as strings
+        self.app.config['GROUP_COMMIT'] = True
+        try:
+            res = self._post_json("/api/v1/items/",
+                                {"name": "Ipad",
+                                "person_id": str(self.person.id)})
+            assert_equal(res.status_code, 201)
+            assert_equal(res.json['item']['person']['id'], self.person.id)
+            res = self._put_json("/api/v1/items/{0}".format(self.item2.id),
+                                {"person_id": str(self.person2.id)})
+            assert_equal(res.status_code, 200)
+            assert_equal(res.json['item']['person']['id'], self.person2.id)
+            res = self._post_json("/api/v1/items/",
+                                {"name": "Ipad", "person_id": "Steve"})
+            assert_equal(res.status_code, 400)
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+
+    @db_session
+    def test_server_timing_and_queries(self):
+        res = self.client.get("/api/v1/items/")
+        assert_in('db;dur=', res.headers['Server-Timing'])
+        res = self.client.get("/api/v1/queries")
+        stats = res.json["GET /api/v1/items/"]
+        assert_true(stats['requests'] >= 1)
+        assert_true(stats['queries_per_request'] > 0)
+
+    @db_session
+    def test_metrics(self):
+        self.client.get("/api/v1/items/")
+        res = self.client.get("/metrics")
+        assert_equal(res.status_code, 200)
+        assert_true(res.content_type.startswith("text/plain"))
+        assert_in('sleepy_requests_total{method="GET",'
+                    'route="/api/v1/items/",status="200"}', res.data)
+        assert_in('sleepy_request_duration_seconds_bucket', res.data)
+        assert_in('sleepy_requests_in_flight', res.data)
+        assert_in('sleepy_cache_hits_total', res.data)
+        assert_in('sleepy_pool_checkouts_total', res.data)
+
+    @db_session
+    def test_profile_request(self):
+        self.app.config['PROFILING'] = True
+        try:
+            self.client.get("/api/v1/items/",
+                            headers={"X-Sleepy-Profile": "1"}, buffered=True)
+        finally:
+            self.app.config['PROFILING'] = False
+        res = self.client.get("/admin/profiles")
+        profile = res.json['profiles'][0]
+        assert_equal(profile['path'], "/api/v1/items/")
+        assert_equal(profile['status'], 200)
+        assert_equal(set(profile['phases_ms']),
+                    set(["query", "hydration", "serialization", "json", "app"]))
+
+    @db_session
+    def test_compact_json_without_debug(self):
+        debug = self.app.debug
+        self.app.debug = False
+        try:
+            res = self.client.get("/api/v1/items/")
+        finally:
+            self.app.debug = debug
+        assert_not_in("\n", res.data)
+        assert_equal(len(res.json['items']), 2)
+
+    def test_create_tables_adds_item_count_column(self):
+        # A database created before item_count existed
+        db.drop_all_tables(with_all_data=True)
+        with db_session:
+            db.execute("CREATE TABLE people (id INTEGER PRIMARY KEY, "
+                        "firstname VARCHAR(80) NOT NULL, "
+                        "lastname VARCHAR(80) NOT NULL, created DATETIME)")
+            db.execute("INSERT INTO people (firstname, lastname, created) "
+                        "VALUES ('Steve', 'Loria', '2014-01-01 00:00:00')")
+        create_tables()
+        assert_false(add_item_count_column())
+        with db_session:
+            assert_equal(Person.select().first().item_count, 0)
+
+    def test_stored_item_counts(self):
+        # No db_session here: each request gets its own, as in production,
+        # so none of them reads people cached with stale counts
+        with db_session:
+            person_id, person2_id = self.person.id, self.person2.id
+            item_id = self.item.id
+        self.app.config['STORED_ITEM_COUNTS'] = True
+        try:
+            # Steve's item was added without counting it
+            assert_equal(reconcile_item_counts(), 1)
+            self._post_json("/api/v1/items/", {"name": "Ipad",
+                                                "person_id": person2_id})
+            self._put_json("/api/v1/items/{0}".format(item_id),
+                            {"person_id": person2_id})
+            res = self.client.get("/api/v1/people/")
+            counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+            assert_equal(counts, {person_id: 0, person2_id: 2})
+            self.client.delete("/api/v1/items/{0}".format(item_id))
+            res = self.client.get("/api/v1/people/{0}".format(person2_id))
+            assert_equal(res.json['n_items'], 1)
+            assert_equal(reconcile_item_counts(), 0)
+        finally:
+            self.app.config['STORED_ITEM_COUNTS'] = False
+
     @db_session
     def test_delete_person(self):
         person = Person[self.person.id]
@@ -136,6 +378,42 @@ class TestPonyAPI(TestCase):
         self.client.delete('/api/v1/people/{0}'.format(self.person.id))
         assert_not_in(person, Person.select()[:])
 
+    @db_session
+    def test_bulk_post_items(self):
+        res = self._post_json("/api/v1/items/bulk",
+                            [{"name": "Ipad", "person_id": self.person.id},
+                            {"checked_out": True}])
+        assert_equal(res.status_code, 200)
+        results = res.json['results']
+        assert_equal([r['status'] for r in results], [201, 400])
+        item = Item[results[0]['item']['id']]
+        assert_equal(item.name, "Ipad")
+        assert_equal(item.person, Person[self.person.id])
+
+    def test_bulk_put_same_item_twice(self):
+        item_id, person_id, person2_id = (self.item.id, self.person.id,
+                                            self.person2.id)
+        res = self._put_json("/api/v1/items/bulk",
+                            [{"id": item_id, "name": "Ipad",
+                                "person_id": person2_id},
+                            {"id": item_id, "name": "Kindle",
+                                "person_id": person_id}])
+        results = [(r['item']['name'], r['item']['person']['id'])
+                    for r in res.json['results']]
+        # Each row gets the state it wrote, and the last one is stored
+        assert_equal(results, [("Ipad", person2_id), ("Kindle", person_id)])
+        res = self.client.get("/api/v1/items/{0}".format(item_id))
+        assert_equal(res.json['name'], "Kindle")
+        assert_equal(res.json['person']['id'], person_id)
+
+    @db_session
+    def test_bulk_delete_items(self):
+        res = self.client.delete("/api/v1/items/bulk",
+                                data=json.dumps([self.item.id, 1234]),
+                                content_type='application/json')
+        assert_equal([r['status'] for r in res.json['results']], [200, 404])
+        assert_equal(Item.select()[:], [Item[self.item2.id]])
+
     @db_session
     def test_recent(self):
         item = Item[self.item.id]
@@ -5,18 +5,32 @@ from nose.tools import *  # PEP8 asserts
 from flask.ext.testing import TestCase
 
 from flask import json
-from sleepy.api_sqlalchemy import Person, Item, db, app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sleepy import configure_app
+from sleepy.api_sqlalchemy import (Person, Item, db, app, cache,
+                                    reconcile_item_counts,
+                                    add_item_count_column)
 from sleepy.serializers import ItemSerializer
+from sleepy.cache import make_store, NullCache, RedisCache, DictClient
+from sleepy.batching import GroupCommit, _Waiter
+from werkzeug.exceptions import ServiceUnavailable
+
+executed_queries = []
+
+@event.listens_for(Engine, "before_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    executed_queries.append(statement)
 
 
 class TestSQLAlchemyAPI(TestCase):
     TESTING = True
     DEBUG = True
+    CACHE_TYPE = "lru"
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
     def create_app(self):
-        app.config.from_object(self)
-        return app
+        return configure_app('sqlalchemy', self)
 
     def setUp(self):
         db.create_all()
@@ -31,6 +45,7 @@ class TestSQLAlchemyAPI(TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        cache.clear()
 
     def test_get_items(self):
         url = "/api/v1/items/"
@@ -40,6 +55,148 @@ class TestSQLAlchemyAPI(TestCase):
         assert_equal(len(data['items']), 2)
         assert_equal(data['items'][0]['name'], self.item2.name)
 
+    def test_get_items_paginated(self):
+        res = self.client.get("/api/v1/items/?limit=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], self.item2.name)
+        assert_true(res.json['next'])
+        res = self.client.get("/api/v1/items/?limit=1&after={0}"
+                                .format(res.json['next']))
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], self.item.name)
+        assert_equal(res.json['next'], None)
+
+    def test_get_items_streaming(self):
+        res = self.client.get("/api/v1/items/?stream=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(res.json['items'][0]['name'], self.item2.name)
+
+    def test_get_items_raw_rows(self):
+        for url in ("/api/v1/items/", "/api/v1/people/"):
+            expected = self.client.get(url).json
+            app.config['RAW_ROWS'] = True
+            try:
+                res = self.client.get(url)
+            finally:
+                app.config['RAW_ROWS'] = False
+            assert_equal(res.status_code, 200)
+            assert_equal(res.json, expected)
+
+    def test_get_items_raw_rows_without_person(self):
+        app.config['RAW_ROWS'] = True
+        try:
+            res = self.client.get("/api/v1/items/")
+        finally:
+            app.config['RAW_ROWS'] = False
+        people = dict((i['name'], i['person']) for i in res.json['items'])
+        assert_equal(people["Bar"], None)
+        assert_equal(people["Foo"]['id'], self.person.id)
+
+    def test_compiled_serializer_engine(self):
+        urls = ("/api/v1/items/", "/api/v1/people/",
+                "/api/v1/items/{0}".format(self.item.id))
+        for url in urls:
+            expected = self.client.get(url).json
+            cache.clear()
+            app.config['SERIALIZER_ENGINE'] = "compiled"
+            try:
+                res = self.client.get(url)
+            finally:
+                app.config['SERIALIZER_ENGINE'] = "marshmallow"
+            assert_equal(res.status_code, 200)
+            assert_equal(res.json, expected)
+
+    def test_get_items_fields(self):
+        res = self.client.get("/api/v1/items/?fields=id,name")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(sorted(res.json['items'][0]), ['id', 'name'])
+
+    def test_get_items_unknown_field(self):
+        res = self.client.get("/api/v1/items/?fields=id,password")
+        assert_equal(res.status_code, 400)
+
+    def test_get_person_fields(self):
+        url = '/api/v1/people/{0}?fields=n_items'.format(self.person.id)
+        res = self.client.get(url)
+        assert_equal(res.status_code, 200)
+        assert_equal(res.json, {"n_items": 1})
+
+    def test_get_pool_stats(self):
+        res = self.client.get("/api/v1/pool")
+        assert_equal(res.status_code, 200)
+        assert_in('wait_ms_max', res.json)
+
+    def test_get_persons_streaming(self):
+        res = self.client.get("/api/v1/people/?stream=1")
+        assert_equal(res.status_code, 200)
+        counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+        assert_equal(counts, {self.person.id: 1, self.person2.id: 0})
+
+    def test_get_items_bad_cursor(self):
+        res = self.client.get("/api/v1/items/?after=notacursor")
+        assert_equal(res.status_code, 400)
+
+    def _count_queries(self, url):
+        # Start from an empty identity map so that lazy loads aren't hidden
+        db.session.expunge_all()
+        del executed_queries[:]
+        res = self.client.get(url)
+        assert_equal(res.status_code, 200)
+        return len(executed_queries)
+
+    def test_list_query_count_does_not_grow_with_items(self):
+        urls = ("/api/v1/items/", "/api/v1/recentcheckouts/")
+        before = [self._count_queries(url) for url in urls]
+        people = [Person(firstname="First{0}".format(i), lastname="Last")
+                    for i in range(10)]
+        items = [Item(name="Item{0}".format(i), person=person, checked_out=True)
+                    for i, person in enumerate(people)]
+        db.session.add_all(people + items)
+        db.session.commit()
+        after = [self._count_queries(url) for url in urls]
+        assert_equal(before, after)
+
+    def test_people_query_count_does_not_grow_with_people(self):
+        before = self._count_queries("/api/v1/people/")
+        people = [Person(firstname="First{0}".format(i), lastname="Last")
+                    for i in range(10)]
+        db.session.add_all(people + [Item(name="Item", person=p) for p in people])
+        db.session.commit()
+        after = self._count_queries("/api/v1/people/")
+        assert_equal(before, after)
+
+    def test_get_items_not_modified(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+        self._post_json(url, {"name": "Ipad"})
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    def test_delete_person_changes_items_etag(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        self.client.delete('/api/v1/people/{0}'.format(self.person.id))
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    def test_get_items_ignores_if_modified_since(self):
+        url = "/api/v1/items/"
+        assert_not_in('Last-Modified', self.client.get(url).headers)
+        res = self.client.get(url, headers={
+                "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        assert_equal(res.status_code, 200)
+
+    def test_get_item_not_modified(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+
     def test_get_item(self):
         url = '/api/v1/items/{0}'.format(self.item.id)
         res = self.client.get(url)
@@ -48,6 +205,28 @@ class TestSQLAlchemyAPI(TestCase):
         assert_equal(data['name'], self.item.name)
         assert_equal(data['person']['id'], self.person.id)
 
+    def test_get_item_is_cached(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        self.client.get(url)
+        hits = cache.stats()['hits']
+        res = self.client.get(url)
+        assert_equal(cache.stats()['hits'], hits + 1)
+        assert_equal(res.json['name'], "Foo")
+
+    def test_cache_is_shared_or_off_by_default(self):
+        assert_true(isinstance(make_store({}), NullCache))
+        store = make_store({"CACHE_REDIS_CLIENT": DictClient()})
+        assert_true(isinstance(store, RedisCache))
+
+    def test_put_item_invalidates_cache(self):
+        item_url = '/api/v1/items/{0}'.format(self.item.id)
+        person_url = '/api/v1/people/{0}'.format(self.person2.id)
+        self.client.get(item_url)
+        assert_equal(self.client.get(person_url).json['n_items'], 0)
+        self._put_json(item_url, {"name": "Baz", "person_id": self.person2.id})
+        assert_equal(self.client.get(item_url).json['name'], "Baz")
+        assert_equal(self.client.get(person_url).json['n_items'], 1)
+
     def test_get_persons(self):
         res = self.client.get('/api/v1/people/')
         assert_equal(res.status_code, 200)
@@ -55,6 +234,12 @@ class TestSQLAlchemyAPI(TestCase):
         assert_equal(res.json['people'][0]['name'],
                     "{0}, {1}".format(self.person2.lastname, self.person2.firstname))
 
+    def test_get_persons_item_counts(self):
+        res = self.client.get('/api/v1/people/')
+        counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+        assert_equal(counts[self.person.id], 1)
+        assert_equal(counts[self.person2.id], 0)
+
     def test_get_person(self):
         res = self.client.get('/api/v1/people/{0}'.format(self.person.id))
         assert_equal(res.status_code, 200)
@@ -112,6 +297,138 @@ class TestSQLAlchemyAPI(TestCase):
         assert_true(self.item.checked_out)
         assert_equal(self.item.person, self.person2)
 
+    def test_put_item_group_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        try:
+            res = self._put_json("/api/v1/items/{0}".format(self.item.id),
+                                {"checked_out": True,
+                                "person_id": self.person2.id})
+            assert_equal(res.status_code, 200)
+            assert_true(res.json['item']['checked_out'])
+            res = self._put_json("/api/v1/items/0", {"checked_out": True})
+            assert_equal(res.status_code, 404)
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+
+    def test_group_commit_string_person_id(self):
+        # The browser interface sends ids as strings
+        self.app.config['GROUP_COMMIT'] = True
+        try:
+            res = self._post_json("/api/v1/items/",
+                                {"name": "Ipad",
+                                "person_id": str(self.person.id)})
+            assert_equal(res.status_code, 201)
+            assert_equal(res.json['item']['person']['id'], self.person.id)
+            res = self._put_json("/api/v1/items/{0}".format(self.item2.id),
+                                {"person_id": str(self.person2.id)})
+            assert_equal(res.status_code, 200)
+            assert_equal(res.json['item']['person']['id'], self.person2.id)
+            res = self._post_json("/api/v1/items/",
+                                {"name": "Ipad", "person_id": "Steve"})
+            assert_equal(res.status_code, 400)
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+
+    def test_group_commit_follower_times_out(self):
+        commit = GroupCommit(lambda rows: rows)
+        commit._leading = True  # A leader that never writes the batch
+        self.app.config['GROUP_COMMIT_TIMEOUT'] = 0.01
+        try:
+            assert_raises(ServiceUnavailable, commit.submit, {"name": "Foo"})
+            assert_equal(commit._pending, [])
+        finally:
+            self.app.config['GROUP_COMMIT_TIMEOUT'] = 30
+
+    def test_group_commit_killed_leader_answers_followers(self):
+        class Killed(BaseException):
+            pass
+        def apply(rows):
+            raise Killed()
+        commit = GroupCommit(apply)
+        follower = _Waiter({"name": "Bar"})
+        commit._pending.append(follower)
+        assert_raises(Killed, commit.submit, {"name": "Foo"})
+        assert_true(follower.done.is_set())
+        assert_true(isinstance(follower.error, ServiceUnavailable))
+        assert_false(commit._leading)
+
+    def test_server_timing_and_queries(self):
+        res = self.client.get("/api/v1/items/")
+        assert_in('db;dur=', res.headers['Server-Timing'])
+        res = self.client.get("/api/v1/queries")
+        stats = res.json["GET /api/v1/items/"]
+        assert_true(stats['requests'] >= 1)
+        assert_true(stats['queries_per_request'] > 0)
+
+    def test_metrics(self):
+        self.client.get("/api/v1/items/")
+        res = self.client.get("/metrics")
+        assert_equal(res.status_code, 200)
+        assert_true(res.content_type.startswith("text/plain"))
+        assert_in('sleepy_requests_total{method="GET",'
+                    'route="/api/v1/items/",status="200"}', res.data)
+        assert_in('sleepy_request_duration_seconds_bucket', res.data)
+        assert_in('sleepy_requests_in_flight', res.data)
+        assert_in('sleepy_cache_hits_total', res.data)
+        assert_in('sleepy_pool_checkouts_total', res.data)
+
+    def test_profile_request(self):
+        self.app.config['PROFILING'] = True
+        try:
+            self.client.get("/api/v1/items/",
+                            headers={"X-Sleepy-Profile": "1"}, buffered=True)
+        finally:
+            self.app.config['PROFILING'] = False
+        res = self.client.get("/admin/profiles")
+        profile = res.json['profiles'][0]
+        assert_equal(profile['path'], "/api/v1/items/")
+        assert_equal(profile['status'], 200)
+        assert_equal(set(profile['phases_ms']),
+                    set(["query", "hydration", "serialization", "json", "app"]))
+
+    def test_compact_json_without_debug(self):
+        debug = self.app.debug
+        self.app.debug = False
+        try:
+            res = self.client.get("/api/v1/items/")
+        finally:
+            self.app.debug = debug
+        assert_not_in("\n", res.data)
+        assert_equal(len(res.json['items']), 2)
+
+    def test_add_item_count_column(self):
+        # A database created before item_count existed
+        db.session.remove()
+        db.drop_all()
+        db.engine.execute("CREATE TABLE person (id INTEGER PRIMARY KEY, "
+                            "firstname VARCHAR(80) NOT NULL, "
+                            "lastname VARCHAR(80) NOT NULL, created DATETIME)")
+        db.engine.execute("INSERT INTO person (firstname, lastname) "
+                            "VALUES ('Steve', 'Loria')")
+        db.create_all()
+        assert_true(add_item_count_column())
+        assert_false(add_item_count_column())
+        assert_equal(Person.query.one().item_count, 0)
+
+    def test_stored_item_counts(self):
+        self.app.config['STORED_ITEM_COUNTS'] = True
+        try:
+            # Steve's item was added without counting it
+            assert_equal(reconcile_item_counts(), 1)
+            self._post_json("/api/v1/items/", {"name": "Ipad",
+                                                "person_id": self.person2.id})
+            self._put_json("/api/v1/items/{0}".format(self.item.id),
+                            {"person_id": self.person2.id})
+            res = self.client.get("/api/v1/people/")
+            counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+            assert_equal(counts, {self.person.id: 0, self.person2.id: 2})
+            self.client.delete("/api/v1/items/{0}".format(self.item.id))
+            res = self.client.get("/api/v1/people/{0}".format(self.person2.id))
+            assert_equal(res.json['n_items'], 1)
+            assert_equal(reconcile_item_counts(), 0)
+        finally:
+            self.app.config['STORED_ITEM_COUNTS'] = False
+
     def test_delete_person(self):
         all_persons = Person.query.all()
         assert_in(self.person, all_persons)
@@ -119,6 +436,59 @@ class TestSQLAlchemyAPI(TestCase):
         all_persons = Person.query.all()
         assert_not_in(self.person, all_persons)
 
+    def test_bulk_post_items(self):
+        res = self._post_json("/api/v1/items/bulk",
+                            [{"name": "Ipad", "person_id": self.person.id},
+                            {"checked_out": True}])
+        assert_equal(res.status_code, 200)
+        results = res.json['results']
+        assert_equal([r['status'] for r in results], [201, 400])
+        item = Item.query.get(results[0]['item']['id'])
+        assert_equal(item.name, "Ipad")
+        assert_equal(item.person, self.person)
+
+    def test_bulk_put_items(self):
+        res = self._put_json("/api/v1/items/bulk",
+                            [{"id": self.item.id, "checked_out": True,
+                                "person_id": self.person2.id},
+                            {"id": 1234, "checked_out": True}])
+        assert_equal([r['status'] for r in res.json['results']], [200, 404])
+        item = Item.query.get(self.item.id)
+        assert_true(item.checked_out)
+        assert_equal(item.person, self.person2)
+
+    def test_bulk_put_same_item_twice(self):
+        item_id, person_id, person2_id = (self.item.id, self.person.id,
+                                            self.person2.id)
+        res = self._put_json("/api/v1/items/bulk",
+                            [{"id": item_id, "name": "Ipad",
+                                "person_id": person2_id},
+                            {"id": item_id, "name": "Kindle",
+                                "person_id": person_id}])
+        results = [(r['item']['name'], r['item']['person']['id'])
+                    for r in res.json['results']]
+        # Each row gets the state it wrote, and the last one is stored
+        assert_equal(results, [("Ipad", person2_id), ("Kindle", person_id)])
+        res = self.client.get("/api/v1/items/{0}".format(item_id))
+        assert_equal(res.json['name'], "Kindle")
+        assert_equal(res.json['person']['id'], person_id)
+
+    def test_bulk_delete_items(self):
+        res = self.client.delete("/api/v1/items/bulk",
+                                data=json.dumps([self.item.id, 1234]),
+                                content_type='application/json')
+        assert_equal([r['status'] for r in res.json['results']], [200, 404])
+        assert_equal(Item.query.all(), [self.item2])
+
+    def test_bulk_too_many_rows(self):
+        app.config['MAX_BULK_SIZE'] = 1
+        try:
+            res = self._post_json("/api/v1/items/bulk",
+                                [{"name": "Ipad"}, {"name": "Ipod"}])
+        finally:
+            del app.config['MAX_BULK_SIZE']
+        assert_equal(res.status_code, 400)
+
     def test_recent(self):
         self.item.checked_out = True
         self.item2.checked_out = False
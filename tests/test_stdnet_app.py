@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 import unittest
 import time
+from datetime import datetime, timedelta
 from nose.tools import *  # PEP8 asserts
 from flask.ext.testing import TestCase
 from flask import json
 from stdnet import odm
 
-from sleepy.api_stdnet import app, register_models
+from sleepy import configure_app
+from sleepy.api_stdnet import (app, register_models, cache,
+                                reconcile_item_counts)
 from sleepy.serializers import ItemSerializer
 
 models = odm.Router('redis://localhost:6379')
@@ -16,9 +19,10 @@ models = odm.Router('redis://localhost:6379')
 class TestStdnetAPI(TestCase):
     TESTING = True
     DEBUG = True
+    CACHE_TYPE = "lru"
 
     def create_app(self):
-        app.config.from_object(self)
+        app = configure_app('stdnet', self)
         register_models(models)
         return app
 
@@ -35,6 +39,7 @@ class TestStdnetAPI(TestCase):
 
     def tearDown(self):
         models.flush()
+        cache.clear()
 
     def test_get_items(self):
         url = "/api/v1/items/"
@@ -44,6 +49,73 @@ class TestStdnetAPI(TestCase):
         assert_equal(len(data['items']), 2)
         assert_equal(data['items'][0]['name'], self.item2.name)
 
+    def test_get_items_paginated(self):
+        res = self.client.get("/api/v1/items/?limit=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], self.item2.name)
+        assert_true(res.json['next'])
+        res = self.client.get("/api/v1/items/?limit=1&after={0}"
+                                .format(res.json['next']))
+        assert_equal(len(res.json['items']), 1)
+        assert_equal(res.json['items'][0]['name'], self.item.name)
+        assert_equal(res.json['next'], None)
+
+    def test_get_items_streaming(self):
+        res = self.client.get("/api/v1/items/?stream=1")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(res.json['items'][0]['name'], self.item2.name)
+
+    def test_get_items_fields(self):
+        res = self.client.get("/api/v1/items/?fields=id,name")
+        assert_equal(res.status_code, 200)
+        assert_equal(len(res.json['items']), 2)
+        assert_equal(sorted(res.json['items'][0]), ['id', 'name'])
+
+    def test_get_items_unknown_field(self):
+        res = self.client.get("/api/v1/items/?fields=id,password")
+        assert_equal(res.status_code, 400)
+
+    def test_get_person_fields(self):
+        url = '/api/v1/people/{0}?fields=n_items'.format(self.person.id)
+        res = self.client.get(url)
+        assert_equal(res.status_code, 200)
+        assert_equal(res.json, {"n_items": 1})
+
+    def test_get_items_bad_cursor(self):
+        res = self.client.get("/api/v1/items/?after=notacursor")
+        assert_equal(res.status_code, 400)
+
+    def test_get_items_not_modified(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+        self._post_json(url, {"name": "Ipad"})
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    def test_delete_person_changes_items_etag(self):
+        url = "/api/v1/items/"
+        etag = self.client.get(url).headers['ETag']
+        self.client.delete('/api/v1/people/{0}'.format(self.person.id))
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 200)
+
+    def test_get_items_ignores_if_modified_since(self):
+        url = "/api/v1/items/"
+        assert_not_in('Last-Modified', self.client.get(url).headers)
+        res = self.client.get(url, headers={
+                "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        assert_equal(res.status_code, 200)
+
+    def test_get_item_not_modified(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        etag = self.client.get(url).headers['ETag']
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        assert_equal(res.status_code, 304)
+
     def test_get_item(self):
         url = '/api/v1/items/{0}'.format(self.item.id)
         res = self.client.get(url)
@@ -52,6 +124,23 @@ class TestStdnetAPI(TestCase):
         assert_equal(data['name'], self.item.name)
         assert_equal(data['person']['id'], self.person.id)
 
+    def test_get_item_is_cached(self):
+        url = '/api/v1/items/{0}'.format(self.item.id)
+        self.client.get(url)
+        hits = cache.stats()['hits']
+        res = self.client.get(url)
+        assert_equal(cache.stats()['hits'], hits + 1)
+        assert_equal(res.json['name'], "Foo")
+
+    def test_put_item_invalidates_cache(self):
+        item_url = '/api/v1/items/{0}'.format(self.item.id)
+        person_url = '/api/v1/people/{0}'.format(self.person2.id)
+        self.client.get(item_url)
+        assert_equal(self.client.get(person_url).json['n_items'], 0)
+        self._put_json(item_url, {"name": "Baz", "person_id": str(self.person2.id)})
+        assert_equal(self.client.get(item_url).json['name'], "Baz")
+        assert_equal(self.client.get(person_url).json['n_items'], 1)
+
     def test_get_nonexistent_item(self):
         url = '/api/v1/items/{0}'.format("abc")
         res = self.client.get(url)
@@ -62,6 +151,12 @@ class TestStdnetAPI(TestCase):
         assert_equal(res.status_code, 200)
         assert_equal(len(res.json['people']), models.person.query().count())
 
+    def test_get_persons_item_counts(self):
+        res = self.client.get('/api/v1/people/')
+        counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+        assert_equal(counts[self.person.id], 1)
+        assert_equal(counts[self.person2.id], 0)
+
     def test_get_person(self):
         res = self.client.get('/api/v1/people/{0}'.format(self.person.id))
         assert_equal(res.status_code, 200)
@@ -122,6 +217,81 @@ class TestStdnetAPI(TestCase):
         assert_true(item.checked_out)
         assert_equal(item.person, self.person2)
 
+    def test_put_item_group_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        try:
+            res = self._put_json("/api/v1/items/{0}".format(self.item.id),
+                                {"checked_out": True,
+                                "person_id": str(self.person2.id)})
+            assert_equal(res.status_code, 200)
+            assert_true(res.json['item']['checked_out'])
+            res = self._put_json("/api/v1/items/0", {"checked_out": True})
+            assert_equal(res.status_code, 404)
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+
+    def test_server_timing_and_queries(self):
+        res = self.client.get("/api/v1/items/")
+        assert_in('db;dur=', res.headers['Server-Timing'])
+        res = self.client.get("/api/v1/queries")
+        stats = res.json["GET /api/v1/items/"]
+        assert_true(stats['requests'] >= 1)
+        assert_true(stats['queries_per_request'] > 0)
+
+    def test_metrics(self):
+        self.client.get("/api/v1/items/")
+        res = self.client.get("/metrics")
+        assert_equal(res.status_code, 200)
+        assert_true(res.content_type.startswith("text/plain"))
+        assert_in('sleepy_requests_total{method="GET",'
+                    'route="/api/v1/items/",status="200"}', res.data)
+        assert_in('sleepy_request_duration_seconds_bucket', res.data)
+        assert_in('sleepy_requests_in_flight', res.data)
+        assert_in('sleepy_cache_hits_total', res.data)
+
+    def test_profile_request(self):
+        self.app.config['PROFILING'] = True
+        try:
+            self.client.get("/api/v1/items/",
+                            headers={"X-Sleepy-Profile": "1"}, buffered=True)
+        finally:
+            self.app.config['PROFILING'] = False
+        res = self.client.get("/admin/profiles")
+        profile = res.json['profiles'][0]
+        assert_equal(profile['path'], "/api/v1/items/")
+        assert_equal(profile['status'], 200)
+        assert_equal(set(profile['phases_ms']),
+                    set(["query", "hydration", "serialization", "json", "app"]))
+
+    def test_compact_json_without_debug(self):
+        debug = self.app.debug
+        self.app.debug = False
+        try:
+            res = self.client.get("/api/v1/items/")
+        finally:
+            self.app.debug = debug
+        assert_not_in("\n", res.data)
+        assert_equal(len(res.json['items']), 2)
+
+    def test_stored_item_counts(self):
+        self.app.config['STORED_ITEM_COUNTS'] = True
+        try:
+            # Steve's item was added without counting it
+            assert_equal(reconcile_item_counts(), 1)
+            self._post_json("/api/v1/items/", {"name": "Ipad",
+                                                "person_id": self.person2.id})
+            self._put_json("/api/v1/items/{0}".format(self.item.id),
+                            {"person_id": self.person2.id})
+            res = self.client.get("/api/v1/people/")
+            counts = dict((p['id'], p['n_items']) for p in res.json['people'])
+            assert_equal(counts, {self.person.id: 0, self.person2.id: 2})
+            self.client.delete("/api/v1/items/{0}".format(self.item.id))
+            res = self.client.get("/api/v1/people/{0}".format(self.person2.id))
+            assert_equal(res.json['n_items'], 1)
+            assert_equal(reconcile_item_counts(), 0)
+        finally:
+            self.app.config['STORED_ITEM_COUNTS'] = False
+
     def test_delete_person(self):
         all_persons = models.person.query()
         assert_in(self.person, all_persons)
@@ -129,6 +299,40 @@ class TestStdnetAPI(TestCase):
         all_persons = models.person.query()
         assert_not_in(self.person, all_persons)
 
+    def test_bulk_post_items(self):
+        res = self._post_json("/api/v1/items/bulk",
+                            [{"name": "Ipad", "person_id": self.person.id},
+                            {"checked_out": True}])
+        assert_equal(res.status_code, 200)
+        results = res.json['results']
+        assert_equal([r['status'] for r in results], [201, 400])
+        item = models.item.get(id=results[0]['item']['id'])
+        assert_equal(item.name, "Ipad")
+        assert_equal(item.person, self.person)
+
+    def test_bulk_put_same_item_twice(self):
+        item_id, person_id, person2_id = (self.item.id, self.person.id,
+                                            self.person2.id)
+        res = self._put_json("/api/v1/items/bulk",
+                            [{"id": item_id, "name": "Ipad",
+                                "person_id": person2_id},
+                            {"id": item_id, "name": "Kindle",
+                                "person_id": person_id}])
+        results = [(r['item']['name'], r['item']['person']['id'])
+                    for r in res.json['results']]
+        # Each row gets the state it wrote, and the last one is stored
+        assert_equal(results, [("Ipad", person2_id), ("Kindle", person_id)])
+        res = self.client.get("/api/v1/items/{0}".format(item_id))
+        assert_equal(res.json['name'], "Kindle")
+        assert_equal(res.json['person']['id'], person_id)
+
+    def test_bulk_delete_items(self):
+        res = self.client.delete("/api/v1/items/bulk",
+                                data=json.dumps([self.item.id, 1234]),
+                                content_type='application/json')
+        assert_equal([r['status'] for r in res.json['results']], [200, 404])
+        assert_equal(list(models.item.query()), [self.item2])
+
     def test_recent(self):
         self.item.checked_out = True
         self.item2.checked_out = False
@@ -138,6 +342,29 @@ class TestStdnetAPI(TestCase):
         assert_in(ItemSerializer(self.item).data, res.json['items'])
         assert_not_in(ItemSerializer(self.item2).data, res.json['items'])
 
+    def test_recent_returns_every_checkout(self):
+        self.item.checked_out = True
+        self.item2.checked_out = True
+        self.item.save()
+        self.item2.save()
+        res = self.client.get("/api/v1/recentcheckouts/?limit=1")
+        assert_equal(len(res.json['items']), 2)
+
+    def test_recent_excludes_old_checkouts(self):
+        self.item.checked_out = True
+        self.item.updated = datetime.utcnow() - timedelta(hours=2)
+        self.item.save()
+        res = self.client.get("/api/v1/recentcheckouts/")
+        assert_equal(res.json['items'], [])
+
+    def test_recent_excludes_returned_items(self):
+        self.item.checked_out = True
+        self.item.save()
+        self.item.checked_out = False
+        self.item.save()
+        res = self.client.get("/api/v1/recentcheckouts/")
+        assert_equal(res.json['items'], [])
+
 
 if __name__ == '__main__':
     unittest.main()